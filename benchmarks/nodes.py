@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Memory and construction time of the tree nodes
+#
+# Usage: python3 benchmarks/nodes.py [number of subscribers]
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from pyqos.algorithms.htb import HTBClass, HTBFilterSFQ, RootHTBClass
+
+
+def build_tree(subscribers):
+    """
+    Build a tree of one class per subscriber, each one with 2 leaves (so 3
+    classes and 2 qdiscs per subscriber)
+    """
+    root = RootHTBClass("eth0", rate=10000000, ceil=10000000, default=0)
+    for i in range(subscribers):
+        subscriber = HTBClass(id=0x10000 + i, rate=(1, 1000), ceil=100000)
+        subscriber.add_child(
+            HTBFilterSFQ(id=0x20000 + 2 * i, mark=2 * i + 1, prio=1,
+                         rate=(80, 100), ceil=(100, 100)),
+            HTBFilterSFQ(id=0x20001 + 2 * i, mark=2 * i + 2, prio=2,
+                         rate=(20, 10), ceil=(100, 100)),
+        )
+        root.add_child(subscriber)
+    return root
+
+
+def build_chain(depth):
+    """
+    Build a chain of classes with relative rates and burst formulas
+    """
+    root = RootHTBClass("eth0", rate=10000000, ceil=10000000, default=0)
+    node = root
+    for i in range(depth):
+        child = HTBClass(
+            id=i + 2, rate=(90, 10), ceil=(100, 10),
+            burst=(lambda obj: obj.rate / 8, ),
+            cburst=(lambda obj: 1.5 * obj.rate / 8 + obj.burst, )
+        )
+        node.add_child(child)
+        node = child
+    return root
+
+
+def resolve_tree(node):
+    """
+    Read the values used in the tc commands of every class
+    """
+    node.rate, node.ceil, node.burst, node.cburst
+    for child in node.children:
+        resolve_tree(child)
+
+
+def count_nodes(node):
+    count = 1
+    for child in node.children:
+        count += count_nodes(child)
+        if getattr(child, "qdisc", None) is not None:
+            count += 1
+    return count
+
+
+def main(subscribers=10000):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    root = build_tree(subscribers)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    nodes = count_nodes(root)
+    start = time.perf_counter()
+    build_tree(subscribers)
+    elapsed_untraced = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(3):
+        for subscriber in root.children:
+            for leaf in subscriber.children:
+                leaf.rate, leaf.ceil
+    elapsed_rates = time.perf_counter() - start
+
+    chain = build_chain(100)
+    start = time.perf_counter()
+    resolve_tree(chain)
+    elapsed_chain = time.perf_counter() - start
+
+    print("nodes: {}".format(nodes))
+    print("memory: {:.0f} bytes/node".format(memory / nodes))
+    print("construction: {:.0f} nodes/s (traced: {:.0f} nodes/s)".format(
+        nodes / elapsed_untraced, nodes / elapsed
+    ))
+    print("rate and ceil of the leaves: {:.0f} reads/s".format(
+        3 * 4 * subscribers / elapsed_rates
+    ))
+    print("resolve a chain of 100 classes: {:.1f} ms".format(
+        elapsed_chain * 1000
+    ))
+
+
+if __name__ == "__main__":
+    main(*(int(i) for i in sys.argv[1:]))
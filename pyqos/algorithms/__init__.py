@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 # Author: Anthony Ruhier
 
+import inspect
 import logging
 
+from pyqos import plan
+
 _logger = logging.getLogger("pyqos")
 
 
@@ -22,20 +25,111 @@ class EmptyObject():
             setattr(self, attr, value)
 
 
+class NodeAttribute():
+    """
+    Descriptor of an attribute of a node, declared once on its class
+
+    The value set on an instance is stored in its "_<name>" slot. Reading the
+    attribute calls the "<getter>" method of the class if any, which can get
+    this stored value through :meth:`_BasicQDisc._raw`. Writing it calls the
+    "<setter>" method if any, or stores the value directly.
+
+    A subclass can change the default value by just setting a value in its
+    body, as for any class attribute::
+
+        class Interactive(HTBFilterFQCodel):
+            rate = (30, 1000)
+    """
+    def __init__(self, default=None, getter=None, setter=None):
+        #: value returned if nothing has been set on the instance
+        self.default = default
+        #: name of the method computing the value, if any
+        self.getter = getter
+        #: name of the method setting the value, if any
+        self.setter = setter
+        self.name = None
+        self.slot = None
+        #: bind the default value to the instance, as for a method
+        self._bind_default = False
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = "_" + name
+
+    def with_default(self, default):
+        """
+        Copy of this attribute with another default value
+        """
+        attribute = NodeAttribute(default, self.getter, self.setter)
+        attribute.name, attribute.slot = self.name, self.slot
+        attribute._bind_default = inspect.isfunction(default)
+        return attribute
+
+    def raw(self, obj):
+        """
+        Value stored on obj, or the default one
+        """
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            if self._bind_default:
+                return self.default.__get__(obj, type(obj))
+            return self.default
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.getter is not None:
+            return getattr(type(obj), self.getter)(obj)
+        return self.raw(obj)
+
+    def __set__(self, obj, value):
+        if self.setter is not None:
+            getattr(type(obj), self.setter)(obj, value)
+        else:
+            setattr(obj, self.slot, value)
+
+
 class _BasicQDisc():
     """
     Abstract class for QDisc
+
+    The attributes are declared with :class:`NodeAttribute` descriptors and
+    stored in slots, so a node does not need its own dict. Subclasses only
+    need to declare ``__slots__`` to stay compact.
     """
-    #: id
-    _id = None
-    #: interface
-    _interface = None
+    __slots__ = ("_id", "_interface", "_parent")
+
     #: parent object
-    parent = None
+    parent = NodeAttribute()
     #: QDisc ID
-    id = None
+    id = NodeAttribute(getter="_get_id", setter="_set_id")
     #: Interface linked to this qdisc
-    interface = None
+    interface = NodeAttribute(getter="_get_interface",
+                              setter="_set_interface")
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Convert the values set in the body of a subclass, for attributes
+        declared as :class:`NodeAttribute` by a parent, to new defaults
+        """
+        super().__init_subclass__(**kwargs)
+        for name, value in list(vars(cls).items()):
+            if (name.startswith("__") or
+                    isinstance(value, (NodeAttribute, property))):
+                continue
+            for base in cls.__mro__[1:]:
+                if name in vars(base):
+                    attribute = vars(base)[name]
+                    if isinstance(attribute, NodeAttribute):
+                        setattr(cls, name, attribute.with_default(value))
+                    break
+
+    def _raw(self, attr):
+        """
+        Value set for an attribute, without going through its getter
+        """
+        return getattr(type(self), attr).raw(self)
 
     def _getter_attr_shared_with_parents(self, attr):
         """
@@ -46,7 +140,7 @@ class _BasicQDisc():
         To use the value set directly on this qdisc attribute (and its
         parent one), set the parent attribute to None.
         """
-        return (getattr(self, "_" + attr)
+        return (self._raw(attr)
                 if self.parent is None else getattr(self.parent, attr))
 
     def _setter_attr_shared_with_parents(self, attr, value):
@@ -64,59 +158,26 @@ class _BasicQDisc():
             )
         setattr(self, "_" + attr, value)
 
-    def _get_id(self, obj=None):
+    def _get_id(self):
         """
         Getter for id
         """
-        if obj is not None:
-            self = obj
         return self._getter_attr_shared_with_parents("id")
 
-    def _set_id(self, obj=None, value=None):
-        if obj is not None:
-            self = obj
+    def _set_id(self, value):
         return self._setter_attr_shared_with_parents("id", value)
 
-    def _get_interface(self, obj=None):
+    def _get_interface(self):
         """
         Getter for the interface
         """
         return self._getter_attr_shared_with_parents("interface")
 
-    def _set_interface(self, obj=None, value=None):
+    def _set_interface(self, value):
         return self._setter_attr_shared_with_parents("interface", value)
 
-    def _init_properties(self, *args):
-        """
-        Little hack to allow overriding the class and conserving the properties
-        without the need of overriding __init__
-        """
-        def set_property(attribute):
-            cls = type(self)
-            if not hasattr(cls, "__perinstance"):
-                cls = type(cls.__name__, (cls,), {})
-                cls.__perinstance = True
-                self.__class__ = cls
-            setattr(
-                cls, attribute,
-                property(
-                    getattr(self, "_get_" + attribute),
-                    getattr(self, "_set_" + attribute)
-                )
-            )
-
-        for attribute in args:
-            try:
-                if not isinstance(getattr(type(self), attribute), property):
-                    tmp = getattr(self, attribute)
-                    set_property(attribute)
-                    setattr(self, attribute, tmp)
-            except AttributeError:
-                set_property(attribute)
-
     def __init__(self, id=None, parent=None, interface=None, *args,
                  **kwargs):
-        self._init_properties("id", "interface")
         if parent is not None:
             self.parent = parent
         if interface is not None:
@@ -124,8 +185,16 @@ class _BasicQDisc():
         if id is not None:
             self.id = id
 
-    def apply(self, dryrun=False):
+    def compile(self):
+        """
+        Generate the operations to apply the node
+
+        :return: generator of :class:`pyqos.plan.Operation`
+        """
         raise NotImplementedError()
 
+    def apply(self, dryrun=False):
+        plan.execute(self.compile(), dryrun=dryrun)
+
 
-from . import classless_qdiscs, htb
+from . import classless_qdiscs, htb, mq, subscribers, u32
@@ -1,26 +1,27 @@
 #!/usr/bin/env python3
 # Author: Anthony Ruhier
 
-from pyqos import tools
-from pyqos.backend import tc
-from . import _BasicQDisc
+from pyqos import interfaces, plan
+from . import _BasicQDisc, NodeAttribute
 
 
 class FQCodel(_BasicQDisc):
     """
     FQCodel (fq_codel) qdisc
     """
+    __slots__ = ("_limit", "_flows", "_target", "_interval", "_codel_quantum")
+
     #: when this limit is reached, incoming packets are dropped
-    limit = None
+    limit = NodeAttribute()
     #: is the number of flows into which the incoming packets are classified
-    flows = None
+    flows = NodeAttribute()
     #: is the acceptable minimum standing/persistent queue delay
-    target = None
+    target = NodeAttribute()
     #: is used to ensure that the measured minimum delay does not become too
     #: stale
-    interval = None
+    interval = NodeAttribute()
     #: is the number of bytes used as 'deficit' in the fair queuing algorithm
-    codel_quantum = None
+    codel_quantum = NodeAttribute()
 
     def __init__(self, limit=None, flows=None, target=None, interval=None,
                  codel_quantum=None, *args, **kwargs):
@@ -31,15 +32,15 @@ class FQCodel(_BasicQDisc):
         self.codel_quantum = codel_quantum
         super().__init__(*args, **kwargs)
 
-    def apply(self, dryrun=False):
+    def compile(self):
         if self.codel_quantum is None:
-            self.codel_quantum = tools.get_mtu(self.interface)
-        tc.qdisc_add(
-            self.interface,
+            self.codel_quantum = interfaces.get_mtu(self.interface)
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self,
             parent=self.parent.classid if self.parent else None,
             handle=self.id, algorithm="fq_codel",
             limit=self.limit, flows=self.flows, target=self.target,
-            interval=self.interval, quantum=self.codel_quantum, dryrun=dryrun
+            interval=self.interval, quantum=self.codel_quantum
         )
 
 
@@ -47,11 +48,13 @@ class PFIFO(_BasicQDisc):
     """
     PFIFO QDisc
     """
-    def apply(self, dryrun=False):
-        tc.qdisc_add(
-            self.interface,
+    __slots__ = ()
+
+    def compile(self):
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self,
             parent=self.parent.classid if self.parent else None,
-            handle=self.id, algorithm="pfifo", dryrun=dryrun
+            handle=self.id, algorithm="pfifo"
         )
 
 
@@ -59,19 +62,20 @@ class SFQ(_BasicQDisc):
     """
     SFQ QDisc
     """
+    __slots__ = ("_perturb", )
+
     #: perturb parameter for sfq
-    perturb = None
+    perturb = NodeAttribute()
 
     def __init__(self, perturb=10, *args, **kwargs):
         self.perturb = perturb
         super().__init__(*args, **kwargs)
 
-    def apply(self, dryrun=False):
-        tc.qdisc_add(
-            self.interface,
+    def compile(self):
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self,
             parent=self.parent.classid if self.parent else None,
-            handle=self.id, algorithm="sfq", perturb=self.perturb,
-            dryrun=dryrun
+            handle=self.id, algorithm="sfq", perturb=self.perturb
         )
 
 
@@ -82,6 +86,13 @@ class Cake(_BasicQDisc):
     Complete documentation about this algorithm can be read here:
     https://www.bufferbloat.net/projects/codel/wiki/Cake/
     """
+    __slots__ = (
+        "bandwidth", "autorate_ingress", "rtt_time", "rtt_preset",
+        "priority_queue_preset", "flow_isolation", "nat", "wash", "split_gso",
+        "ack_filter", "ack_filter_aggressive", "memlimit", "fwmark",
+        "atm_ptm_compensation", "overhead", "mpu", "overhead_preset",
+        "ingress"
+    )
 
     def __init__(
             self, bandwidth=None, autorate_ingress=False, rtt_time=None,
@@ -157,13 +168,15 @@ class Cake(_BasicQDisc):
 
         super().__init__(*args, **kwargs)
 
-    def apply(self, dryrun=False):
+    def compile(self):
         qdisc_args, qdisc_kwargs = self._build_tc_qdisc_opts()
 
-        tc.qdisc_add(
-            self.interface, handle=self.id, algorithm="cake",
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self, handle=self.id,
+            algorithm="cake",
             parent=self.parent.classid if self.parent else None,
-            opts_args=qdisc_args, dryrun=dryrun, **qdisc_kwargs
+            opts_args=list(qdisc_args) if qdisc_args else None,
+            **qdisc_kwargs
         )
 
     def _build_tc_qdisc_opts(self):
@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 # Author: Anthony Ruhier
 
+from collections import OrderedDict
 import inspect
 
-from pyqos import tools
-from pyqos.backend import tc
+from pyqos import backend, interfaces, plan, solver, stats
+from pyqos.backend import syntax
 from pyqos.exceptions import BadAttributeValueException, NoParentException
-from . import _BasicQDisc
+from . import _BasicQDisc, NodeAttribute
 from .classless_qdiscs import Cake, FQCodel, PFIFO, SFQ
 
 
@@ -14,6 +15,8 @@ class HTBQdisc(_BasicQDisc):
     """
     Implement the qdisc which will be directly set on the network interface
     """
+    __slots__ = ()
+
     @property
     def id(self):
         return str(self.parent.branch_id) + ":"
@@ -30,9 +33,75 @@ class HTBQdisc(_BasicQDisc):
     def r2q(self):
         return self.parent.r2q
 
-    def apply(self, dryrun=False):
-        tc.qdisc_add(self.interface, self.id, "htb",
-                     default=self.default, r2q=self.r2q, dryrun=dryrun)
+    def compile(self):
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self,
+            parent=self.parent.qdisc_parent, handle=self.id, algorithm="htb",
+            default=self.default, r2q=self.r2q
+        )
+
+
+def _match_protocol(rule):
+    """
+    Ethernet protocol of a flower rule: "ipv6" if it matches an IPv6 address
+    or icmpv6, "ip" otherwise
+    """
+    if str(rule.get("ip_proto")) == "icmpv6":
+        return "ipv6"
+    for key in ("src_ip", "dst_ip"):
+        if rule.get(key) is not None and ":" in str(rule[key]):
+            return "ipv6"
+    return "ip"
+
+
+def _in_chain(operation, chain):
+    return operation._replace(args=dict(operation.args, chain=chain))
+
+
+def _chain_matches(operations, root):
+    """
+    Move the IPv4 flower rules to one filter chain per IP protocol
+
+    The chain 0 keeps the rules without IP protocol, and gets one dispatch
+    filter per protocol, jumping to its chain. The rules without IP protocol
+    are copied in every chain, so a packet meets the same rules in the same
+    order as without chains, but only the ones of its protocol.
+
+    :param operations: operations of a tree
+    :param root: :class:`RootHTBClass` of the tree
+    :return: generator of :class:`pyqos.plan.Operation`
+    """
+    #: chain of each IP protocol
+    chains = OrderedDict()
+    common = []
+    dispatch_prio = None
+    for op in operations:
+        if not (op.kind == "filter" and op.args.get("kind") == "flower" and
+                op.args.get("protocol") == "ip"):
+            yield op
+            continue
+        prio = op.args["prio"]
+        dispatch_prio = min(prio, dispatch_prio or prio)
+        ip_proto = op.args.get("ip_proto")
+        if ip_proto is None:
+            common.append(op)
+            yield op
+            for chain in chains.values():
+                yield _in_chain(op, chain)
+            continue
+        ip_proto = str(ip_proto)
+        if ip_proto not in chains:
+            chains[ip_proto] = len(chains) + 1
+            for common_op in common:
+                yield _in_chain(common_op, chains[ip_proto])
+        yield _in_chain(op, chains[ip_proto])
+    # dispatch once the chains are filled
+    for ip_proto, chain in chains.items():
+        yield plan.make_operation(
+            "filter", "add", root.interface, root,
+            parent=str(root.branch_id) + ":", prio=dispatch_prio,
+            protocol="ip", kind="flower", ip_proto=ip_proto, goto_chain=chain
+        )
 
 
 class EmptyHTBClass(_BasicQDisc):
@@ -42,49 +111,53 @@ class EmptyHTBClass(_BasicQDisc):
     Can be useful to simulate, for example, a class already handled by another
     tool in the system.
     """
-    #: store the rate as it was defined during the init
-    _rate = None
-    #: store the ceil as it was defined during the init
-    _ceil = None
-    #: store the burst as it was defined during the init
-    _burst = None
-    #: store the cburst as it was defined during the init
-    _cburst = None
+    __slots__ = (
+        "_rate", "_ceil", "_burst", "_cburst", "_quantum", "_prio",
+        "_children", "_stats", "auto_quantum", "_resolved"
+    )
+
     #: parent object
-    parent = None
+    parent = NodeAttribute(setter="_set_parent")
+    #: id of the class, under its branch
+    id = NodeAttribute()
     #: quantum (optional)
-    _quantum = None
+    quantum = NodeAttribute(getter="_get_quantum")
     #: priority
-    prio = None
+    prio = NodeAttribute()
     #: children class which will be attached to this class
-    children = None
+    children = NodeAttribute()
+    #: last statistics sampled by :class:`pyqos.stats.Poller`, as a
+    #: :class:`pyqos.stats.ClassStats`
+    stats = NodeAttribute()
 
     #: If rate is an integer, will be used directly. Can also be a tupple to
     #: set a relative rate, equals to a % of the parent class rate:
     #: ``(percentage, rate_min, rate_max)``. The root class cannot have a
     #: relative rate.
-    #: Will be replaced by a property at init
-    rate = None
+    #:
+    #: The resolved rate, ceil, burst and cburst are cached until the class or
+    #: one of its parents is modified. A callback depending on other classes
+    #: needs :meth:`invalidate` to be called when they change.
+    rate = NodeAttribute(getter="_get_rate", setter="_set_rate")
 
     #: If ceil is an integer, will be used directly. Can also
     #: be a tupple to set a relative ceil, equals to a % of the parent class
     #: ceil: ``(percentage, ceil_min, ceil_max)``. If the parent has no ceil
     #: defined, a relative ceil will use the parent's rate instead. The root
     #: class cannot have a relative ceil.
-    #: Will be replaced by a property at init
-    ceil = None
+    ceil = NodeAttribute(getter="_get_ceil", setter="_set_ceil")
 
     #: Burst can be a callback or a fixed value
     #:
-    #: If _burst is an integer, its value will be returned directly.
+    #: If burst is an integer, its value will be returned directly.
     #: Otherwise, if it is a tuple, it will be considered as a callback.
-    burst = None
+    burst = NodeAttribute(getter="_get_burst", setter="_set_burst")
 
     #: Cburst can be a callback or a fixed value
     #:
-    #: If _burst is an integer, its value will be returned directly.
+    #: If cburst is an integer, its value will be returned directly.
     #: Otherwise, if it is a tuple, it will be considered as a callback.
-    cburst = None
+    cburst = NodeAttribute(getter="_get_cburst", setter="_set_cburst")
 
     def _compute_speeds(self, attr):
         """
@@ -103,7 +176,7 @@ class EmptyHTBClass(_BasicQDisc):
         parent_speed = getattr(self.parent, attr)
         if attr is "ceil" and parent_speed is None:
             parent_speed = getattr(self.parent, "rate")
-        relative_speed = getattr(self, "_" + attr)
+        relative_speed = self._raw(attr)
         if len(relative_speed) == 3:
             coeff, speed_min, speed_max = relative_speed
         elif len(relative_speed) == 2:
@@ -137,12 +210,11 @@ class EmptyHTBClass(_BasicQDisc):
             )
         return self.parent.interface
 
-    @property
-    def quantum(self):
+    def _get_quantum(self):
         """
-        Quantum value
+        Getter for quantum
         """
-        return self._quantum
+        return self._raw("quantum")
 
     @property
     def branch_id(self):
@@ -158,39 +230,66 @@ class EmptyHTBClass(_BasicQDisc):
         """
         return str(self.branch_id) + ":" + str(self.id)
 
-    def _get_rate(self, obj=None):
+    def _resolve(self, attr, compute):
         """
-        Getter for rate
+        Return the resolved value of attr, computed once by compute() until
+        the class or one of its parents is modified
         """
-        if obj is not None:
-            self = obj
-        return (self._compute_speeds("rate") if type(self._rate) is tuple
-                else self._rate)
+        try:
+            resolved = self._resolved
+        except AttributeError:
+            resolved = None
+        if resolved is None:
+            resolved = self._resolved = {}
+        try:
+            return resolved[attr]
+        except KeyError:
+            value = resolved[attr] = compute()
+            return value
 
-    def _set_rate(self, obj=None, value=None):
+    def invalidate(self):
         """
-        Setter for rate
+        Forget the resolved values of this class and of its children
         """
-        if obj is not None:
-            self = obj
-        self._rate = value
+        self._resolved = None
+        for child in self.children or ():
+            child.invalidate()
 
-    def _get_ceil(self, obj=None):
+    def _set_and_invalidate(self, attr, value):
+        setattr(self, "_" + attr, value)
+        # the children resolve their values through the getters of this
+        # class, so they cannot depend on it if none of them has been used
+        if getattr(self, "_resolved", None):
+            self.invalidate()
+
+    def _set_parent(self, value):
+        self._set_and_invalidate("parent", value)
+
+    def _get_rate(self):
         """
-        Getter for ceil
+        Getter for rate
         """
-        if obj is not None:
-            self = obj
-        return (self._compute_speeds("ceil") if type(self._ceil) is tuple
-                else self._ceil)
+        def compute():
+            rate = self._raw("rate")
+            return (self._compute_speeds("rate") if type(rate) is tuple
+                    else rate)
+        return self._resolve("rate", compute)
+
+    def _set_rate(self, value):
+        self._set_and_invalidate("rate", value)
 
-    def _set_ceil(self, obj=None, value=None):
+    def _get_ceil(self):
         """
-        Setter for ceil
+        Getter for ceil
         """
-        if obj is not None:
-            self = obj
-        self._ceil = value
+        def compute():
+            ceil = self._raw("ceil")
+            return (self._compute_speeds("ceil") if type(ceil) is tuple
+                    else ceil)
+        return self._resolve("ceil", compute)
+
+    def _set_ceil(self, value):
+        self._set_and_invalidate("ceil", value)
 
     def _getter_burst_cburst(self, attr):
         """
@@ -220,34 +319,33 @@ class EmptyHTBClass(_BasicQDisc):
             callback = attr[0]
             return callback(self)
 
-    def _get_burst(self, obj=None):
+    def _get_burst(self):
         """
         Getter for burst
         """
-        if obj is not None:
-            self = obj
-        return self._getter_burst_cburst(self._burst)
+        return self._resolve(
+            "burst", lambda: self._getter_burst_cburst(self._raw("burst"))
+        )
 
-    def _set_burst(self, obj=None, value=None):
-        if obj is not None:
-            self = obj
-        self._burst = value
+    def _set_burst(self, value):
+        self._set_and_invalidate("burst", value)
 
-    def _get_cburst(self, obj=None):
+    def _get_cburst(self):
         """
         Getter for cburst
         """
-        if obj is not None:
-            self = obj
-        return self._getter_burst_cburst(self._cburst)
+        return self._resolve(
+            "cburst", lambda: self._getter_burst_cburst(self._raw("cburst"))
+        )
 
-    def _set_cburst(self, obj=None, value=None):
-        if obj is not None:
-            self = obj
-        self._cburst = value
+    def _set_cburst(self, value):
+        self._set_and_invalidate("cburst", value)
 
-    def _add_class(self, *args, **kwargs):
-        pass
+    def _compile_class(self):
+        return ()
+
+    def _compile_match(self):
+        return ()
 
     def add_child(self, *args):
         """
@@ -257,6 +355,21 @@ class EmptyHTBClass(_BasicQDisc):
             class_child.parent = self
             self.children.append(class_child)
 
+    def compile(self, auto_quantum=True):
+        """
+        Generate the operations to apply the qos with current attributes
+
+        The function is recursive, so it will generate the operations of all
+        children too.
+
+        :return: generator of :class:`pyqos.plan.Operation`
+        """
+        self.auto_quantum = auto_quantum
+        yield from self._compile_class()
+        yield from self._compile_match()
+        for child in self.children:
+            yield from plan.compile_node(child, auto_quantum=auto_quantum)
+
     def apply(self, auto_quantum=True, dryrun=False):
         """
         Apply qos with current attributes
@@ -264,16 +377,13 @@ class EmptyHTBClass(_BasicQDisc):
         The function is recursive, so it will apply the qos of all children
         too.
         """
-        self.auto_quantum = auto_quantum
-        self._add_class(dryrun=dryrun)
-        for child in self.children:
-            child.apply(auto_quantum=auto_quantum, dryrun=dryrun)
+        plan.execute(self.compile(auto_quantum=auto_quantum), dryrun=dryrun)
 
     def __init__(self, id=None, rate=None, ceil=None,
                  burst=None, cburst=None, quantum=None, prio=None,
                  children=None, *args, **kwargs):
-        self._init_properties("rate", "ceil", "burst", "cburst")
-        self.id = id or self.id
+        if id is not None:
+            self.id = id
         if rate is not None:
             self.rate = rate
         if ceil is not None:
@@ -282,49 +392,143 @@ class EmptyHTBClass(_BasicQDisc):
             self.burst = burst
         if cburst is not None:
             self.cburst = cburst
-        self._quantum = quantum
-        self.prio = prio or self.prio
+        if quantum is not None:
+            self.quantum = quantum
+        if prio is not None:
+            self.prio = prio
         self.children = children or []
 
 
 class HTBClass(EmptyHTBClass):
     """
     Basic HTB class
+
+    The packets can be classified to the class without any firewall marking
+    rule, with :attr:`match` and :attr:`dscp`: they are compiled into flower
+    filters attached to the root qdisc. The rules match IPv4 packets, unless
+    they contain an IPv6 address::
+
+        HTBClass(id=10, rate=1000, match={"ip_proto": "tcp", "dst_port": 22})
+        HTBClass(id=20, rate=500, dscp="EF")
     """
-    @property
-    def quantum(self):
+    __slots__ = ("_match", "_dscp", "_match_prio")
+
+    #: flower keys to match, as a dict like ``{"ip_proto": "tcp",
+    #: "dst_port": 22}``, or a list of dicts for several rules. See
+    #: :data:`pyqos.backend.syntax.FLOWER_KEYS` for the keys.
+    match = NodeAttribute()
+    #: DiffServ code point to match, as a class name ("EF", "AF41", "CS1") or
+    #: a number. Combined with each rule of :attr:`match`, if any.
+    dscp = NodeAttribute()
+    #: priority of the flower filters. If None, use the prio of the class.
+    #: A priority holds filters of one kind and one protocol only, so it has
+    #: to differ from the ones of the fw filters, and IPv4 and IPv6 rules
+    #: need different priorities.
+    match_prio = NodeAttribute()
+
+    def __init__(self, *args, match=None, dscp=None, match_prio=None,
+                 **kwargs):
+        if match is not None:
+            self.match = match
+        if dscp is not None:
+            self.dscp = dscp
+        if match_prio is not None:
+            self.match_prio = match_prio
+        super().__init__(*args, **kwargs)
+
+    def _get_quantum(self):
         """
-        Quantum value
+        Quantum value. If not set, computed from the MTU of the interface
+        unless auto_quantum is disabled.
         """
+        quantum = self._raw("quantum")
         try:
-            if self.auto_quantum and self._quantum is None:
-                return tools.get_mtu(self.interface) + 14
+            if self.auto_quantum and quantum is None:
+                return interfaces.get_mtu(self.interface) + 14
         except AttributeError:
-            return self._quantum
+            pass
+        return quantum
 
-    def _add_class(self, dryrun=False):
+    def _compile_class(self):
         """
-        Add class to the interface
+        Generate the operation adding the class to the interface
         """
-        tc.qos_class_add(self.interface, parent=self.parent.classid,
-                         classid=self.classid, rate=self.rate,
-                         ceil=self.ceil, burst=self.burst, cburst=self.cburst,
-                         prio=self.prio, quantum=self.quantum, dryrun=dryrun)
+        yield plan.make_operation(
+            "class", "add", self.interface, self, parent=self.parent.classid,
+            classid=self.classid, algorithm="htb", rate=self.rate,
+            ceil=self.ceil, burst=self.burst, cburst=self.cburst,
+            prio=self.prio, quantum=self.quantum
+        )
+
+    def _compile_match(self):
+        """
+        Generate the operations adding the flower filters of :attr:`match`
+        and :attr:`dscp`, attached to the root qdisc, unless the root
+        classifies with nftables
+        """
+        rules = self.match
+        if (rules is None and self.dscp is None or
+                self.root.classifier != "flower"):
+            return
+        if rules is None or isinstance(rules, dict):
+            rules = [rules or {}]
+        for rule in rules:
+            unknown = set(rule).difference(syntax.FLOWER_KEYS)
+            if unknown:
+                raise BadAttributeValueException(
+                    "Unknown match keys: " + ", ".join(sorted(unknown))
+                )
+            rule = dict(rule)
+            if self.dscp is not None:
+                rule["ip_tos"] = syntax.format_tos_match(self.dscp)
+            yield plan.make_operation(
+                "filter", "add", self.interface, self,
+                parent=str(self.branch_id) + ":",
+                prio=self.match_prio or self.prio or 1,
+                protocol=_match_protocol(rule), kind="flower",
+                flowid=self.classid, **rule
+            )
 
 
 class RootHTBClass(HTBClass):
     """
     Root tc class, directly attached to the interface
     """
-    #: interface
-    _interface = None
+    __slots__ = ("_branch_id", "_spare_branch_id", "_default", "_r2q",
+                 "_qdisc_parent", "_mark_classid", "_classifier",
+                 "_filter_chains", "_qdisc")
+
     id = 1
     #: branch id (and id of the root qdisc)
-    branch_id = None
+    branch_id = NodeAttribute()
+    #: branch id used instead of branch_id to swap the tree, as the new root
+    #: qdisc needs another handle than the current one. Defaults to
+    #: branch_id + 1 (in hexadecimal if branch_id is a string).
+    spare_branch_id = NodeAttribute()
     #: default mark to catch
-    default = None
+    default = NodeAttribute()
     #: r2q, to influe on the quantum (optional)
-    r2q = None
+    r2q = NodeAttribute()
+    #: classid to which the htb qdisc is attached, like a queue of a mq
+    #: qdisc. If None, the qdisc is the root of the interface.
+    qdisc_parent = NodeAttribute()
+    #: classify the packets with one fw filter using their mark as classid,
+    #: instead of one filter per class. The packets have then to be marked
+    #: with the classid of their class, as a number (see
+    #: :attr:`HTBFilter.fw_mark`): a 10k classes tree is classified in
+    #: constant time, and set up with one filter.
+    mark_classid = NodeAttribute(False)
+    #: how the :attr:`HTBClass.match` and :attr:`HTBClass.dscp` of the
+    #: classes are applied: "flower" to compile them into flower filters, or
+    #: "nftables" to mark the packets with an nftables ruleset (see
+    #: :mod:`pyqos.nftables`) for the fw filters.
+    classifier = NodeAttribute("flower")
+    #: put the IPv4 flower rules of each IP protocol in their own filter
+    #: chain, reached by a "goto chain" dispatch filter, so a packet is only
+    #: compared to the rules of its protocol. The dispatch filters take the
+    #: lowest prio of the flower rules: the other kinds of filters with a
+    #: higher prio are not reached by the dispatched packets anymore.
+    filter_chains = NodeAttribute(False)
 
     @property
     def root(self):
@@ -338,17 +542,49 @@ class RootHTBClass(HTBClass):
         return self._interface
 
     def __init__(self, interface=None, branch_id=1,
-                 default=None, r2q=None, *args, **kwargs):
+                 default=None, r2q=None, spare_branch_id=None,
+                 qdisc_parent=None, mark_classid=None, classifier=None,
+                 filter_chains=None, *args, **kwargs):
         self._interface = interface
+        if classifier is not None:
+            self.classifier = classifier
+        if filter_chains is not None:
+            self.filter_chains = filter_chains
         self.default = default
+        self.qdisc_parent = qdisc_parent or self.qdisc_parent
+        if mark_classid is not None:
+            self.mark_classid = mark_classid
         self.r2q = r2q or self.r2q
         self.branch_id = branch_id or self.branch_id
+        self.spare_branch_id = (spare_branch_id or self.spare_branch_id or
+                                self._next_branch_id())
         self._qdisc = HTBQdisc(parent=self)
         # Needed with inherited functions
         self.parent = self._qdisc
         super().__init__(*args, **kwargs)
 
-    def apply(self, auto_quantum=True, dryrun=False):
+    def _next_branch_id(self):
+        """
+        Default spare branch id: branch_id + 1, in hexadecimal if the branch
+        id is given as tc reads it
+        """
+        if isinstance(self.branch_id, str):
+            return "{:x}".format(
+                (syntax.parse_qdisc_handle(self.branch_id) >> 16) + 1
+            )
+        return self.branch_id + 1
+
+    def swap_branch(self):
+        """
+        Exchange branch_id and spare_branch_id
+
+        All the classids of the tree follow the new branch id.
+        """
+        self.branch_id, self.spare_branch_id = (
+            self.spare_branch_id, self.branch_id
+        )
+
+    def compile(self, auto_quantum=True):
         """
         If the r2q has been defined, the quantum will not be defined
         automatiqually for children.
@@ -357,23 +593,59 @@ class RootHTBClass(HTBClass):
             raise BadAttributeValueException(
                 "Rate cannot be relative for a root class"
             )
-        self._qdisc.apply(dryrun=dryrun)
-        return super().apply(
-            auto_quantum=(auto_quantum and self.r2q is None), dryrun=dryrun
+        # resolve all the relative speeds at once instead of class by class
+        solver.resolve(self)
+        yield from self._qdisc.compile()
+        if self.mark_classid:
+            yield plan.make_operation(
+                "filter", "add", self.interface, self,
+                parent=str(self.branch_id) + ":", prio=1, protocol="all"
+            )
+        operations = super().compile(
+            auto_quantum=(auto_quantum and self.r2q is None)
         )
+        if self.filter_chains:
+            operations = _chain_matches(operations, self)
+        yield from operations
+
+    def compile_classes(self):
+        """
+        Generate the operations adding the classes of the tree, without their
+        qdiscs and filters, as set by the last compile
+
+        :return: generator of :class:`pyqos.plan.Operation`
+        """
+        solver.resolve(self)
+        for node in stats.walk(self):
+            yield from node._compile_class()
+
+    def apply(self, auto_quantum=True, dryrun=False, batch=False):
+        """
+        If the r2q has been defined, the quantum will not be defined
+        automatiqually for children.
+
+        :param batch: queue all commands of the tree and launch them through
+            one tc process for the interface
+        """
+        if batch:
+            with backend.get_backend().batch(dryrun=dryrun):
+                return self.apply(auto_quantum=auto_quantum, dryrun=dryrun)
+        plan.execute(self.compile(auto_quantum=auto_quantum), dryrun=dryrun)
 
 
 class HTBFilter(HTBClass):
     """
     Basic class with filtering
     """
+    __slots__ = ("_mark", "_qdisc", "_qdisc_kwargs")
+
     #: mark catch by the class
-    mark = None
+    mark = NodeAttribute()
     #: qdisc associated. Can be a class of an already initialized qdisc.
-    qdisc = None
+    qdisc = NodeAttribute()
     #: dict used during the construction **ONLY**, used as a kwargs to set the
     #: qdisc attributes.
-    qdisc_kwargs = dict()
+    qdisc_kwargs = NodeAttribute(dict())
 
     def __init__(self, mark=None, qdisc=None, qdisc_kwargs=None, *args,
                  **kwargs):
@@ -389,33 +661,53 @@ class HTBFilter(HTBClass):
                 setattr(qdisc, attr, value)
         super().__init__(*args, **kwargs)
 
-    def _add_filter(self, dryrun=False):
+    @property
+    def fw_mark(self):
         """
-        Add filter to the class
+        Mark to set on the packets to send them to this class: the classid,
+        as a number, if the root uses the marks as classids, or :attr:`mark`
         """
-        tc.filter_add(self.interface, parent=str(self.branch_id) + ":",
-                      prio=self.prio, handle=self.mark, flowid=self.classid,
-                      dryrun=dryrun)
+        if self.root.mark_classid:
+            return syntax.parse_classid(self.classid)
+        return self.mark
 
-    def apply(self, auto_quantum=True, dryrun=False):
+    def _compile_filter(self):
         """
-        Apply qos with current attributes
+        Generate the operation adding the filter to the class, unless the
+        root filter uses the marks as classids or the class has no mark
+        """
+        if self.root.mark_classid or self.mark is None:
+            return
+        yield plan.make_operation(
+            "filter", "add", self.interface, self,
+            parent=str(self.branch_id) + ":", prio=self.prio,
+            handle=self.mark, flowid=self.classid, protocol="all"
+        )
 
-        The function is recursive, so it will apply the qos of all children
-        too.
+    def compile(self, auto_quantum=True):
+        """
+        Generate the operations to apply the qos with current attributes
+
+        The function is recursive, so it will generate the operations of all
+        children too.
+
+        :return: generator of :class:`pyqos.plan.Operation`
         """
         self.auto_quantum = auto_quantum
-        self._add_class(dryrun=dryrun)
-        self.qdisc.apply(dryrun=dryrun)
-        self._add_filter(dryrun=dryrun)
+        yield from self._compile_class()
+        yield from plan.compile_node(self.qdisc)
+        yield from self._compile_filter()
+        yield from self._compile_match()
         for child in self.children:
-            child.apply(auto_quantum=auto_quantum, dryrun=dryrun)
+            yield from plan.compile_node(child, auto_quantum=auto_quantum)
 
 
 class HTBFilterCake(HTBFilter):
     """
     Lazy wrapper to get a HTB class with a filter and a Cake qdisc already set
     """
+    __slots__ = ()
+
     qdisc = Cake
 
 
@@ -424,6 +716,8 @@ class HTBFilterFQCodel(HTBFilter):
     Lazy wrapper to get a HTB class with a filter and a FQCodel qdisc already
     set
     """
+    __slots__ = ()
+
     qdisc = FQCodel
 
 
@@ -432,6 +726,8 @@ class HTBFilterPFIFO(HTBFilter):
     Lazy wrapper to get a HTB class with a filter and a PFIFO qdisc already
     set
     """
+    __slots__ = ()
+
     qdisc = PFIFO
 
 
@@ -439,4 +735,6 @@ class HTBFilterSFQ(HTBFilter):
     """
     Lazy wrapper to get a HTB class with a filter and a SFQ qdisc already set
     """
+    __slots__ = ()
+
     qdisc = SFQ
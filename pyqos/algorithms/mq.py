@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+
+from pyqos import interfaces, plan, stats
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException, ConflictException
+from . import _BasicQDisc, NodeAttribute
+
+#: first qdisc major of the trees of the queues. The majors from this one to
+#: 0xffff are reserved: two per queue, for the branch id and the spare one.
+QUEUES_FIRST_MAJOR = 0xfe00
+
+
+class MQQueue(_BasicQDisc):
+    """
+    Class of a mq qdisc, created by the kernel for each TX queue
+
+    Used as parent for the tree of the queue: a classless qdisc can directly
+    take it as parent, and a :class:`pyqos.algorithms.htb.RootHTBClass` can be
+    attached to it with its branch ids and classid::
+
+        RootHTBClass(queue.interface, branch_id=queue.branch_id,
+                     spare_branch_id=queue.spare_branch_id,
+                     qdisc_parent=queue.classid, rate=queue.rate)
+
+    All the trees share the qdisc handles of the interface, and the leaf
+    qdisc of a class takes its id as handle: the leaves of the queues need
+    different ids, like the ones of :meth:`leaf_id`.
+    """
+    __slots__ = ("_queue", "_rate")
+
+    #: number of the TX queue, starting at 1
+    queue = NodeAttribute()
+    #: share of the mq rate for this queue, in kbit/s
+    rate = NodeAttribute()
+
+    def __init__(self, queue=None, rate=None, *args, **kwargs):
+        self.queue = queue
+        self.rate = rate
+        super().__init__(*args, **kwargs)
+
+    def _major(self, offset):
+        major = QUEUES_FIRST_MAJOR + (self.queue - 1) * 2 + offset
+        if not QUEUES_FIRST_MAJOR <= major <= 0xffff:
+            raise BadAttributeValueException(
+                "No qdisc handle left for the queue {}".format(self.queue)
+            )
+        return "{:x}".format(major)
+
+    @property
+    def branch_id(self):
+        """
+        Branch id for the tree of this queue, unique on the interface:
+        ``fe00`` for the first queue, ``fe02`` for the second one...
+        """
+        return self._major(0)
+
+    @property
+    def spare_branch_id(self):
+        """
+        Spare branch id for the tree of this queue: the branch id + 1
+        """
+        return self._major(1)
+
+    @property
+    def id(self):
+        return self.branch_id
+
+    def leaf_id(self, number):
+        """
+        Id of a class of the tree of this queue, unique on the interface, so
+        its leaf qdisc gets its own handle: ``queue * 0x100 + number``
+
+        :param number: number of the class in the queue, under 0x100
+        """
+        if not 0 < number < 0x100:
+            raise BadAttributeValueException(
+                "Leaf number out of range: {}".format(number)
+            )
+        leaf_id = self.queue << 8 | number
+        if leaf_id >= QUEUES_FIRST_MAJOR:
+            raise BadAttributeValueException(
+                "No leaf id left for the queue {}".format(self.queue)
+            )
+        return "{:x}".format(leaf_id)
+
+    @property
+    def classid(self):
+        return "{}:{:x}".format(self.parent.branch_id, self.queue)
+
+    def compile(self):
+        # the classes of the queues are created with the mq qdisc
+        return iter(())
+
+
+class MQRoot(_BasicQDisc):
+    """
+    Multiqueue root: installs a mq qdisc and one tree per TX queue
+
+    A single root qdisc is shared by all the CPUs sending on the interface,
+    and its lock limits the throughput of fast NICs. With mq, each hardware
+    TX queue gets its own tree, and the kernel keeps each flow on the same
+    queue, so the shaping scales with the number of queues.
+
+    The rate is split evenly between the queues. The tree of each queue is
+    built by :attr:`tree`, which can be overridden as a method::
+
+        class Uplink(MQRoot):
+            __slots__ = ()
+
+            rate = 10000000
+
+            def tree(self, queue):
+                root = RootHTBClass(
+                    queue.interface, branch_id=queue.branch_id,
+                    spare_branch_id=queue.spare_branch_id,
+                    qdisc_parent=queue.classid, rate=queue.rate
+                )
+                root.add_child(Interactive(id=queue.leaf_id(0x10)),
+                               Default(id=queue.leaf_id(0x20)))
+                return root
+
+    The qdisc handles from :data:`QUEUES_FIRST_MAJOR` are reserved for the
+    trees of the queues. A :class:`pyqos.exceptions.ConflictException` is
+    raised when the trees are built if two of their qdiscs share a handle.
+    """
+    __slots__ = ("_branch_id", "_rate", "_num_queues", "_tree", "_children")
+
+    #: branch id (and id of the mq qdisc)
+    branch_id = NodeAttribute(1)
+    #: total rate, in kbit/s, split between the queues
+    rate = NodeAttribute()
+    #: number of TX queues to use. If None, use all the TX queues of the
+    #: interface.
+    num_queues = NodeAttribute()
+    #: function called with a :class:`MQQueue`, returning the tree to attach
+    #: to it
+    tree = NodeAttribute()
+    #: trees of the queues, built at the first access
+    children = NodeAttribute(getter="_get_children")
+
+    def __init__(self, interface=None, branch_id=None, rate=None,
+                 num_queues=None, tree=None, *args, **kwargs):
+        if branch_id is not None:
+            self.branch_id = branch_id
+        if rate is not None:
+            self.rate = rate
+        if num_queues is not None:
+            self.num_queues = num_queues
+        if tree is not None:
+            self.tree = tree
+        super().__init__(interface=interface, *args, **kwargs)
+
+    @property
+    def id(self):
+        return str(self.branch_id) + ":"
+
+    @property
+    def classid(self):
+        return self.id
+
+    def queues(self):
+        """
+        Classes of the TX queues used, with their share of the rate
+
+        :return: list of :class:`MQQueue`
+        """
+        num_queues = self.num_queues
+        if num_queues is None:
+            info = interfaces.get_info(self.interface)
+            num_queues = info.num_tx_queues if info is not None else None
+        num_queues = num_queues or 1
+        rate = self.rate // num_queues if self.rate else None
+        return [MQQueue(queue=i, rate=rate, parent=self)
+                for i in range(1, num_queues + 1)]
+
+    def _get_children(self):
+        """
+        Getter for children
+        """
+        children = self._raw("children")
+        if children is None:
+            children = [self.tree(queue) for queue in self.queues()]
+            self._check_handles(children)
+            self._children = children
+        return children
+
+    def _check_handles(self, children):
+        """
+        Check that the qdiscs of the trees of the queues, their leaf qdiscs
+        included, do not share any handle
+
+        :raise ConflictException: if two qdiscs share a handle
+        """
+        owners = {syntax.parse_qdisc_handle(self.id): self}
+
+        def claim(handle, node):
+            owner = owners.setdefault(syntax.parse_qdisc_handle(handle), node)
+            if owner is not node:
+                raise ConflictException(
+                    "{!r} conflicts with {!r} on the qdisc handle {}".format(
+                        node, owner, handle
+                    )
+                )
+
+        for child in children:
+            if not hasattr(child, "children"):
+                # classless qdisc of the queue
+                claim(child.id, child)
+                continue
+            for handle in (child.branch_id, child.spare_branch_id):
+                claim(handle, child)
+            for node in stats.walk(child):
+                qdisc = getattr(node, "qdisc", None)
+                if qdisc is not None:
+                    claim(qdisc.id, node)
+
+    def compile_classes(self):
+        """
+        Generate the operations adding the classes of the trees of the
+        queues
+        """
+        yield from plan.compile_classes(self.children)
+
+    def compile(self):
+        """
+        Generate the operations adding the mq qdisc, then the trees of all
+        the queues
+        """
+        yield plan.make_operation(
+            "qdisc", "add", self.interface, self, handle=self.id,
+            algorithm="mq"
+        )
+        for child in self.children:
+            yield from plan.compile_node(child)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+
+import csv
+
+from pyqos.exceptions import BadAttributeValueException
+from . import NodeAttribute
+from .classless_qdiscs import FQCodel
+from .htb import HTBFilter
+
+#: columns of a subscriber table
+FIELDS = ("id", "address", "plan")
+
+
+class Subscriber(HTBFilter):
+    """
+    HTB class of one subscriber, with its own leaf qdisc
+
+    Under a :class:`pyqos.algorithms.u32.HTBHashFilter`, the packets are
+    classified by :attr:`address`. With a mark, a fw filter is added as for
+    any :class:`pyqos.algorithms.htb.HTBFilter`.
+    """
+    __slots__ = ("_address", "_subscriber")
+
+    qdisc = FQCodel
+    #: IPv4 address of the subscriber
+    address = NodeAttribute()
+    #: id of the subscriber in the subscriber table
+    subscriber = NodeAttribute()
+
+    def __init__(self, address=None, subscriber=None, *args, **kwargs):
+        if address is not None:
+            self.address = address
+        if subscriber is not None:
+            self.subscriber = subscriber
+        super().__init__(*args, **kwargs)
+
+
+def read_csv(csv_file):
+    """
+    Read a subscriber table from a CSV file, with a header naming at least
+    the columns of :data:`FIELDS`
+
+    :param csv_file: path or file object
+    :return: generator of dicts
+    """
+    if isinstance(csv_file, str):
+        with open(csv_file, newline="") as f:
+            yield from read_csv(f)
+        return
+    reader = csv.DictReader(csv_file)
+    missing = set(FIELDS).difference(reader.fieldnames or ())
+    if missing:
+        raise BadAttributeValueException(
+            "Missing columns in the subscriber table: " +
+            ", ".join(sorted(missing))
+        )
+    for row in reader:
+        yield row
+
+
+def add_subscribers(parent, rows, plans, first_id=0x100, first_mark=None,
+                    subscriber_class=Subscriber, allocator=None):
+    """
+    Add one class per subscriber under a parent
+
+    The classids are allocated from first_id, one per subscriber, in the
+    order of the rows. As a qdisc handle takes the same number, the range
+    must not cross the handles of the other qdiscs of the interface, unless
+    an allocator hands out the ids.
+
+    :param parent: parent class, like a
+        :class:`pyqos.algorithms.u32.HTBHashFilter` to classify the
+        subscribers by address
+    :param rows: iterable of (id, address, plan) or of dicts with these keys,
+        like :func:`read_csv` returns
+    :param plans: attributes of the classes of each plan, by name, like
+        ``{"basic": {"rate": 10000, "ceil": 20000, "prio": 3}}``
+    :param first_id: first class number, at most 0xffff
+    :param first_mark: if set, allocate a fw mark per subscriber from it
+    :param subscriber_class: class of the nodes, a :class:`Subscriber`
+    :param allocator: :class:`pyqos.allocator.Allocator` of the interface,
+        giving free ids instead of first_id, and free marks if first_mark is
+        set
+    :return: list of the :class:`Subscriber` added
+    """
+    subscribers = []
+    for number, row in enumerate(rows, first_id):
+        if isinstance(row, dict):
+            row = tuple(row[field] for field in FIELDS)
+        subscriber_id, address, plan_name = row
+        if number > 0xFFFF and allocator is None:
+            raise BadAttributeValueException(
+                "No class number left for the subscriber " +
+                str(subscriber_id)
+            )
+        try:
+            attributes = plans[plan_name]
+        except KeyError:
+            raise BadAttributeValueException(
+                "Unknown plan {} for the subscriber {}".format(
+                    plan_name, subscriber_id
+                )
+            )
+        class_id = mark = None
+        if allocator is None:
+            class_id = "{:x}".format(number)
+            if first_mark is not None:
+                mark = first_mark + number - first_id
+        subscribers.append(subscriber_class(
+            address=address or None, subscriber=subscriber_id,
+            id=class_id, mark=mark, **attributes
+        ))
+    if allocator is None:
+        parent.add_child(*subscribers)
+    else:
+        allocator.add(parent, *subscribers, marks=first_mark is not None)
+    return subscribers
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+
+import ipaddress
+import logging
+
+from pyqos import plan, stats
+from pyqos.exceptions import BadAttributeValueException
+from . import NodeAttribute
+from .htb import HTBClass
+
+_logger = logging.getLogger(__name__)
+
+#: offset of the addresses in the IPv4 header
+ADDRESS_OFFSETS = {"src": 12, "dst": 16}
+
+#: number of buckets of each hash table
+DIVISOR = 256
+
+
+def _table(htid, bucket=None):
+    if bucket is None:
+        return "{:x}:".format(htid)
+    return "{:x}:{:x}:".format(htid, bucket)
+
+
+def _key(network, offset):
+    """
+    u32 key matching a network, as (value, mask, offset)
+    """
+    return (int(network.network_address), int(network.netmask), offset)
+
+
+def hash_operations(interface, parent, prio, network, hosts, direction="src",
+                    first_htid=0x10, origin=None):
+    """
+    Generate the u32 hash tables classifying the packets of a network by
+    address
+
+    Each host gets one rule, in a table of 256 buckets keyed on the last octet
+    of the addresses. For a network larger than a /24, another table keyed on
+    the third octet links to one of these tables per /24, so finding the rule
+    of a packet always costs two lookups, whatever the number of hosts.
+
+    :param parent: handle of the qdisc the filters are attached to
+    :param prio: priority of the filters
+    :param network: IPv4 network of the hosts, at least a /16
+    :param hosts: iterable of (address, classid)
+    :param direction: classify on the "src" or "dst" address
+    :param first_htid: id of the first hash table. The next ones follow it.
+    :return: generator of :class:`pyqos.plan.Operation`
+    """
+    try:
+        network = ipaddress.ip_network(network)
+    except ValueError:
+        raise BadAttributeValueException(
+            "Bad network for u32 hash filters: {!r}".format(network)
+        )
+    if network.version != 4 or network.prefixlen < 16:
+        raise BadAttributeValueException(
+            "u32 hash filters need an IPv4 network of at least a /16, "
+            "got {}".format(network)
+        )
+    offset = ADDRESS_OFFSETS[direction]
+
+    def filter_op(**args):
+        return plan.make_operation(
+            "filter", "add", interface, origin, parent=parent, prio=prio,
+            protocol="ip", kind="u32", **args
+        )
+
+    # hosts by /24, then by last octet
+    subnets = {}
+    for address, classid in hosts:
+        address = ipaddress.ip_address(address)
+        if address not in network:
+            _logger.warning("%s is not in %s, it will not be classified",
+                            address, network)
+            continue
+        third, last = address.packed[2], address.packed[3]
+        subnets.setdefault(third, {})[last] = (address, classid)
+
+    two_levels = network.prefixlen < 24
+    next_htid = first_htid + 1 if two_levels else first_htid
+    subnet_tables = {}
+    for third in sorted(subnets):
+        subnet_tables[third] = next_htid
+        next_htid += 1
+        if next_htid > 0xFFF:
+            raise BadAttributeValueException(
+                "Too many u32 hash tables from {:x}".format(first_htid)
+            )
+
+    # tables have to exist before being filled and linked
+    if two_levels:
+        yield filter_op(handle=_table(first_htid), divisor=DIVISOR)
+    for htid in subnet_tables.values():
+        yield filter_op(handle=_table(htid), divisor=DIVISOR)
+    for third, htid in subnet_tables.items():
+        for last, (address, classid) in sorted(subnets[third].items()):
+            yield filter_op(
+                ht=_table(htid, last), flowid=classid,
+                match=[_key(ipaddress.ip_network(address), offset)]
+            )
+    if two_levels:
+        for third, htid in subnet_tables.items():
+            subnet = ipaddress.ip_network(
+                "{}/24".format(network.network_address + (third << 8))
+            )
+            yield filter_op(
+                ht=_table(first_htid, third), link=_table(htid),
+                match=[_key(subnet, offset)], hashkey=(0x000000FF, offset)
+            )
+        yield filter_op(link=_table(first_htid), match=[_key(network, offset)],
+                        hashkey=(0x0000FF00, offset))
+    elif subnet_tables:
+        htid, = subnet_tables.values()
+        yield filter_op(link=_table(htid), match=[_key(network, offset)],
+                        hashkey=(0x000000FF, offset))
+
+
+class HTBHost(HTBClass):
+    """
+    HTB class for the packets of one address, classified by a parent
+    :class:`HTBHashFilter`
+    """
+    __slots__ = ("_address", )
+
+    #: IPv4 address of the host
+    address = NodeAttribute()
+
+    def __init__(self, address=None, *args, **kwargs):
+        if address is not None:
+            self.address = address
+        super().__init__(*args, **kwargs)
+
+
+class HTBHashFilter(HTBClass):
+    """
+    HTB class classifying the packets of a network to its children by
+    address, with u32 hash tables
+
+    Every :class:`HTBHost` under this class gets its own rule. The lookup
+    of a packet does not depend on the number of hosts, unlike a list of
+    filters. The filters use the prio of the class, which cannot be shared
+    with filters of another kind.
+    """
+    __slots__ = ("_network", "_direction", "_first_htid")
+
+    #: IPv4 network of the hosts, at least a /16
+    network = NodeAttribute()
+    #: classify on the "src" (upload) or "dst" (download) address
+    direction = NodeAttribute("src")
+    #: id of the first u32 hash table. Several hash filters on the same
+    #: interface need different ranges of tables.
+    first_htid = NodeAttribute(0x10)
+
+    def __init__(self, network=None, direction=None, first_htid=None, *args,
+                 **kwargs):
+        if network is not None:
+            self.network = network
+        if direction is not None:
+            self.direction = direction
+        if first_htid is not None:
+            self.first_htid = first_htid
+        super().__init__(*args, **kwargs)
+
+    def hosts(self):
+        """
+        Hosts classified by this filter
+
+        :return: generator of (address, classid)
+        """
+        for node in stats.walk(self):
+            address = getattr(node, "address", None)
+            if address is not None:
+                yield address, node.classid
+
+    def compile(self, auto_quantum=True):
+        yield from super().compile(auto_quantum=auto_quantum)
+        yield from hash_operations(
+            self.interface, str(self.branch_id) + ":", self.prio or 1,
+            self.network, self.hosts(), self.direction, self.first_htid,
+            origin=self
+        )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Allocate the class ids, qdisc handles and marks of the trees of an interface
+
+import logging
+
+from pyqos.algorithms.htb import EmptyHTBClass, HTBFilter, RootHTBClass
+from pyqos.algorithms.mq import MQRoot
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException, ConflictException
+from pyqos.stats import walk
+
+_logger = logging.getLogger(__name__)
+
+
+class NumberPool():
+    """
+    Range of numbers handed out and recycled in constant time
+
+    A number can be taken several times, by trees sharing it, and is free
+    again once released as many times.
+    """
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        #: number of users of each taken number
+        self._taken = {}
+        #: released numbers, reused before the never used ones
+        self._free = []
+        #: all the numbers from this one have never been handed out
+        self._next = first
+
+    def __contains__(self, number):
+        return number in self._taken
+
+    def __len__(self):
+        return len(self._taken)
+
+    def take(self, number):
+        """
+        Take a number, even if it is already taken
+        """
+        self._taken[number] = self._taken.get(number, 0) + 1
+
+    def allocate(self):
+        """
+        :return: a free number, now taken
+        """
+        while self._free:
+            number = self._free.pop()
+            # a released number can have been taken again since
+            if number not in self._taken:
+                break
+        else:
+            while self._next in self._taken:
+                self._next += 1
+            if self._next > self.last:
+                raise BadAttributeValueException(
+                    "No number left between {:#x} and {:#x}".format(
+                        self.first, self.last
+                    )
+                )
+            number = self._next
+            self._next += 1
+        self._taken[number] = 1
+        return number
+
+    def release(self, number):
+        count = self._taken.get(number, 0) - 1
+        if count > 0:
+            self._taken[number] = count
+            return
+        self._taken.pop(number, None)
+        if self.first <= number < self._next:
+            self._free.append(number)
+
+
+class Allocator():
+    """
+    Allocate the ids and marks of the classes of the trees of an interface,
+    and detect their conflicts when the classes are added instead of through
+    a failing tc command
+
+    The ids are numbers formatted in hexadecimal, as tc reads them: the id
+    0x100 is the class ``1:100``. As the leaf qdisc of a class takes its id
+    as handle, an id is allocated once for all the branches of the
+    interface. The ids and marks of removed classes are reused.
+    """
+    def __init__(self, *roots, first_id=2, first_mark=1):
+        #: class minors and qdisc majors, shared by all the branches
+        self.ids = NumberPool(first_id, 0xFFFF)
+        #: fw marks
+        self.marks = NumberPool(first_mark, 0xFFFFFFFF)
+        self._classids = {}
+        self._handles = {}
+        self._marks = {}
+        for root in roots:
+            self.register(root)
+
+    def _claim(self, owners, key, node):
+        owner = owners.setdefault(key, node)
+        if owner is not node:
+            raise ConflictException(
+                "{!r} conflicts with {!r}".format(node, owner)
+            )
+
+    def _ids(self, node):
+        """
+        Numbers used by a node
+
+        :return: generator of (table, key, pool, number)
+        """
+        if isinstance(node, MQRoot):
+            handle = syntax.parse_qdisc_handle(node.branch_id) >> 16
+            yield self._handles, handle, self.ids, handle
+        if isinstance(node, RootHTBClass):
+            for branch_id in (node.branch_id, node.spare_branch_id):
+                handle = syntax.parse_qdisc_handle(branch_id) >> 16
+                yield self._handles, handle, self.ids, handle
+        if not isinstance(node, EmptyHTBClass):
+            return
+        classid = syntax.parse_classid(node.classid)
+        yield self._classids, classid, self.ids, classid & 0xFFFF
+        qdisc = getattr(node, "qdisc", None)
+        if qdisc is not None:
+            handle = syntax.parse_qdisc_handle(qdisc.id) >> 16
+            yield self._handles, handle, self.ids, handle
+        if isinstance(node, HTBFilter) and node.mark is not None:
+            if not node.root.mark_classid:
+                # the trees of the queues of a mq qdisc classify the same
+                # packets: they can share their marks
+                yield (self._marks, (node.root, node.mark), self.marks,
+                       node.mark)
+
+    def register(self, node):
+        """
+        Take the ids and marks of a node and of its children
+
+        :raise ConflictException: if one of them is taken by another node
+        """
+        registered = []
+        try:
+            for child in walk(node):
+                for owners, key, pool, number in self._ids(child):
+                    self._claim(owners, key, child)
+                    pool.take(number)
+                    registered.append((owners, key, pool, number))
+        except BadAttributeValueException:
+            for owners, key, pool, number in registered:
+                owners.pop(key, None)
+                pool.release(number)
+            raise
+
+    def unregister(self, node):
+        """
+        Release the ids and marks of a node and of its children
+        """
+        for child in walk(node):
+            for owners, key, pool, number in self._ids(child):
+                if owners.get(key) is child:
+                    del owners[key]
+                    pool.release(number)
+
+    def add(self, parent, *nodes, marks=False):
+        """
+        Give the nodes without id a free one, and a free mark to the
+        :class:`pyqos.algorithms.htb.HTBFilter` without mark if marks is set,
+        then add them to a parent
+
+        :raise ConflictException: if an id or mark set on a node is taken.
+            The nodes added before it are kept, the failing one gets back the
+            id and mark it had.
+        """
+        for node in nodes:
+            allocated = []
+            assigned = []
+            try:
+                if node.id is None:
+                    allocated.append((self.ids, self.ids.allocate()))
+                    node.id = "{:x}".format(allocated[-1][1])
+                    assigned.append("id")
+                if (marks and isinstance(node, HTBFilter) and
+                        node.mark is None):
+                    allocated.append((self.marks, self.marks.allocate()))
+                    node.mark = allocated[-1][1]
+                    assigned.append("mark")
+                parent.add_child(node)
+                try:
+                    self.register(node)
+                except BadAttributeValueException:
+                    parent.children.remove(node)
+                    raise
+            except BadAttributeValueException:
+                for attr in assigned:
+                    setattr(node, attr, None)
+                raise
+            finally:
+                # the registration took the allocated numbers again
+                for pool, number in allocated:
+                    pool.release(number)
+        return nodes
+
+    def remove(self, node):
+        """
+        Detach a node from its parent, and release its ids and marks
+        """
+        self.unregister(node)
+        node.parent.children.remove(node)
+        _logger.debug("%r removed", node)
@@ -2,18 +2,32 @@
 # Author: Anthony Ruhier
 
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import importlib
+import itertools
+import json
 import logging
 import os
 import subprocess
 import sys
 
-from pyqos.backend import tc
+from pyqos import (autorate, backend, diff, nftables, plan, profiles,
+                   server, stats)
+from pyqos.backend import records, syntax
 from pyqos.config import Config, ConfigAttribute
+from pyqos.exceptions import BadAttributeValueException, NoParentException
 
 global_logger = logging.getLogger("pyqos")
 _logger = logging.getLogger(__name__)
 
 
+def _format_classid(classid):
+    return syntax.format_handle(syntax.parse_classid(classid))
+
+
 class PyQoS():
     """
     Application to simplify the initialization of the QoS rules. Inspired from
@@ -28,12 +42,42 @@ class PyQoS():
     debug = ConfigAttribute("DEBUG")
     #: dryrun
     dryrun = ConfigAttribute("DRYRUN")
+    #: queue the tc commands and launch them through one process per interface
+    batch = ConfigAttribute("BATCH")
+    #: backend used to apply the rules: "tc" or "netlink"
+    backend_name = ConfigAttribute("BACKEND")
+    #: only apply the differences between the trees and the current rules
+    incremental = ConfigAttribute("INCREMENTAL")
+    #: build the new trees under spare root handles and swap them at once
+    swap = ConfigAttribute("SWAP")
+    #: number of interfaces applied concurrently
+    workers = ConfigAttribute("WORKERS")
+    #: load the nftables ruleset marking the packets with the rules
+    nftables_marks = ConfigAttribute("NFTABLES")
+    #: time between two samples of the stats subcommand, in seconds
+    stats_interval = ConfigAttribute("STATS_INTERVAL")
+    #: controllers adapting the rate of classes to the latency of the links
+    autorate = ConfigAttribute("AUTORATE")
+    #: values of rate, ceil and prio of the classes, by profile name
+    profiles = ConfigAttribute("PROFILES")
+    #: times at which the profiles are switched
+    schedule = ConfigAttribute("SCHEDULE")
     #: name of the main logger
     logger_name = ConfigAttribute('LOGGER_NAME')
     #: configuration default values
     default_config = {
         "DEBUG": False,
         "DRYRUN": False,
+        "BATCH": False,
+        "BACKEND": "tc",
+        "INCREMENTAL": True,
+        "SWAP": False,
+        "WORKERS": 1,
+        "NFTABLES": False,
+        "STATS_INTERVAL": 1,
+        "AUTORATE": [],
+        "PROFILES": {},
+        "SCHEDULE": [],
         "LOGGER_NAME": None,
         "INTERFACES": dict(),
     }
@@ -46,6 +90,12 @@ class PyQoS():
         self.config = Config(root_path, self.default_config)
         self._logger = None
         self.logger_name = self.app_name
+        self._rules_loader = None
+        self._rules_modules = ()
+        #: arguments of the classes applied, by (interface, classid)
+        self._applied_classes = {}
+        #: :class:`pyqos.profiles.ProfileScheduler` of the PROFILES config
+        self.scheduler = None
 
     @property
     def logger(self):
@@ -77,6 +127,337 @@ class PyQoS():
                 if_names.update(self.get_ifnames(interfaces_lst=interface))
         return if_names
 
+    def rules_loader(self, loader=None, modules=()):
+        """
+        Register the function building the trees, and call it
+
+        The daemon calls it again to reload the rules. It can be used as a
+        decorator::
+
+            @app.rules_loader
+            def load(app):
+                app.run_list.append(build_root_class())
+
+        :param loader: function taking the application, and filling its
+            run_list
+        :param modules: modules defining the rules, reimported before each
+            reload, in this order, and watched by the daemon
+        """
+        if loader is None:
+            return functools.partial(self.rules_loader, modules=modules)
+        self._rules_loader = loader
+        self._rules_modules = tuple(modules)
+        self.reload_rules(reimport=False)
+        return loader
+
+    def reload_rules(self, reimport=True):
+        """
+        Fill a new run_list with the rules loader
+
+        If the loader fails, the previous run_list is kept.
+
+        :param reimport: reimport the modules of the rules before
+        """
+        if self._rules_loader is None:
+            raise BadAttributeValueException("No rules loader registered")
+        if reimport:
+            self._rules_modules = tuple(
+                importlib.reload(module) for module in self._rules_modules
+            )
+        old_run_list = self.run_list
+        self.run_list = []
+        try:
+            self._rules_loader(self)
+        except Exception:
+            self.run_list = old_run_list
+            raise
+
+    def watched_files(self):
+        """
+        Files of the config and of the modules of the rules
+
+        :return: set of paths
+        """
+        files = set(self.config.files())
+        files.update(module.__file__ for module in self._rules_modules
+                     if getattr(module, "__file__", None))
+        return files
+
+    def reload(self):
+        """
+        Load the config and the rules again, and only apply the trees of the
+        interfaces whose rules changed
+
+        If only the arguments of some applied classes changed on an
+        interface, like their rates, they are applied with class changes
+        instead of the diff of the interface, which sends its filters again.
+        If the config or the rules cannot be loaded, the previous ones are
+        kept.
+
+        :return: set of the changed interfaces
+        """
+        old_roots = self.run_list
+        old_operations = plan.record(old_roots)
+        old_config = dict(self.config)
+        old_scheduler = self.scheduler
+        try:
+            self.config.reload()
+            self.reload_rules()
+            # the profiles may have been added, changed or removed. The new
+            # trees get the profile set on the current ones if it still
+            # exists, which is then switched by the scheduler if needed
+            profile = getattr(old_scheduler, "profile", None)
+            self.load_scheduler()
+            if self.scheduler is not None:
+                self.scheduler.select(
+                    profile if profile in self.scheduler.profiles else None
+                )
+        except Exception:
+            _logger.error("Cannot reload the rules, the previous ones are "
+                          "kept")
+            self.config.clear()
+            self.config.update(old_config)
+            self.config.refresh_global_logger_lvl()
+            self.run_list = old_roots
+            self.scheduler = old_scheduler
+            raise
+        # keep the branch ids selected for the current trees, so they are
+        # compared with the same classids
+        old_branches = {}
+        for root in old_roots:
+            old_branches.setdefault(root.interface, []).append(root)
+        for root in self.run_list:
+            old_interface_roots = old_branches.get(root.interface)
+            if not old_interface_roots or not hasattr(root, "swap_branch"):
+                continue
+            old_root = old_interface_roots.pop(0)
+            if (getattr(old_root, "branch_id", None) ==
+                    root.spare_branch_id and
+                    old_root.spare_branch_id == root.branch_id):
+                root.swap_branch()
+        new_operations = plan.record(self.run_list)
+        changed = diff.changed_interfaces(old_operations, new_operations)
+        applied = set(interface for interface, _ in self._applied_classes)
+        class_only = applied.intersection(
+            diff.class_only_interfaces(old_operations, new_operations)
+        )
+        if class_only:
+            self.change_classes(op for op in new_operations
+                                if op.interface in class_only)
+        if changed - class_only:
+            self.apply_qos(changed - class_only)
+        elif self.config.get("NFTABLES", False):
+            # the marking rules are not part of the operations
+            self.apply_marks()
+        return changed
+
+    def find_class(self, interface, classid):
+        """
+        Find a class of the run_list
+
+        :param classid: classid, as tc reads it
+        :return: the class, or None if no class matches
+        """
+        return self.classes().get((interface, _format_classid(classid)))
+
+    def classes(self):
+        """
+        Classes of the run_list
+
+        :return: dict {(interface, classid as tc prints it): class}
+        """
+        result = {}
+        for root in self.run_list:
+            for node in stats.walk(root):
+                try:
+                    key = (node.interface, _format_classid(node.classid))
+                except (AttributeError, BadAttributeValueException,
+                        NoParentException):
+                    continue
+                result.setdefault(key, node)
+        return result
+
+    def autorate_controllers(self):
+        """
+        Build the controllers of the classes listed in the AUTORATE config
+
+        Each item is a dict with the ``interface`` of the class, its
+        ``classid`` (the top class of the first root of the interface if
+        missing), the ``target`` host to ping, or a ``probe`` function, and
+        the other parameters of :class:`pyqos.autorate.Autorate`, like
+        ``min_rate`` and ``max_rate``.
+
+        :return: list of :class:`pyqos.autorate.Autorate`
+        """
+        controllers = []
+        for options in self.config.get("AUTORATE", ()):
+            options = dict(options)
+            interface = options.pop("interface")
+            classid = options.pop("classid", None)
+            if classid is None:
+                node = next(iter(self.roots([interface])), None)
+            else:
+                node = self.find_class(interface, classid)
+            if node is None:
+                raise BadAttributeValueException(
+                    "No class {} on {}".format(classid or "", interface)
+                )
+            target = options.pop("target", None)
+            if "probe" not in options:
+                if target is None:
+                    raise BadAttributeValueException(
+                        "No target to probe for {}".format(interface)
+                    )
+                options["probe"] = autorate.PingProbe(target)
+            controllers.append(autorate.Autorate(self, node, **options))
+        return controllers
+
+    def load_scheduler(self):
+        """
+        Build the scheduler switching the profiles of the PROFILES config, at
+        the times of the SCHEDULE config
+
+        The profiles cannot override the rate of the classes adjusted by the
+        controllers of the AUTORATE config, nor their ceil if the controllers
+        set it: a switch would undo the rates set by the controllers.
+
+        :raise BadAttributeValueException: if a profile overrides an
+            attribute set by a controller
+        :return: the :class:`pyqos.profiles.ProfileScheduler`, or None if
+            there is no profile
+        """
+        if not self.config.get("PROFILES"):
+            self.scheduler = None
+            return None
+        scheduler = profiles.ProfileScheduler(
+            self, self.config["PROFILES"], self.config.get("SCHEDULE")
+        )
+        controlled = {}
+        for controller in self.autorate_controllers():
+            controlled[controller.node] = (
+                {"rate", "ceil"} if controller.set_ceil else {"rate"}
+            )
+        for name, overrides in scheduler.profiles.items():
+            for node, values in overrides.items():
+                attributes = controlled.get(node, set()) & set(values)
+                if attributes:
+                    raise BadAttributeValueException(
+                        "Profile {}: the {} of {!r} is set by an autorate "
+                        "controller".format(
+                            name, " and ".join(sorted(attributes)), node
+                        )
+                    )
+        self.scheduler = scheduler
+        return scheduler
+
+    def _track_classes(self, operations):
+        """
+        Remember the arguments of the classes of some operations as applied,
+        while they are consumed
+        """
+        for op in operations:
+            if op.kind == "class" and op.action != "delete":
+                key = (op.interface, _format_classid(op.args["classid"]))
+                self._applied_classes[key] = op.args
+            yield op
+
+    def _forget_classes(self, interfaces=None):
+        """
+        Forget the applied classes of some interfaces, the removed ones
+        included
+
+        :param interfaces: only forget the classes of these interfaces
+        """
+        self._applied_classes = {
+            key: args for key, args in self._applied_classes.items()
+            if interfaces is not None and key[0] not in interfaces
+        }
+
+    def track_applied(self, interfaces=None):
+        """
+        Remember the classes of the run_list already set as wanted on the
+        interfaces as applied, for :meth:`commit`, when the trees have been
+        applied by another process
+
+        :param interfaces: only read these interfaces
+        :return: number of classes set as wanted
+        """
+        dumps = self.dump_interfaces(interfaces)
+        self.select_branches(dumps)
+        operations = diff.synced_classes(
+            plan.record(self.roots(interfaces)), dumps
+        )
+        for _ in self._track_classes(operations):
+            pass
+        return len(operations)
+
+    def update_rates(self, rates):
+        """
+        Change the rate and ceil of some applied classes, then apply the
+        changes with :meth:`commit`
+
+        :param rates: dict {(interface, classid): (rate, ceil)}. A rate or
+            ceil set to None is not changed.
+        :raise BadAttributeValueException: if a class does not exist or has
+            not been applied
+        :return: list of the "change" :class:`pyqos.plan.Operation` applied
+        """
+        classes = self.classes()
+        nodes = []
+        for (interface, classid), speeds in rates.items():
+            key = (interface, _format_classid(classid))
+            node = classes.get(key)
+            if node is None:
+                raise BadAttributeValueException(
+                    "No class {} on {}".format(classid, interface)
+                )
+            if key not in self._applied_classes:
+                raise BadAttributeValueException(
+                    "The class {} on {} has not been applied: apply the "
+                    "trees first".format(classid, interface)
+                )
+            nodes.append((node, speeds))
+        for node, (rate, ceil) in nodes:
+            if rate is not None:
+                node.rate = rate
+            if ceil is not None:
+                node.ceil = ceil
+        return self.commit()
+
+    def commit(self, interfaces=None):
+        """
+        Apply the changes of the applied classes, like a new rate set on a
+        class, with one "change" operation per modified class, in one batch
+
+        The relative rates and the bursts depending on the modified classes
+        are computed again. The kernel state is not read, and the qdiscs,
+        filters, added and removed classes are ignored: they need
+        :meth:`apply_qos`.
+
+        :param interfaces: only commit the classes of these interfaces
+        :return: list of the "change" :class:`pyqos.plan.Operation` applied
+        """
+        return self.change_classes(
+            plan.compile_classes(self.roots(interfaces))
+        )
+
+    def change_classes(self, operations):
+        """
+        Apply the classes of some operations which differ from the applied
+        ones, with one "change" operation per class, in one batch
+
+        :param operations: operations adding the classes, like
+            :func:`pyqos.plan.compile_classes` generates
+        :return: list of the "change" :class:`pyqos.plan.Operation` applied
+        """
+        operations = diff.class_changes(self._applied_classes, operations)
+        dryrun = self.config.get("DRYRUN", False)
+        backend_module = self.get_backend()
+        with backend_module.batch(dryrun=dryrun):
+            plan.execute(self._track_classes(operations), backend_module,
+                         dryrun=dryrun)
+        return operations
+
     def run_as_root(self):
         """
         Restart the script as root
@@ -87,30 +468,362 @@ class PyQoS():
             subprocess.call(["sudo", sys.executable] + sys.argv)
             exit()
 
-    def apply_qos(self):
+    def get_backend(self):
+        """
+        Select the backend set in the config and return its module
+        """
+        backend.set_backend(self.config.get("BACKEND", "tc"))
+        return backend.get_backend()
+
+    def command_batch(self):
+        """
+        Context in which the commands are queued then launched at once by the
+        backend (one tc process per interface, or pipelined netlink
+        messages), if batching is enabled in the config
+        """
+        if self.config.get("BATCH", False):
+            return self.get_backend().batch(
+                dryrun=self.config.get("DRYRUN", False)
+            )
+        return contextlib.ExitStack()
+
+    def roots(self, interfaces=None):
+        """
+        Roots of the run_list on some interfaces
+
+        :param interfaces: set of interface names, or None for all the roots
+        """
+        return [r for r in self.run_list
+                if interfaces is None or r.interface in interfaces]
+
+    def dump_interfaces(self, interfaces=None):
+        """
+        Read the current rules of the configured interfaces and of the ones
+        used in the run_list
+
+        :param interfaces: only read these interfaces
+        :return: dict {interface: :class:`pyqos.backend.records.Dump`}
+        """
+        backend_module = self.get_backend()
+        if interfaces is None:
+            interfaces = self.get_ifnames()
+            interfaces.update(r.interface for r in self.run_list)
+        interfaces = sorted(interfaces)
+        workers = max(self.config.get("WORKERS", 1), 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(interfaces,
+                            pool.map(backend_module.dump, interfaces)))
+
+    def select_branches(self, dumps, swap=False):
+        """
+        Make the HTB roots of the run_list use the branch id currently set on
+        their interface, or the spare one if their tree has to be swapped
+
+        :param dumps: current state of the interfaces, as returned by
+            :meth:`dump_interfaces`
+        :param swap: select the branch id which is not in use
+        """
+        for root in self.run_list:
+            if not hasattr(root, "swap_branch") or root.interface not in dumps:
+                continue
+            live_root = dumps[root.interface].root
+            if live_root is None:
+                continue
+            live_handle = syntax.parse_qdisc_handle(live_root.handle)
+            in_use = syntax.parse_qdisc_handle(str(root.branch_id) + ":")
+            spare = syntax.parse_qdisc_handle(str(root.spare_branch_id) + ":")
+            if (live_handle == in_use and swap or
+                    live_handle == spare and not swap):
+                root.swap_branch()
+
+    def plan_operations(self, interfaces=None, track=False):
+        """
+        Compute the operations converging the configured interfaces to the
+        trees of the run_list, from their current rules
+
+        :param interfaces: only converge these interfaces
+        :param track: remember the classes as applied instead of the previous
+            ones of the interfaces, for :meth:`commit`, once the plan is built
+        :return: list of :class:`pyqos.plan.Operation`
+        """
+        dumps = self.dump_interfaces(interfaces)
+        self.select_branches(dumps)
+        operations = plan.record(self.roots(interfaces))
+        result = diff.diff(operations, dumps)
+        if track:
+            self._forget_classes(interfaces)
+            for _ in self._track_classes(operations):
+                pass
+        return result
+
+    def swap_operations(self, interfaces=None, track=False):
+        """
+        Compute the operations building the trees of the run_list under their
+        spare branch id, and replacing the current roots by them
+
+        :param interfaces: only swap the trees of these interfaces
+        :param track: remember the classes as applied instead of the previous
+            ones of the interfaces, for :meth:`commit`, once the plan is built
+        :return: list of :class:`pyqos.plan.Operation`
+        """
+        dumps = self.dump_interfaces(interfaces)
+        self.select_branches(dumps, swap=True)
+        operations = plan.record(self.roots(interfaces))
+        result = diff.swap(operations, dumps)
+        if track:
+            self._forget_classes(interfaces)
+            for _ in self._track_classes(operations):
+                pass
+        return result
+
+    def rebuild_plans(self, interfaces=None):
+        """
+        Plans resetting each interface, then building its trees from scratch
+
+        :param interfaces: only rebuild these interfaces
+        :return: OrderedDict {interface: generator of
+            :class:`pyqos.plan.Operation`}
+        """
+        if interfaces is None:
+            interfaces = self.get_ifnames()
+        roots = OrderedDict((i, []) for i in sorted(interfaces))
+        for r in self.roots(interfaces):
+            roots.setdefault(r.interface, []).append(r)
+        return OrderedDict(
+            (interface, itertools.chain(
+                [plan.make_operation("qdisc", "delete", interface,
+                                     stderr=subprocess.DEVNULL)],
+                self._track_classes(plan.compile(interface_roots))
+            ))
+            for interface, interface_roots in roots.items()
+        )
+
+    def execute_parallel(self, plans):
+        """
+        Apply the plans of the interfaces concurrently, and log the
+        interfaces which failed
+
+        :param plans: dict {interface: iterable of
+            :class:`pyqos.plan.Operation`}
+        :return: list of :class:`pyqos.plan.InterfaceResult`
+        """
+        results = plan.execute_parallel(
+            plans, workers=self.config.get("WORKERS", 1),
+            backend_module=self.get_backend(),
+            dryrun=self.config.get("DRYRUN", False)
+        )
+        failed = [r.interface for r in results
+                  if r.failed or r.error is not None]
+        if failed:
+            _logger.error("Errors while applying the rules of: %s",
+                          ", ".join(failed))
+        return results
+
+    def apply_qos(self, interfaces=None):
+        """
+        Apply the trees of the run_list
+
+        :param interfaces: only apply the trees of these interfaces, and
+            leave the other interfaces untouched
+        """
         self.run_as_root()
-        # Clean old rules
-        self.reset_qos()
-        # Setting new rules
-        print("Setting new rules")
-        for r in self.run_list:
-            r.apply(dryrun=self.config.get("DRYRUN", False))
+        dryrun = self.config.get("DRYRUN", False)
+        parallel = self.config.get("WORKERS", 1) > 1
+        # the applied classes are only replaced once the plan is built, so
+        # they are kept if it fails
+        if self.config.get("SWAP", False):
+            print("Swapping the rules")
+            operations = self.swap_operations(interfaces, track=True)
+            if parallel:
+                self.execute_parallel(plan.split_by_interface(operations))
+            else:
+                # always batch, to send the new tree right after the new root
+                with self.get_backend().batch(dryrun=dryrun):
+                    plan.execute(operations, dryrun=dryrun)
+        elif self.config.get("INCREMENTAL", True):
+            print("Applying the differences with the current rules")
+            operations = self.plan_operations(interfaces, track=True)
+            if parallel:
+                self.execute_parallel(plan.split_by_interface(operations))
+            else:
+                with self.command_batch():
+                    plan.execute(operations, dryrun=dryrun)
+        elif parallel:
+            print("Removing tc rules and setting new rules")
+            # the interfaces are reset before their trees are compiled
+            self._forget_classes(interfaces)
+            self.execute_parallel(self.rebuild_plans(interfaces))
+        else:
+            self._forget_classes(interfaces)
+            with self.command_batch():
+                # Clean old rules
+                self.reset_qos(marks=False, interfaces=interfaces)
+                # Setting new rules
+                print("Setting new rules")
+                plan.execute(self._track_classes(
+                    plan.compile(self.roots(interfaces))
+                ), dryrun=dryrun)
+        if self.config.get("NFTABLES", False):
+            self.apply_marks()
+
+    def apply_marks(self):
+        """
+        Load the nftables ruleset marking the packets of the classes
+        """
+        print("Loading the nftables marking rules")
+        nftables.load(nftables.ruleset(self.run_list),
+                      dryrun=self.config.get("DRYRUN", False))
+
+    def show_marks(self):
+        """
+        Print the nftables ruleset marking the packets of the classes
+        """
+        print(nftables.ruleset(self.run_list), end="")
 
-    def reset_qos(self):
+    def format_plan(self, json=False):
+        """
+        Format the operations that would be done to apply the rules
+
+        :param json: format the operations as JSON lines instead of tc
+            commands
+        :return: generator of lines
+        """
+        if self.config.get("SWAP", False):
+            operations = self.swap_operations()
+        else:
+            operations = self.plan_operations()
+        if json:
+            return plan.serialize(operations)
+        return (plan.format_operation(op) for op in operations)
+
+    def show_plan(self, json=False):
+        """
+        Print the operations that would be done to apply the rules
+
+        :param json: print the operations as JSON lines instead of tc commands
+        """
+        for line in self.format_plan(json=json):
+            print(line)
+
+    def reset_qos(self, marks=True, interfaces=None):
         """
         Reset QoS for all configured interfaces
+
+        :param marks: remove the nftables marking rules too, if enabled
+        :param interfaces: only reset these interfaces
         """
         self.run_as_root()
         print("Removing tc rules")
-        ifnames = self.get_ifnames()
-        tc.qdisc_del(ifnames, stderr=subprocess.DEVNULL)
+        ifnames = self.get_ifnames() if interfaces is None else interfaces
+        self.get_backend().qdisc_del(ifnames, stderr=subprocess.DEVNULL)
+        if marks and self.config.get("NFTABLES", False):
+            nftables.delete(dryrun=self.config.get("DRYRUN", False))
+
+    def format_qos(self):
+        """
+        Format the qdiscs, classes and filters of the configured interfaces,
+        with their statistics
+
+        :return: generator of lines
+        """
+        backend_module = self.get_backend()
+        for dump in backend_module.dumps(sorted(self.get_ifnames()),
+                                         stats=True):
+            title = "Interface {}".format(dump.interface)
+            yield "\n\t {}\n\t {}\n".format(title, "=" * len(title))
+            for record in (list(dump.qdiscs.values()) +
+                           list(dump.classes.values()) + dump.filters):
+                yield "\n".join(records.format_record(record))
 
     def show_qos(self):
-        ifnames = self.get_ifnames()
-        print("\n\t QDiscs details\n\t================\n")
-        tc.qdisc_show(ifnames, "details")
-        print("\n\t QDiscs stats\n\t==============\n")
-        tc.qdisc_show(ifnames, "details")
+        """
+        Print the qdiscs, classes and filters of the configured interfaces,
+        with their statistics
+        """
+        for line in self.format_qos():
+            print(line)
+
+    def poll_stats(self, count=None):
+        """
+        Print the rates of the classes of the run_list every STATS_INTERVAL
+
+        :param count: number of samples. If None, run until interrupted.
+        """
+        self.select_branches(self.dump_interfaces())
+        poller = stats.Poller(
+            self.run_list, self.config.get("STATS_INTERVAL", 1),
+            self.get_backend()
+        )
+
+        def print_rates(result):
+            rates = sorted(
+                (node.interface, node.classid, node_stats)
+                for node, node_stats in result.items()
+                if node_stats.rate_bps is not None
+            )
+            if not rates:
+                return
+            print("\n{:<8} {:<8} {:>14} {:>10} {:>10}".format(
+                "dev", "class", "rate (kbit/s)", "pkt/s", "drops/s"
+            ))
+            for interface, classid, node_stats in rates:
+                print("{:<8} {:<8} {:>14.1f} {:>10.1f} {:>10.1f}".format(
+                    interface, classid, node_stats.rate_bps / 1000,
+                    node_stats.rate_pps, node_stats.drop_rate
+                ))
+
+        try:
+            poller.run(print_rates, count)
+        except KeyboardInterrupt:
+            pass
+
+    def serve(self, socket_path=None, watch=False):
+        """
+        Run the daemon, applying the commands received on its control socket
+        to the trees kept in memory, until interrupted
+
+        :param socket_path: path of the control socket
+        :param watch: reload the rules when their files or the config change
+        """
+        self.run_as_root()
+        if self.config.get("AUTORATE") or self.config.get("PROFILES"):
+            # the controllers and the profiles change the classes applied by
+            # the daemon
+            self.apply_qos()
+        else:
+            # the trees may have been applied by the start subcommand
+            self.track_applied()
+        daemon = server.Server(self, socket_path or server.SOCKET_PATH,
+                               watch=watch)
+        print("Listening on " + daemon.path)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.server_close()
+
+    def control(self, command, arguments=(), socket_path=None):
+        """
+        Send a command to the daemon and print its result
+
+        :param arguments: list of "name=value" strings. The values are read
+            as JSON if possible.
+        """
+        args = {}
+        for argument in arguments:
+            name, _, value = argument.partition("=")
+            try:
+                args[name] = json.loads(value)
+            except ValueError:
+                args[name] = value
+        result = server.request(command, socket_path or server.SOCKET_PATH,
+                                **args)
+        if isinstance(result, list):
+            for line in result:
+                print(line if isinstance(line, str) else json.dumps(line))
+        elif result is not None:
+            print(json.dumps(result))
 
     def init_parser(self):
         """
@@ -125,17 +838,72 @@ class PyQoS():
         sp_start = sp_action.add_parser("start", help="set QoS rules")
         sp_stop = sp_action.add_parser("stop", help="remove all QoS rules")
         sp_show = sp_action.add_parser("show", help="show QoS rules")
+        sp_plan = sp_action.add_parser(
+            "plan", help="show the changes needed to apply the QoS rules"
+        )
+        sp_plan.add_argument('-j', '--json',
+                             help="print the operations as JSON lines",
+                             dest="json", action="store_true")
+        sp_nft = sp_action.add_parser(
+            "nftables", help="show the nftables marking rules"
+        )
+        sp_stats = sp_action.add_parser(
+            "stats", help="show the rates of the classes"
+        )
+        sp_stats.add_argument('-i', '--interval', type=float,
+                              help="time between two samples, in seconds",
+                              dest="interval")
+        sp_stats.add_argument('-c', '--count', type=int,
+                              help="number of samples", dest="count")
+        sp_serve = sp_action.add_parser(
+            "serve", help="run the daemon, controlled through a socket"
+        )
+        sp_ctl = sp_action.add_parser(
+            "ctl", help="send a command to the daemon"
+        )
+        sp_ctl.add_argument("command",
+                            help="apply, reload, set_rate, stats, show or "
+                            "plan")
+        sp_ctl.add_argument("arguments", nargs="*", metavar="NAME=VALUE",
+                            help="arguments of the command")
+        sp_serve.add_argument('-W', '--watch', dest="watch",
+                              action="store_true",
+                              help="reload the rules when their files "
+                              "change")
+        for sp in (sp_serve, sp_ctl):
+            sp.add_argument('-S', '--socket', dest="socket_path",
+                            help="path of the control socket")
 
         # Set function to call for each options
         sp_start.set_defaults(func=self.apply_qos)
         sp_stop.set_defaults(func=self.reset_qos)
         sp_show.set_defaults(func=self.show_qos)
+        sp_plan.set_defaults(func=self.show_plan)
+        sp_nft.set_defaults(func=self.show_marks)
+        sp_stats.set_defaults(func=self.poll_stats)
+        sp_serve.set_defaults(func=self.serve)
+        sp_ctl.set_defaults(func=self.control)
 
         # Debug option
         parser.add_argument('-d', '--debug', help="set the debug level",
                             dest="debug", action="store_true")
         parser.add_argument('-D', '--dryrun', help="dry run",
                             dest="dryrun", action="store_true")
+        parser.add_argument('-b', '--batch',
+                            help="launch the tc commands in batch",
+                            dest="batch", action="store_true")
+        parser.add_argument('--backend',
+                            help="backend used to apply the rules",
+                            dest="backend", choices=backend.BACKENDS)
+        parser.add_argument('-f', '--full',
+                            help="remove all rules before applying them",
+                            dest="full", action="store_true")
+        parser.add_argument('-w', '--workers', type=int,
+                            help="number of interfaces applied concurrently",
+                            dest="workers")
+        parser.add_argument('-s', '--swap',
+                            help="build the new rules aside and swap them at "
+                            "once", dest="swap", action="store_true")
 
         self.arg_parser = parser
 
@@ -151,12 +919,36 @@ class PyQoS():
         args = self.arg_parser.parse_args()
 
         self.dryrun = args.dryrun
+        if args.batch:
+            self.batch = True
+        if args.backend is not None:
+            self.backend_name = args.backend
+        if args.full:
+            self.incremental = False
+        if args.swap:
+            self.swap = True
+        if args.workers is not None:
+            self.workers = args.workers
         if args.debug or args.dryrun:
             self.debug = True
+        func_kwargs = {}
+        if getattr(args, "interval", None):
+            self.stats_interval = args.interval
+        if getattr(args, "count", None):
+            func_kwargs["count"] = args.count
+        if getattr(args, "json", False):
+            func_kwargs["json"] = True
+        if getattr(args, "watch", False):
+            func_kwargs["watch"] = True
+        if getattr(args, "socket_path", None):
+            func_kwargs["socket_path"] = args.socket_path
+        if getattr(args, "command", None):
+            func_kwargs["command"] = args.command
+            func_kwargs["arguments"] = args.arguments
 
         # Execute correct function, or print usage
         if hasattr(args, "func"):
-            args.func()
+            args.func(**func_kwargs)
         else:
             self.arg_parser.print_help()
             sys.exit(1)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Adapt the rate of a class to the capacity of a variable link
+
+import logging
+import re
+import socket
+import struct
+import subprocess
+import time
+
+from pyqos import backend
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException
+
+_logger = logging.getLogger(__name__)
+
+_PING_TIME = re.compile(r"time[=<]([\d.]+) ?ms")
+
+
+class PingProbe():
+    """
+    Measure the round trip time to a host with one ICMP echo, through the
+    ping command
+    """
+    def __init__(self, target, timeout=1, interface=None):
+        """
+        :param target: host to ping
+        :param timeout: time to wait for the reply, in seconds
+        :param interface: interface to send the echo from
+        """
+        self.target = target
+        self.timeout = timeout
+        self.interface = interface
+
+    def __call__(self):
+        """
+        :return: round trip time in ms, or None if the echo has been lost
+        """
+        command = ["ping", "-n", "-c", "1", "-W", str(self.timeout)]
+        if self.interface is not None:
+            command += ["-I", self.interface]
+        command.append(self.target)
+        try:
+            output = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True, timeout=self.timeout + 1
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired) as e:
+            _logger.warning("Cannot ping %s: %s", self.target, e)
+            return None
+        match = _PING_TIME.search(output)
+        return float(match.group(1)) if match else None
+
+
+class UDPProbe():
+    """
+    Measure the round trip time to a UDP echo service, like the echo port
+    (7) of a host or a probe reflector, without launching any process
+    """
+    _PAYLOAD = struct.Struct("!Id")
+
+    def __init__(self, target, port=7, timeout=1):
+        self.target = target
+        self.port = port
+        self.timeout = timeout
+        self._sequence = 0
+
+    def __call__(self):
+        """
+        :return: round trip time in ms, or None if the datagram has been lost
+        """
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        payload = self._PAYLOAD.pack(self._sequence, time.monotonic())
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect((self.target, self.port))
+                sock.send(payload)
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    reply = sock.recv(self._PAYLOAD.size)
+                    now = time.monotonic()
+                    # ignore the late replies to the previous probes
+                    if reply == payload:
+                        return (now - self._PAYLOAD.unpack(reply)[1]) * 1000
+                    if now >= deadline:
+                        return None
+                    sock.settimeout(deadline - now)
+            except OSError:
+                return None
+
+
+class ClassLoad():
+    """
+    Measure the throughput of a class from its counters
+    """
+    def __init__(self, node, backend_module=None, clock=time.monotonic):
+        self.node = node
+        self.backend_module = backend_module
+        self.clock = clock
+        self._last = None
+
+    def __call__(self):
+        """
+        :return: throughput since the previous call, in kbit/s, or None for
+            the first call or if the class has no counters
+        """
+        backend_module = self.backend_module or backend.get_backend()
+        dump = backend_module.dump(self.node.interface, stats=True)
+        record = dump.classes.get(
+            syntax.format_handle(syntax.parse_classid(self.node.classid))
+        )
+        if record is None or record.stats is None:
+            self._last = None
+            return None
+        now, sent = self.clock(), record.stats.bytes
+        last, self._last = self._last, (now, sent)
+        # counters going back mean the class has been recreated
+        if last is None or now <= last[0] or sent < last[1]:
+            return None
+        return (sent - last[1]) * 8 / 1000 / (now - last[0])
+
+
+class SimulatedLink():
+    """
+    Link whose capacity can change, with a queue in front of it which fills
+    when the shaped rate is above the capacity, to test a controller without
+    network
+
+    The rates are in kbit/s and the times in ms, as for the classes.
+    """
+    def __init__(self, capacity, rate, base_rtt=20, demand=None):
+        """
+        :param capacity: throughput of the link
+        :param rate: rate of the shaper in front of the link
+        :param base_rtt: round trip time when the queue is empty
+        :param demand: traffic sent to the shaper. If None, the shaper is
+            always saturated.
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.base_rtt = base_rtt
+        self.demand = demand
+        #: kbit waiting in the queue of the link
+        self.queue = 0
+        #: throughput of the shaper during the last advance
+        self.throughput = None
+
+    def advance(self, seconds):
+        """
+        Let the traffic flow for some time
+        """
+        sent = self.rate if self.demand is None else min(self.demand,
+                                                         self.rate)
+        self.queue = max(self.queue + (sent - self.capacity) * seconds, 0)
+        self.throughput = sent
+
+    def probe(self):
+        """
+        :return: round trip time, with the time spent in the queue
+        """
+        return self.base_rtt + self.queue / self.capacity * 1000
+
+    def load(self):
+        """
+        :return: throughput of the shaper
+        """
+        return self.throughput
+
+
+class Autorate():
+    """
+    Controller adjusting the rate of a class, usually the top class of a
+    :class:`pyqos.algorithms.htb.RootHTBClass`, to the capacity of a link
+    which changes over time, like LTE or DOCSIS
+
+    At each step, the latency is probed and compared to its baseline, the
+    lowest latency seen. If it increased by more than ``delay_threshold``,
+    a queue is filling beyond the shaper: the rate is lowered under the
+    measured throughput. If the latency stays low while the class is loaded
+    (its throughput is above ``load_threshold`` of its rate), the rate is
+    raised. The rate always stays between min_rate and max_rate.
+
+    A new rate is sent with :meth:`pyqos.PyQoS.commit`, as a change of the
+    class and of the classes with a rate or ceil relative to it: the trees
+    have to be applied by the same application first.
+    """
+    #: time between two steps, in seconds
+    interval = 1
+
+    def __init__(self, app, node, min_rate, max_rate, probe, load=None,
+                 delay_threshold=15, load_threshold=0.8, increase=1.05,
+                 decrease=0.9, baseline_drift=0.01, set_ceil=True,
+                 interval=None, clock=time.monotonic):
+        """
+        :param app: application which applied the tree of the node
+        :param node: class whose rate is adjusted. Its rate has to be a
+            number, in kbit/s.
+        :param min_rate: lowest rate set, in kbit/s
+        :param max_rate: highest rate set, in kbit/s
+        :param probe: function returning the round trip time in ms, or None
+            if the probe has been lost, like a :class:`PingProbe`
+        :param load: function returning the throughput of the class in
+            kbit/s, or None if unknown. If None, the counters of the class are
+            read, with a :class:`ClassLoad`.
+        :param delay_threshold: increase of the latency over its baseline
+            lowering the rate, in ms
+        :param load_threshold: part of the rate to use to raise it
+        :param increase: factor applied to the rate to raise it
+        :param decrease: factor applied to the throughput to lower the rate
+        :param baseline_drift: speed at which the baseline follows a higher
+            latency, when the path changes, between 0 and 1
+        :param set_ceil: set the ceil of the class to its new rate too, as
+            for a top class, which has no parent to borrow from
+        :param interval: time between two steps, in seconds
+        :param clock: function returning the current time, in seconds
+        """
+        rate = node._raw("rate")
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+            raise BadAttributeValueException(
+                "The rate of {!r} is not a number".format(node)
+            )
+        if not 0 < min_rate <= max_rate:
+            raise BadAttributeValueException(
+                "Bad rate bounds: {} - {}".format(min_rate, max_rate)
+            )
+        self.app = app
+        self.node = node
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.probe = probe
+        self.load = load or ClassLoad(node, app.get_backend(), clock)
+        self.delay_threshold = delay_threshold
+        self.load_threshold = load_threshold
+        self.increase = increase
+        self.decrease = decrease
+        self.baseline_drift = baseline_drift
+        self.set_ceil = set_ceil
+        self.interval = interval or self.interval
+        self.clock = clock
+        #: current rate, in kbit/s
+        self.rate = min(max(rate, min_rate), max_rate)
+        #: lowest round trip time, in ms
+        self.baseline = None
+        #: last round trip time, in ms
+        self.rtt = None
+        self._next_time = None
+
+    def next_rate(self, rtt, load):
+        """
+        Compute the rate to set from a probe and the throughput, and update
+        the baseline
+
+        :param rtt: round trip time in ms, or None if the probe was lost
+        :param load: throughput in kbit/s, or None if unknown
+        :return: new rate, in kbit/s
+        """
+        self.rtt = rtt
+        if rtt is not None:
+            if self.baseline is None or rtt < self.baseline:
+                self.baseline = rtt
+            elif rtt - self.baseline <= self.delay_threshold:
+                self.baseline += (rtt - self.baseline) * self.baseline_drift
+        if rtt is None or rtt - self.baseline > self.delay_threshold:
+            rate = self.rate if load is None else min(self.rate, load)
+            rate *= self.decrease
+        elif load is not None and load >= self.rate * self.load_threshold:
+            rate = self.rate * self.increase
+        else:
+            rate = self.rate
+        return int(min(max(rate, self.min_rate), self.max_rate))
+
+    def measure(self):
+        """
+        Probe the link and read the throughput of the class, which can wait
+        for the network up to the timeout of the probe
+
+        :return: (round trip time, throughput), for :meth:`update`
+        """
+        return self.probe(), self.load()
+
+    def update(self, rtt, load):
+        """
+        Apply the rate computed from a measure, if it changed
+
+        :return: the new rate, or None if the rate did not change
+        """
+        rate = self.next_rate(rtt, load)
+        if rate == self.rate:
+            return None
+        _logger.debug("%r: rate %d -> %d (rtt %s, baseline %s)", self.node,
+                      self.rate, rate, self.rtt, self.baseline)
+        self.node.rate = rate
+        if self.set_ceil:
+            self.node.ceil = rate
+        self.app.commit(interfaces=[self.node.interface])
+        self.rate = rate
+        return rate
+
+    def step(self):
+        """
+        Probe the link and apply a new rate if needed
+
+        :return: the new rate, or None if the rate did not change
+        """
+        return self.update(*self.measure())
+
+    def due(self):
+        """
+        Check if the interval elapsed since the previous step, and schedule
+        the next one if so
+        """
+        now = self.clock()
+        if self._next_time is not None and now < self._next_time:
+            return False
+        self._next_time = now + self.interval
+        return True
+
+    def run_pending(self):
+        """
+        Do a step if the interval elapsed since the previous one
+
+        :return: the new rate, or None if the rate did not change
+        """
+        if not self.due():
+            return None
+        return self.step()
+
+    def run(self, count=None):
+        """
+        Adjust the rate every interval
+
+        :param count: number of steps to do. If None, run until interrupted.
+        """
+        done = 0
+        while count is None or done < count:
+            self.run_pending()
+            done += 1
+            if count is None or done < count:
+                time.sleep(max(self._next_time - self.clock(), 0))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+
+from contextlib import contextmanager
+import importlib
+import threading
+
+#: available backends, by name
+BACKENDS = ("tc", "netlink")
+
+#: name of the backend currently used by the algorithms
+_backend_name = "tc"
+
+#: per-thread state: backend temporarily used instead of the selected one
+_context = threading.local()
+
+
+def get_backend():
+    """
+    Return the module of the backend currently used to apply the rules
+    """
+    override = getattr(_context, "backend", None)
+    if override is not None:
+        return override
+    return importlib.import_module("pyqos.backend." + _backend_name)
+
+
+@contextmanager
+def use_backend(backend):
+    """
+    Temporarily use another backend in the current thread
+
+    :param backend: any object exposing the same functions than the backend
+        modules
+    """
+    previous = getattr(_context, "backend", None)
+    _context.backend = backend
+    try:
+        yield backend
+    finally:
+        _context.backend = previous
+
+
+def set_backend(name):
+    """
+    Select the backend used to apply the rules
+
+    :param name: name of the backend: "tc" launches tc commands, "netlink"
+        talks directly to the kernel
+    """
+    global _backend_name
+    if name not in BACKENDS:
+        raise ValueError(
+            "Unknown backend \"{}\". Available: {}".format(
+                name, ", ".join(BACKENDS)
+            )
+        )
+    _backend_name = name
@@ -0,0 +1,1275 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Backend talking directly to the kernel through rtnetlink
+
+"""
+Alternative to :mod:`pyqos.backend.tc`, exposing the same functions but
+encoding the rtnetlink messages itself instead of launching tc.
+
+Arguments are the same as the tc ones, and are parsed the same way (handles
+in hexadecimal, rates and sizes with the tc units, ...). Messages are sent
+through an AF_NETLINK socket and the kernel acknowledgements are read back.
+In a :func:`batch`, messages are pipelined: they are sent by chunks and only
+the acknowledgements are waited.
+"""
+
+from contextlib import contextmanager
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import subprocess
+
+from pyqos import tools
+from pyqos.decorators import multiple_interfaces
+from pyqos.exceptions import BadAttributeValueException
+from .records import (
+    ClassRecord, Dump, FilterRecord, QDiscRecord, Stats, without_list_heads
+)
+from .syntax import (
+    IP_PROTOCOLS, PROTOCOLS, TC_H_ROOT, format_handle, format_u32_handle,
+    parse_classid, parse_qdisc_handle, parse_rate, parse_size, parse_time,
+    parse_u32_handle, protocol_name
+)
+
+_logger = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+NETLINK_CAP_ACK = 10
+NETLINK_EXT_ACK = 11
+SOL_NETLINK = 270
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_CAPPED = 0x100
+NLM_F_ACK_TLVS = 0x200
+NLMSGERR_ATTR_MSG = 1
+
+RTM_NEWQDISC = 36
+RTM_DELQDISC = 37
+RTM_GETQDISC = 38
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_GETTCLASS = 42
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+RTM_GETTFILTER = 46
+
+NLA_F_NESTED = 0x8000
+
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_XSTATS = 4
+TCA_STATS2 = 7
+TCA_CHAIN = 11
+
+TCA_STATS_BASIC = 1
+TCA_STATS_QUEUE = 3
+TCA_STATS_PKT64 = 8
+
+TC_LINKLAYER_ETHERNET = 1
+
+TCA_HTB_PARMS = 1
+TCA_HTB_INIT = 2
+TCA_HTB_DIRECT_QLEN = 5
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+
+TCA_FQ_CODEL_TARGET = 1
+TCA_FQ_CODEL_LIMIT = 2
+TCA_FQ_CODEL_INTERVAL = 3
+TCA_FQ_CODEL_ECN = 4
+TCA_FQ_CODEL_FLOWS = 5
+TCA_FQ_CODEL_QUANTUM = 6
+
+TCA_CAKE_BASE_RATE64 = 2
+TCA_CAKE_DIFFSERV_MODE = 3
+TCA_CAKE_ATM = 4
+TCA_CAKE_FLOW_MODE = 5
+TCA_CAKE_OVERHEAD = 6
+TCA_CAKE_RTT = 7
+TCA_CAKE_AUTORATE = 9
+TCA_CAKE_MEMORY = 10
+TCA_CAKE_NAT = 11
+TCA_CAKE_RAW = 12
+TCA_CAKE_WASH = 13
+TCA_CAKE_MPU = 14
+TCA_CAKE_INGRESS = 15
+TCA_CAKE_ACK_FILTER = 16
+TCA_CAKE_SPLIT_GSO = 17
+TCA_CAKE_FWMARK = 18
+
+TCA_FW_CLASSID = 1
+
+TCA_U32_CLASSID = 1
+TCA_U32_HASH = 2
+TCA_U32_LINK = 3
+TCA_U32_DIVISOR = 4
+TCA_U32_SEL = 5
+TC_U32_TERMINAL = 1
+
+TCA_FLOWER_CLASSID = 1
+TCA_FLOWER_KEY_ETH_TYPE = 8
+TCA_FLOWER_KEY_IP_PROTO = 9
+TCA_FLOWER_KEY_IPV4_SRC = 10
+TCA_FLOWER_KEY_IPV4_DST = 12
+TCA_FLOWER_KEY_IPV6_SRC = 14
+TCA_FLOWER_KEY_IPV6_DST = 16
+TCA_FLOWER_KEY_IP_TOS = 73
+TCA_FLOWER_KEY_IP_TOS_MASK = 74
+
+#: flower attributes of the (source, destination) ports, by IP protocol
+FLOWER_PORTS = {6: (18, 19), 17: (20, 21), 132: (41, 42)}
+
+TCA_ACT_KIND = 1
+TCA_ACT_OPTIONS = 2
+TCA_GACT_PARMS = 2
+TC_ACT_GOTO_CHAIN = 2 << 28
+
+#: attribute of the actions in the options of each filter kind
+FILTER_ACTIONS = {"fw": 4, "u32": 7, "flower": 3}
+
+#: number of messages sent before reading their acknowledgements
+PIPELINE_CHUNK = 128
+
+#: cake options without value, to the attribute and value they set
+CAKE_FLAGS = {
+    "autorate-ingress": (TCA_CAKE_AUTORATE, 1),
+    "diffserv3": (TCA_CAKE_DIFFSERV_MODE, 0),
+    "diffserv4": (TCA_CAKE_DIFFSERV_MODE, 1),
+    "diffserv8": (TCA_CAKE_DIFFSERV_MODE, 2),
+    "besteffort": (TCA_CAKE_DIFFSERV_MODE, 3),
+    "precedence": (TCA_CAKE_DIFFSERV_MODE, 4),
+    "flowblind": (TCA_CAKE_FLOW_MODE, 0),
+    "srchost": (TCA_CAKE_FLOW_MODE, 1),
+    "dsthost": (TCA_CAKE_FLOW_MODE, 2),
+    "hosts": (TCA_CAKE_FLOW_MODE, 3),
+    "flows": (TCA_CAKE_FLOW_MODE, 4),
+    "dual-srchost": (TCA_CAKE_FLOW_MODE, 5),
+    "dual-dsthost": (TCA_CAKE_FLOW_MODE, 6),
+    "triple-isolate": (TCA_CAKE_FLOW_MODE, 7),
+    "nat": (TCA_CAKE_NAT, 1), "nonat": (TCA_CAKE_NAT, 0),
+    "wash": (TCA_CAKE_WASH, 1), "nowash": (TCA_CAKE_WASH, 0),
+    "split-gso": (TCA_CAKE_SPLIT_GSO, 1),
+    "no-split-gso": (TCA_CAKE_SPLIT_GSO, 0),
+    "ack-filter": (TCA_CAKE_ACK_FILTER, 1),
+    "ack-filter-aggressive": (TCA_CAKE_ACK_FILTER, 2),
+    "no-ack-filter": (TCA_CAKE_ACK_FILTER, 0),
+    "noatm": (TCA_CAKE_ATM, 0), "atm": (TCA_CAKE_ATM, 1),
+    "ptm": (TCA_CAKE_ATM, 2),
+    "ingress": (TCA_CAKE_INGRESS, 1), "egress": (TCA_CAKE_INGRESS, 0),
+    "raw": (TCA_CAKE_RAW, 1),
+}
+
+#: cake rtt presets, in µs
+CAKE_RTT_PRESETS = {
+    "datacentre": 100, "lan": 1000, "metro": 10000, "regional": 30000,
+    "internet": 100000, "oceanic": 300000, "satellite": 1000000,
+    "interplanetary": 3600000000,
+}
+
+#: cake overhead presets: (overhead, mpu, atm mode)
+CAKE_OVERHEAD_PRESETS = {
+    "conservative": (48, None, 1), "ipoa-vcmux": (8, None, 1),
+    "ipoa-llcsnap": (16, None, 1), "bridged-vcmux": (24, None, 1),
+    "bridged-llcsnap": (32, None, 1), "pppoa-vcmux": (10, None, 1),
+    "pppoa-llc": (14, None, 1), "pppoe-vcmux": (32, None, 1),
+    "pppoe-llcsnap": (40, None, 1), "pppoe-ptm": (30, None, 2),
+    "bridged-ptm": (22, None, 2), "docsis": (18, 64, 0),
+    "ethernet": (38, 84, 0),
+}
+
+
+def get_ifindex(interface):
+    """
+    Return the index of an interface
+    """
+    return socket.if_nametoindex(interface)
+
+
+def _read_psched():
+    """
+    Read the kernel clock parameters, as tc does, to convert durations in
+    ticks
+
+    :return: (tick_in_usec, hz)
+    """
+    try:
+        with open("/proc/net/psched") as psched:
+            t2us, us2t, clock_res, hz = (
+                int(i, 16) for i in psched.read().split()[:4]
+            )
+    except (OSError, ValueError):
+        return 1.0, 1000
+    if clock_res == 1000000000:
+        t2us = us2t
+    tick_in_usec = t2us / us2t * (clock_res / 1000000)
+    return tick_in_usec, (hz if clock_res == 1000000 else 1000)
+
+
+_tick_in_usec, _hz = _read_psched()
+
+
+def _xmit_time(rate, size):
+    """
+    Time to send size Bytes at rate Bytes/s, in kernel ticks
+    """
+    return int(1000000 * size / rate * _tick_in_usec)
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def attr(attr_type, data):
+    """
+    Encode a netlink attribute
+    """
+    length = 4 + len(data)
+    return (struct.pack("=HH", length, attr_type) + data +
+            b"\0" * (_align(length) - length))
+
+
+def attr_u32(attr_type, value):
+    return attr(attr_type, struct.pack("=I", value))
+
+
+def attr_s32(attr_type, value):
+    return attr(attr_type, struct.pack("=i", value))
+
+
+def attr_u64(attr_type, value):
+    return attr(attr_type, struct.pack("=Q", value))
+
+
+def attr_str(attr_type, value):
+    return attr(attr_type, value.encode() + b"\0")
+
+
+def parse_attrs(data):
+    """
+    Decode a sequence of netlink attributes
+
+    :return: dict {attribute type: raw data}
+    """
+    attrs = {}
+    offset = 0
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        attrs[attr_type & 0x3FFF] = data[offset + 4:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def tcmsg(ifindex, handle=0, parent=0, info=0):
+    """
+    Encode a tcmsg header
+    """
+    return struct.pack("=BxxxiIII", socket.AF_UNSPEC, ifindex, handle,
+                       parent, info)
+
+
+def nlmsg(msg_type, flags, seq, payload):
+    """
+    Encode a netlink message
+    """
+    return struct.pack("=IHHII", 16 + len(payload), msg_type, flags, seq,
+                       0) + payload
+
+
+def parse_nlmsgs(data):
+    """
+    Split a datagram in netlink messages
+
+    :return: list of tuples (type, flags, seq, payload)
+    """
+    messages = []
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type, flags, seq, _ = struct.unpack_from(
+            "=IHHII", data, offset
+        )
+        if length < 16:
+            break
+        messages.append(
+            (msg_type, flags, seq, data[offset + 16:offset + length])
+        )
+        offset += _align(length)
+    return messages
+
+
+def _action_flags(action):
+    flags = NLM_F_REQUEST | NLM_F_ACK
+    if action == "add":
+        flags |= NLM_F_EXCL | NLM_F_CREATE
+    elif action == "replace":
+        flags |= NLM_F_CREATE | NLM_F_REPLACE
+    elif action not in ("change", "delete"):
+        raise BadAttributeValueException("Unknown action: " + str(action))
+    return flags
+
+
+def _ratespec(rate):
+    return struct.pack(
+        "=BBHhHI", 0, TC_LINKLAYER_ETHERNET, 0, 0, 0, min(rate, 0xFFFFFFFF)
+    )
+
+
+def _htb_qdisc_options(opts_args, default=None, r2q=None, direct_qlen=None):
+    options = attr(TCA_HTB_INIT, struct.pack(
+        "=IIIII", 3, int(r2q or 10),
+        int(str(default), 16) if default is not None else 0, 0, 0
+    ))
+    if direct_qlen is not None:
+        options += attr_u32(TCA_HTB_DIRECT_QLEN, int(direct_qlen))
+    return options
+
+
+def _pfifo_qdisc_options(opts_args, limit=None):
+    if limit is None:
+        return None
+    return struct.pack("=I", int(limit))
+
+
+def _mq_qdisc_options(opts_args):
+    return None
+
+
+def _sfq_qdisc_options(opts_args, perturb=None, limit=None, quantum=None,
+                       divisor=None, flows=None):
+    return struct.pack(
+        "=IiIII", parse_size(quantum) if quantum is not None else 0,
+        int(perturb or 0), int(limit or 0), int(divisor or 0), int(flows or 0)
+    )
+
+
+def _fq_codel_qdisc_options(opts_args, limit=None, flows=None, target=None,
+                            interval=None, quantum=None):
+    options = b""
+    if limit is not None:
+        options += attr_u32(TCA_FQ_CODEL_LIMIT, int(limit))
+    if flows is not None:
+        options += attr_u32(TCA_FQ_CODEL_FLOWS, int(flows))
+    if target is not None:
+        options += attr_u32(TCA_FQ_CODEL_TARGET, parse_time(target))
+    if interval is not None:
+        options += attr_u32(TCA_FQ_CODEL_INTERVAL, parse_time(interval))
+    if quantum is not None:
+        options += attr_u32(TCA_FQ_CODEL_QUANTUM, parse_size(quantum))
+    for flag in opts_args:
+        if flag not in ("ecn", "noecn"):
+            raise BadAttributeValueException(
+                "Unknown fq_codel option: " + flag
+            )
+        options += attr_u32(TCA_FQ_CODEL_ECN, int(flag == "ecn"))
+    return options
+
+
+def _cake_qdisc_options(opts_args, bandwidth=None, rtt=None, memlimit=None,
+                        fwmark=None, overhead=None, mpu=None):
+    values = {}
+    for flag in opts_args:
+        if flag in CAKE_FLAGS:
+            attr_type, value = CAKE_FLAGS[flag]
+            values[attr_type] = value
+            if flag == "raw":
+                values[TCA_CAKE_OVERHEAD] = 0
+        elif flag in CAKE_RTT_PRESETS:
+            values[TCA_CAKE_RTT] = CAKE_RTT_PRESETS[flag]
+        elif flag in CAKE_OVERHEAD_PRESETS:
+            preset_overhead, preset_mpu, atm = CAKE_OVERHEAD_PRESETS[flag]
+            values[TCA_CAKE_OVERHEAD] = preset_overhead
+            values[TCA_CAKE_ATM] = atm
+            if preset_mpu is not None:
+                values[TCA_CAKE_MPU] = preset_mpu
+        elif flag == "ether-vlan":
+            values[TCA_CAKE_OVERHEAD] = values.get(TCA_CAKE_OVERHEAD, 0) + 4
+        else:
+            raise BadAttributeValueException("Unknown cake option: " + flag)
+    if bandwidth is not None:
+        values[TCA_CAKE_BASE_RATE64] = (
+            0 if bandwidth == "unlimited" else parse_rate(bandwidth)
+        )
+    if rtt is not None:
+        values[TCA_CAKE_RTT] = parse_time(rtt)
+    if memlimit is not None:
+        values[TCA_CAKE_MEMORY] = parse_size(memlimit)
+    if fwmark is not None:
+        values[TCA_CAKE_FWMARK] = int(str(fwmark), 0)
+    if overhead is not None:
+        values[TCA_CAKE_OVERHEAD] = int(overhead)
+    if mpu is not None:
+        values[TCA_CAKE_MPU] = int(mpu)
+
+    options = b""
+    for attr_type, value in sorted(values.items()):
+        if attr_type == TCA_CAKE_BASE_RATE64:
+            options += attr_u64(attr_type, value)
+        elif attr_type == TCA_CAKE_OVERHEAD:
+            options += attr_s32(attr_type, value)
+        else:
+            options += attr_u32(attr_type, value)
+    return options
+
+
+#: encoders of the qdisc options, by algorithm
+QDISC_OPTIONS = {
+    "htb": _htb_qdisc_options, "mq": _mq_qdisc_options,
+    "pfifo": _pfifo_qdisc_options, "sfq": _sfq_qdisc_options,
+    "fq_codel": _fq_codel_qdisc_options, "cake": _cake_qdisc_options,
+}
+
+
+def _htb_class_options(rate=None, ceil=None, burst=None, cburst=None,
+                       prio=None, quantum=None, mtu=1600):
+    """
+    Encode the options of a htb class, with the same defaults than tc
+    """
+    if rate is None:
+        raise BadAttributeValueException("A htb class needs a rate")
+    rate = parse_rate(rate)
+    ceil = parse_rate(ceil) if ceil is not None else rate
+    buffer = parse_size(burst) if burst is not None else rate // _hz + mtu
+    cbuffer = parse_size(cburst) if cburst is not None else ceil // _hz + mtu
+    options = attr(TCA_HTB_PARMS, _ratespec(rate) + _ratespec(ceil) +
+                   struct.pack(
+                       "=IIIII", _xmit_time(rate, buffer),
+                       _xmit_time(ceil, cbuffer),
+                       parse_size(quantum) if quantum is not None else 0,
+                       0, int(prio or 0)
+                   ))
+    if rate > 0xFFFFFFFF:
+        options += attr_u64(TCA_HTB_RATE64, rate)
+    if ceil > 0xFFFFFFFF:
+        options += attr_u64(TCA_HTB_CEIL64, ceil)
+    return options
+
+
+def _describe(*args, **kwargs):
+    """
+    Describe a message with the equivalent tc command, for logs and errors
+    """
+    command = ["tc"] + [str(i) for i in args if i is not None]
+    for i, j in sorted(kwargs.items()):
+        if j is not None:
+            command += [str(i), str(j)]
+    return " ".join(command)
+
+
+class Pipeline():
+    """
+    Queue of netlink messages, sent by chunks on one socket
+
+    Only the acknowledgements are waited, once per chunk, so a big tree costs
+    a few syscalls instead of one round trip per message.
+    """
+    def __init__(self, dryrun=False, sock=None):
+        self.dryrun = dryrun
+        self._sock = sock
+        self._seq = 0
+        #: queued messages: list of tuples
+        #: ``(seq, message, description, origin, ignore_errors)``
+        self.queue = []
+        #: failures of the messages already sent, since the last flush
+        self._failed = []
+
+    @property
+    def sock(self):
+        if self._sock is None:
+            self._sock = open_socket()
+        return self._sock
+
+    def accepts(self, command):
+        """
+        tc commands are never queued in a netlink pipeline
+        """
+        return False
+
+    def add(self, msg_type, flags, payload, description=None, origin=None,
+            ignore_errors=False):
+        """
+        Queue a message
+
+        :param description: equivalent tc command, used in the logs
+        :param origin: object which generated the message
+        :param ignore_errors: do not report a failure of this message
+        """
+        self._seq += 1
+        self.queue.append((
+            self._seq, nlmsg(msg_type, flags, self._seq, payload),
+            description, origin, ignore_errors
+        ))
+        if len(self.queue) >= PIPELINE_CHUNK:
+            # send full chunks right away, to not hold a big plan in memory
+            self._failed.extend(self._send_queue())
+
+    def flush(self):
+        """
+        Send all queued messages and read their acknowledgements
+
+        :return: list of failed messages since the last flush, as tuples
+            ``(description, origin, error message)``
+        """
+        failed, self._failed = self._failed, []
+        return failed + self._send_queue()
+
+    def _send_queue(self):
+        queue, self.queue = self.queue, []
+        for _, _, description, _, _ in queue:
+            _logger.debug(description)
+        if self.dryrun:
+            return []
+        failed = []
+        for i in range(0, len(queue), PIPELINE_CHUNK):
+            failed.extend(self._send_chunk(queue[i:i + PIPELINE_CHUNK]))
+        return failed
+
+    def _send_chunk(self, chunk):
+        pending = {seq: (description, origin, ignore_errors)
+                   for seq, _, description, origin, ignore_errors in chunk}
+        self.sock.send(b"".join(message for _, message, _, _, _ in chunk))
+        failed = []
+        while pending:
+            for msg_type, flags, seq, payload in parse_nlmsgs(
+                    self.sock.recv(1 << 16)):
+                if msg_type != NLMSG_ERROR or seq not in pending:
+                    continue
+                description, origin, ignore_errors = pending.pop(seq)
+                error = struct.unpack_from("=i", payload)[0]
+                if error and not ignore_errors:
+                    message = _error_message(error, flags, payload)
+                    failed.append((description, origin, message))
+                    _logger.error("%s (generated by %r): %s", description,
+                                  origin, message)
+        return failed
+
+    def dump(self, msg_type, payload):
+        """
+        Send a dump request and return all received messages
+
+        :return: list of tuples (type, payload)
+        """
+        self._seq += 1
+        seq = self._seq
+        self.sock.send(
+            nlmsg(msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, payload)
+        )
+        messages = []
+        while True:
+            for msg_type, flags, msg_seq, msg_payload in parse_nlmsgs(
+                    self.sock.recv(1 << 16)):
+                if msg_seq != seq:
+                    continue
+                if msg_type == NLMSG_DONE:
+                    return messages
+                if msg_type == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", msg_payload)[0]
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return messages
+                messages.append((msg_type, msg_payload))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def _error_message(error, flags, payload):
+    """
+    Message of a netlink error, with the extended ack message if any
+    """
+    message = os.strerror(-error)
+    if flags & NLM_F_ACK_TLVS:
+        # skip the error code and the header of the original message
+        orig_len = struct.unpack_from("=I", payload, 4)[0]
+        offset = 4 + (16 if flags & NLM_F_CAPPED else _align(orig_len))
+        ext_msg = parse_attrs(payload[offset:]).get(NLMSGERR_ATTR_MSG)
+        if ext_msg:
+            message += ": " + ext_msg.rstrip(b"\0").decode(errors="replace")
+    return message
+
+
+def open_socket():
+    """
+    Open a rtnetlink socket, asking for short and extended acknowledgements
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    for option in (NETLINK_CAP_ACK, NETLINK_EXT_ACK):
+        try:
+            sock.setsockopt(SOL_NETLINK, option, 1)
+        except OSError:
+            pass
+    sock.bind((0, 0))
+    return sock
+
+
+@contextmanager
+def batch(dryrun=False, sock=None):
+    """
+    Pipeline all messages sent in this context and flush them at its exit
+
+    If a batch is already active, messages are queued in it and will be
+    flushed by the outer context.
+
+    :param dryrun: only prints the queued messages during the flush
+    :param sock: netlink socket to use. If None, opens a new one.
+    """
+    current = tools.get_batch()
+    if isinstance(current, Pipeline):
+        yield current
+        return
+    pipeline = Pipeline(dryrun=dryrun, sock=sock)
+    tools.set_batch(pipeline)
+    try:
+        yield pipeline
+    finally:
+        tools.set_batch(current)
+    try:
+        pipeline.flush()
+    finally:
+        if sock is None:
+            pipeline.close()
+
+
+def _send(msg_type, flags, payload, description, dryrun=False,
+          ignore_errors=False):
+    """
+    Queue the message in the current pipeline, or send it directly
+    """
+    pipeline = tools.get_batch()
+    if isinstance(pipeline, Pipeline):
+        pipeline.add(msg_type, flags, payload, description,
+                     tools.get_command_origin(), ignore_errors)
+        return
+    with batch(dryrun=dryrun) as pipeline:
+        pipeline.add(msg_type, flags, payload, description,
+                     tools.get_command_origin(), ignore_errors)
+
+
+@multiple_interfaces
+def qdisc(interface, action, algorithm=None, handle=None, parent=None,
+          stderr=None, dryrun=False, opts_args=None, **kwargs):
+    """
+    Add/change/replace/replace qdisc
+
+    **kwargs will be used for specific arguments, depending on the algorithm
+    used.
+
+    :param action: "add", "replace", "change" or "delete"
+    :param interface: target interface
+    :param algorithm: algorithm used for this leaf (htb, pfifo, sfq, ...)
+    :param handle: handle parameter for tc (default: None)
+    :param parent: if is None, the rule will be added as root. (default: None)
+    :param stderr: if subprocess.DEVNULL, errors will not be logged
+    :param opts_args: list of options without value, to append to the command
+    """
+    opts_args = opts_args or []
+    ignore_errors = stderr == subprocess.DEVNULL
+    try:
+        ifindex = get_ifindex(interface)
+    except OSError:
+        if ignore_errors:
+            return
+        raise
+    payload = tcmsg(
+        ifindex,
+        handle=parse_qdisc_handle(handle) if handle is not None else 0,
+        parent=parse_classid(parent) if parent is not None else TC_H_ROOT
+    )
+    kwargs = {i: j for i, j in kwargs.items() if j is not None}
+    if algorithm is not None:
+        payload += attr_str(TCA_KIND, algorithm)
+        if action != "delete":
+            try:
+                encoder = QDISC_OPTIONS[algorithm]
+            except KeyError:
+                raise BadAttributeValueException(
+                    "Qdisc {} is not supported by the netlink "
+                    "backend".format(algorithm)
+                )
+            try:
+                options = encoder(list(opts_args), **kwargs)
+            except TypeError as e:
+                raise BadAttributeValueException(str(e))
+            if options is not None:
+                payload += attr(TCA_OPTIONS, options)
+    description = _describe(
+        "qdisc", action, "dev", interface,
+        *(["root"] if parent is None else ["parent", parent]),
+        *(["handle", handle] if handle is not None else []),
+        algorithm, *sorted(opts_args), **kwargs
+    )
+    _send(RTM_DELQDISC if action == "delete" else RTM_NEWQDISC,
+          _action_flags(action), payload, description, dryrun, ignore_errors)
+
+
+@multiple_interfaces
+def qdisc_add(interface, handle, algorithm, parent=None, opts_args=None,
+              **kwargs):
+    """
+    Add qdisc
+
+    **kwargs will be used for specific arguments, depending on the algorithm
+    used.
+
+    :param interface: target interface
+    :param algorithm: algorithm used for this leaf (htb, pfifo, sfq, ...)
+    :param handle: handle parameter for tc
+    :param parent: if is None, the rule will be added as root. (default: None)
+    :param opts_args: list of options without value, to append to the command
+    """
+    return qdisc(
+        interface, "add", algorithm, handle, parent, opts_args=opts_args,
+        **kwargs
+    )
+
+
+@multiple_interfaces
+def qdisc_del(interface, algorithm=None, handle=None, parent=None, *args,
+              **kwargs):
+    """
+    Delete qdisc
+
+    :param interface: target interface
+    :param algorithm: algorithm used for this leaf (htb, pfifo, sfq, ...)
+    :param handle: handle parameter for tc (default: None)
+    :param parent: if is None, the rule will be added as root. (default: None)
+    """
+    return qdisc(
+        interface, "delete", algorithm, handle, parent, opts_args=args,
+        **kwargs
+    )
+
+
+def _dump(msg_type, interface=None, dryrun=False):
+    """
+    Dump the objects of an interface
+
+    :return: list of tuples (tcmsg fields, attributes)
+    """
+    ifindex = get_ifindex(interface) if interface is not None else 0
+    _logger.debug(_describe(
+        {RTM_GETQDISC: "qdisc", RTM_GETTCLASS: "class",
+         RTM_GETTFILTER: "filter"}[msg_type], "show",
+        *(["dev", interface] if interface is not None else [])
+    ))
+    if dryrun:
+        return []
+    pipeline = tools.get_batch()
+    if not isinstance(pipeline, Pipeline):
+        pipeline = Pipeline()
+    try:
+        messages = pipeline.dump(msg_type, tcmsg(ifindex))
+    finally:
+        if pipeline is not tools.get_batch():
+            pipeline.close()
+    objects = []
+    for _, payload in messages:
+        fields = struct.unpack_from("=BxxxiIII", payload)
+        if ifindex and fields[1] != ifindex:
+            continue
+        objects.append((fields, parse_attrs(payload[20:])))
+    return objects
+
+
+def _kind(attrs):
+    return attrs.get(TCA_KIND, b"").rstrip(b"\0").decode()
+
+
+def _decode_stats(kind, attrs):
+    """
+    Decode the statistics of a qdisc or a class
+
+    :return: :class:`pyqos.backend.records.Stats`, or None if the kernel did
+        not send them
+    """
+    stats = parse_attrs(attrs.get(TCA_STATS2, b""))
+    if TCA_STATS_BASIC not in stats:
+        return None
+    sent_bytes, packets = struct.unpack_from("=QI", stats[TCA_STATS_BASIC])
+    if TCA_STATS_PKT64 in stats:
+        packets = struct.unpack("=Q", stats[TCA_STATS_PKT64])[0]
+    qlen = backlog = drops = requeues = overlimits = 0
+    if TCA_STATS_QUEUE in stats:
+        qlen, backlog, drops, requeues, overlimits = struct.unpack_from(
+            "=IIIII", stats[TCA_STATS_QUEUE]
+        )
+    tokens = ctokens = None
+    xstats = attrs.get(TCA_XSTATS, b"")
+    if kind == "htb" and len(xstats) >= 20:
+        tokens, ctokens = struct.unpack_from("=ii", xstats, 12)
+    return Stats(sent_bytes, packets, drops, overlimits, requeues, backlog,
+                 qlen, tokens, ctokens)
+
+
+def _decode_qdisc(interface, fields, attrs):
+    _, _, handle, parent, _ = fields
+    kind = _kind(attrs)
+    data = attrs.get(TCA_OPTIONS, b"")
+    options = {}
+    if kind == "htb":
+        init = parse_attrs(data).get(TCA_HTB_INIT)
+        if init:
+            _, r2q, defcls, _, _ = struct.unpack_from("=IIIII", init)
+            options = {"r2q": r2q, "default": hex(defcls)}
+    elif kind == "sfq" and len(data) >= 20:
+        quantum, perturb, limit, divisor, flows = struct.unpack_from(
+            "=IiIII", data
+        )
+        options = {"quantum": quantum, "perturb": perturb, "limit": limit,
+                   "divisor": divisor, "flows": flows}
+    elif kind in ("pfifo", "bfifo") and len(data) >= 4:
+        options = {"limit": struct.unpack_from("=I", data)[0]}
+    elif kind == "fq_codel":
+        names = {TCA_FQ_CODEL_TARGET: "target", TCA_FQ_CODEL_LIMIT: "limit",
+                 TCA_FQ_CODEL_INTERVAL: "interval",
+                 TCA_FQ_CODEL_FLOWS: "flows",
+                 TCA_FQ_CODEL_QUANTUM: "quantum"}
+        for attr_type, value in parse_attrs(data).items():
+            if attr_type in names:
+                options[names[attr_type]] = struct.unpack_from("=I", value)[0]
+        for key in ("target", "interval"):
+            if key in options:
+                options[key] = "{}us".format(options[key])
+    elif kind == "cake":
+        rate = parse_attrs(data).get(TCA_CAKE_BASE_RATE64)
+        if rate:
+            options = {
+                "bandwidth": "{}bps".format(struct.unpack("=Q", rate)[0])
+            }
+    return QDiscRecord(
+        interface, kind, format_handle(handle),
+        "root" if parent == TC_H_ROOT else format_handle(parent), options,
+        _decode_stats(kind, attrs)
+    )
+
+
+def _decode_class(interface, fields, attrs):
+    _, _, classid, parent, leaf = fields
+    kind = _kind(attrs)
+    rate = ceil = burst = cburst = prio = quantum = None
+    options = parse_attrs(attrs.get(TCA_OPTIONS, b""))
+    parms = options.get(TCA_HTB_PARMS)
+    if kind == "htb" and parms:
+        rate = struct.unpack_from("=I", parms, 8)[0]
+        ceil = struct.unpack_from("=I", parms, 20)[0]
+        if TCA_HTB_RATE64 in options:
+            rate = struct.unpack("=Q", options[TCA_HTB_RATE64])[0]
+        if TCA_HTB_CEIL64 in options:
+            ceil = struct.unpack("=Q", options[TCA_HTB_CEIL64])[0]
+        buffer, cbuffer, quantum, _, prio = struct.unpack_from(
+            "=IIIII", parms, 24
+        )
+        burst = int(rate * buffer / _tick_in_usec / 1000000)
+        cburst = int(ceil * cbuffer / _tick_in_usec / 1000000)
+        rate, ceil = rate * 8, ceil * 8
+    if parent == TC_H_ROOT:
+        parent = classid & 0xFFFF0000
+    return ClassRecord(
+        interface, kind, format_handle(classid), format_handle(parent),
+        format_handle(leaf) if leaf else None, rate, ceil, burst, cburst,
+        prio, quantum, _decode_stats(kind, attrs)
+    )
+
+
+def _fw_filter_options(flowid):
+    if flowid is None:
+        return None
+    return attr_u32(TCA_FW_CLASSID, parse_classid(flowid))
+
+
+def _u32_filter_options(flowid, divisor=None, ht=None, match=(),
+                        hashkey=None, link=None, terminal=False):
+    """
+    Encode the options of a u32 filter. See
+    :func:`pyqos.backend.tc._u32_filter_options` for the parameters.
+
+    :param terminal: the rule ends the classification, even without flowid,
+        to run its actions
+    """
+    options = b""
+    if flowid is not None:
+        options += attr_u32(TCA_U32_CLASSID, parse_classid(flowid))
+    if divisor is not None:
+        # a new hash table, without selector
+        return options + attr_u32(TCA_U32_DIVISOR, int(divisor))
+    if ht is not None:
+        options += attr_u32(TCA_U32_HASH, parse_u32_handle(ht))
+    if link is not None:
+        options += attr_u32(TCA_U32_LINK, parse_u32_handle(link))
+    hmask, hoff = hashkey if hashkey is not None else (0, 0)
+    sel = struct.pack(
+        "=BBBxHHhh",
+        TC_U32_TERMINAL if flowid is not None or terminal else 0, 0,
+        len(match), 0, 0, 0, hoff
+    ) + struct.pack(">I", hmask)
+    for value, mask, offset in match:
+        sel += struct.pack(">II", mask, value & mask)
+        sel += struct.pack("=ii", offset, 0)
+    return options + attr(TCA_U32_SEL, sel)
+
+
+def _flower_address(network, ipv4_attr):
+    """
+    Encode an address or network matched by flower, followed by its mask.
+    The attributes of the IPv6 addresses follow the IPv4 ones by 4.
+    """
+    try:
+        network = ipaddress.ip_network(network, strict=False)
+    except ValueError as e:
+        raise BadAttributeValueException(str(e))
+    attr_type = ipv4_attr if network.version == 4 else ipv4_attr + 4
+    return (attr(attr_type, network.network_address.packed) +
+            attr(attr_type + 1, network.netmask.packed))
+
+
+def _flower_filter_options(flowid, eth_type=None, ip_proto=None,
+                           src_ip=None, dst_ip=None, src_port=None,
+                           dst_port=None, ip_tos=None):
+    """
+    Encode the options of a flower filter. See
+    :func:`pyqos.backend.tc._flower_filter_options` for the parameters.
+
+    :param eth_type: ethernet protocol of the filter, as a number
+    """
+    options = b""
+    if flowid is not None:
+        options += attr_u32(TCA_FLOWER_CLASSID, parse_classid(flowid))
+    if eth_type is not None and eth_type != PROTOCOLS["all"]:
+        options += attr(TCA_FLOWER_KEY_ETH_TYPE, struct.pack(">H", eth_type))
+    if ip_proto is not None:
+        ip_proto = str(ip_proto)
+        try:
+            ip_proto = IP_PROTOCOLS.get(ip_proto) or int(ip_proto, 0)
+        except ValueError:
+            raise BadAttributeValueException(
+                "Unknown IP protocol: " + ip_proto
+            )
+        options += attr(TCA_FLOWER_KEY_IP_PROTO, struct.pack("=B", ip_proto))
+    if src_ip is not None:
+        options += _flower_address(src_ip, TCA_FLOWER_KEY_IPV4_SRC)
+    if dst_ip is not None:
+        options += _flower_address(dst_ip, TCA_FLOWER_KEY_IPV4_DST)
+    for port, index in ((src_port, 0), (dst_port, 1)):
+        if port is None:
+            continue
+        if ip_proto not in FLOWER_PORTS:
+            raise BadAttributeValueException(
+                "Ports can only be matched for tcp, udp and sctp"
+            )
+        options += attr(FLOWER_PORTS[ip_proto][index],
+                        struct.pack(">H", int(port)))
+    if ip_tos is not None:
+        value, _, mask = str(ip_tos).partition("/")
+        options += attr(TCA_FLOWER_KEY_IP_TOS,
+                        struct.pack("=B", int(value, 0)))
+        options += attr(TCA_FLOWER_KEY_IP_TOS_MASK,
+                        struct.pack("=B", int(mask, 0) if mask else 0xFF))
+    return options
+
+
+#: encoders of the filter options, by kind
+FILTER_OPTIONS = {"fw": _fw_filter_options, "u32": _u32_filter_options,
+                  "flower": _flower_filter_options}
+
+
+def _goto_chain_action(chain):
+    """
+    Encode the list of actions of a filter, with one gact action continuing
+    the classification in another chain
+    """
+    parms = struct.pack("=IIiii", 0, 0, TC_ACT_GOTO_CHAIN | int(chain), 0, 0)
+    action = attr_str(TCA_ACT_KIND, "gact") + attr(
+        NLA_F_NESTED | TCA_ACT_OPTIONS, attr(TCA_GACT_PARMS, parms)
+    )
+    # the actions are numbered from 1
+    return attr(1, action)
+
+
+def _decode_filter(interface, fields, attrs):
+    _, _, handle, parent, info = fields
+    kind = _kind(attrs)
+    if not handle:
+        # head of a filter list
+        handle = None
+    elif kind == "u32":
+        handle = format_u32_handle(handle)
+    flowid = None
+    # TCA_FW_CLASSID, TCA_U32_CLASSID and TCA_FLOWER_CLASSID
+    classid = parse_attrs(attrs.get(TCA_OPTIONS, b"")).get(TCA_FW_CLASSID)
+    if kind in ("fw", "u32", "flower") and classid:
+        flowid = format_handle(struct.unpack("=I", classid)[0])
+    chain = attrs.get(TCA_CHAIN)
+    return FilterRecord(
+        interface, kind, format_handle(parent),
+        protocol_name(socket.ntohs(info & 0xFFFF)), info >> 16, handle, flowid,
+        struct.unpack("=I", chain)[0] if chain else 0
+    )
+
+
+def dump(interface, stats=False):
+    """
+    Get the qdiscs, classes and filters of an interface
+
+    :param stats: keep the statistics of the qdiscs and classes. The kernel
+        always sends them, so it costs nothing more.
+    :return: :class:`pyqos.backend.records.Dump`
+    """
+    try:
+        qdiscs = _dump(RTM_GETQDISC, interface)
+        classes = _dump(RTM_GETTCLASS, interface)
+        filters = _dump(RTM_GETTFILTER, interface)
+    except OSError as e:
+        _logger.warning("Cannot read the tc rules of %s: %s", interface, e)
+        return Dump(interface)
+    qdiscs = (_decode_qdisc(interface, *q) for q in qdiscs)
+    classes = (_decode_class(interface, *c) for c in classes)
+    filters = (_decode_filter(interface, *f) for f in filters)
+    if not stats:
+        qdiscs = (q._replace(stats=None) for q in qdiscs)
+        classes = (c._replace(stats=None) for c in classes)
+    return Dump(
+        interface, qdiscs=qdiscs, classes=classes,
+        filters=without_list_heads(filters),
+    )
+
+
+def dumps(interface=None, stats=False):
+    """
+    Get the qdiscs, classes and filters of several interfaces
+
+    :param interface: target interface, list of interfaces, or None for all
+        interfaces
+    :param stats: keep the statistics of the qdiscs and classes
+    :return: list of :class:`pyqos.backend.records.Dump`
+    """
+    return [dump(i, stats) for i in tools.interface_names(interface)]
+
+
+def qdisc_show(interface=None):
+    """
+    Get the qdiscs with their statistics
+
+    :param interface: target interface, list of interfaces, or None for all
+        interfaces (default: None)
+    :return: list of :class:`pyqos.backend.records.QDiscRecord`
+    """
+    return [q for d in dumps(interface, stats=True) for q in d.qdiscs.values()]
+
+
+@multiple_interfaces
+def qos_class(interface, action, parent, classid=None, algorithm="htb",
+              dryrun=False, *args, **kwargs):
+    """
+    Add/change/replace/replace class
+
+    **kwargs will be used for specific arguments, depending on the algorithm
+    used.
+    Parameters need to be in kbit. If the unit isn't indicated, add it
+    automagically
+
+    :param action: "add", "replace", "change" or "delete"
+    :param interface: target interface
+    :param parent: parent class/qdisc
+    :param classid: id for the current class (default: None)
+    :param algorithm: algorithm used for this class (default: htb)
+    """
+    if algorithm != "htb":
+        raise BadAttributeValueException(
+            "Class {} is not supported by the netlink backend".format(
+                algorithm
+            )
+        )
+    kwargs = {i: j for i, j in kwargs.items() if j is not None}
+    for key, unit in (("rate", "kbit"), ("ceil", "kbit"), ("burst", "k"),
+                      ("cburst", "k")):
+        if key in kwargs:
+            try:
+                kwargs[key] = str(int(kwargs[key])) + unit
+            except ValueError:
+                pass
+    payload = tcmsg(
+        get_ifindex(interface),
+        handle=parse_classid(classid) if classid is not None else 0,
+        parent=parse_classid(parent)
+    ) + attr_str(TCA_KIND, algorithm)
+    if action != "delete":
+        try:
+            payload += attr(TCA_OPTIONS, _htb_class_options(**kwargs))
+        except TypeError as e:
+            raise BadAttributeValueException(str(e))
+    description = _describe(
+        "class", action, "dev", interface, "parent", parent,
+        *(["classid", classid] if classid is not None else []),
+        algorithm, **kwargs
+    )
+    _send(RTM_DELTCLASS if action == "delete" else RTM_NEWTCLASS,
+          _action_flags(action), payload, description, dryrun)
+
+
+@multiple_interfaces
+def qos_class_add(interface, parent, classid, algorithm="htb", **kwargs):
+    """
+    Add class
+
+    :param interface: target interface
+    :param parent: parent class/qdisc
+    :param classid: id for the current class (default: None)
+    :param algorithm: algorithm used for this class (default: htb)
+    """
+    return qos_class(interface, "add", parent, classid, algorithm, **kwargs)
+
+
+@multiple_interfaces
+def qos_class_del(interface, parent, classid=None, algorithm="htb", **kwargs):
+    """
+    Delete class
+
+    :param interface: target interface
+    :param parent: parent class/qdisc
+    :param classid: id for the current class (default: None)
+    :param algorithm: algorithm used for this class (default: htb)
+    """
+    return qos_class(interface, "delete", parent, classid, algorithm, **kwargs)
+
+
+def qos_class_show(interface):
+    """
+    Get the classes with their statistics
+
+    :param interface: target interface, or list of interfaces
+    :return: list of :class:`pyqos.backend.records.ClassRecord`
+    """
+    return [c for d in dumps(interface, stats=True)
+            for c in d.classes.values()]
+
+
+@multiple_interfaces
+def filter(interface, action, prio, handle=None, flowid=None, parent=None,
+           protocol="all", dryrun=False, *args, **kwargs):
+    """
+    Add/change/replace/delete filter
+
+    :param action: "add", "replace", "change" or "delete"
+    :param interface: target interface
+    :param prio: priority
+    :param handle: filter id. Without handle and flowid, the fw filter uses
+        the marks of the packets as classids.
+    :param flowid: target class
+    :param parent: parent class/qdisc (default: None)
+    :param protocol: protocol to filter. (default: "all")
+    """
+    kind = kwargs.pop("kind", "fw")
+    chain = kwargs.pop("chain", None)
+    goto_chain = kwargs.pop("goto_chain", None)
+    try:
+        eth_protocol = PROTOCOLS[protocol]
+    except KeyError:
+        raise BadAttributeValueException("Unknown protocol: " + protocol)
+    try:
+        encoder = FILTER_OPTIONS[kind]
+    except KeyError:
+        raise BadAttributeValueException(
+            "Filter {} is not supported by the netlink backend".format(kind)
+        )
+    if handle is None:
+        handle_id = 0
+    elif kind == "u32":
+        handle_id = parse_u32_handle(handle)
+    else:
+        handle_id = int(str(handle), 0)
+    payload = tcmsg(
+        get_ifindex(interface), handle=handle_id,
+        parent=parse_classid(parent) if parent is not None else TC_H_ROOT,
+        info=int(prio) << 16 | socket.htons(eth_protocol)
+    ) + attr_str(TCA_KIND, kind)
+    if chain:
+        payload += attr_u32(TCA_CHAIN, int(chain))
+    if action != "delete":
+        options_kwargs = kwargs
+        if kind == "flower":
+            # flower matches the protocol of the filter as a key
+            options_kwargs = dict(kwargs, eth_type=eth_protocol)
+        elif kind == "u32" and goto_chain is not None:
+            options_kwargs = dict(kwargs, terminal=True)
+        try:
+            options = encoder(flowid, **options_kwargs)
+        except TypeError as e:
+            raise BadAttributeValueException(str(e))
+        if goto_chain is not None:
+            options = (options or b"") + attr(
+                FILTER_ACTIONS[kind], _goto_chain_action(goto_chain)
+            )
+        if options is not None:
+            payload += attr(TCA_OPTIONS, options)
+    description = _describe(
+        "filter", action, "dev", interface,
+        *(["parent", parent] if parent is not None else []),
+        "protocol", protocol, "prio", prio,
+        *(["handle", handle] if handle is not None else []), kind,
+        *(["flowid", flowid] if flowid is not None else []),
+        *(["chain", chain] if chain else []),
+        *(["goto_chain", goto_chain] if goto_chain is not None else []),
+        **kwargs
+    )
+    _send(RTM_DELTFILTER if action == "delete" else RTM_NEWTFILTER,
+          _action_flags(action), payload, description, dryrun)
+
+
+@multiple_interfaces
+def filter_add(interface, parent, prio, handle, flowid, protocol="all",
+               *args, **kwargs):
+    """
+    Add filter
+
+    :param interface: target interface
+    :param parent: parent class/qdisc
+    :param prio: priority
+    :param handle: filter id
+    :param flowid: target class
+    :param protocol: protocol to filter (default: "all")
+    """
+    filter(interface, "add", prio, handle, flowid, parent, protocol,
+           *args, **kwargs)
+
+
+@multiple_interfaces
+def filter_del(interface, prio, handle, flowid, parent=None, protocol="all",
+               *args, **kwargs):
+    """
+    Delete filter
+
+    :param interface: target interface
+    :param prio: priority
+    :param handle: filter id
+    :param flowid: target class
+    :param parent: parent class/qdisc (default: None)
+    :param protocol: protocol to filter (default: "all")
+    """
+    filter(interface, "delete", prio, handle, flowid, parent, protocol,
+           *args, **kwargs)
+
+
+def filter_show(interface):
+    """
+    Get the filters
+
+    :param interface: target interface, or list of interfaces
+    :return: list of :class:`pyqos.backend.records.FilterRecord`
+    """
+    return [f for d in dumps(interface) for f in d.filters]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Records describing the qdiscs, classes and filters set on an interface
+
+from collections import namedtuple, OrderedDict
+
+#: statistics of a qdisc or a class. backlog is in Bytes, qlen in packets.
+#: tokens and ctokens are only set for htb classes, in scheduler ticks.
+Stats = namedtuple(
+    "Stats", (
+        "bytes", "packets", "drops", "overlimits", "requeues", "backlog",
+        "qlen", "tokens", "ctokens"
+    )
+)
+Stats.__new__.__defaults__ = (0, ) * 7 + (None, None)
+
+#: qdisc set on an interface. Handles are formatted as tc prints them ("1:"),
+#: parent is "root" for the root qdisc. Options depends on the qdisc kind.
+#: stats is a :class:`Stats`, if they have been read.
+QDiscRecord = namedtuple(
+    "QDiscRecord",
+    ("interface", "kind", "handle", "parent", "options", "stats")
+)
+QDiscRecord.__new__.__defaults__ = (None, )
+
+#: class set on an interface. Rates are in bit/s, bursts in Bytes. leaf is
+#: the handle of the qdisc attached to the class, if any. stats is a
+#: :class:`Stats`, if they have been read.
+ClassRecord = namedtuple(
+    "ClassRecord", (
+        "interface", "kind", "classid", "parent", "leaf", "rate", "ceil",
+        "burst", "cburst", "prio", "quantum", "stats"
+    )
+)
+ClassRecord.__new__.__defaults__ = (None, )
+
+#: filter set on an interface. handle is the mark for a fw filter, None for
+#: a filter without rules (like a fw filter using the marks as classids).
+#: chain is the filter chain holding the filter, 0 by default.
+FilterRecord = namedtuple(
+    "FilterRecord", (
+        "interface", "kind", "parent", "protocol", "prio", "handle", "flowid",
+        "chain"
+    )
+)
+FilterRecord.__new__.__defaults__ = (0, )
+
+
+def without_list_heads(records):
+    """
+    Remove the heads of the filter lists which have rules
+
+    The kernel lists a head for each filter priority, then its rules. A head
+    without rules is kept, as it filters the packets by itself.
+
+    :param records: iterable of records
+    :return: list of records
+    """
+    records = list(records)
+    with_rules = set(
+        (r.interface, r.parent, r.chain, r.prio) for r in records
+        if isinstance(r, FilterRecord) and r.handle is not None
+    )
+    return [r for r in records
+            if not isinstance(r, FilterRecord) or r.handle is not None or
+            (r.interface, r.parent, r.chain, r.prio) not in with_rules]
+
+
+class Dump():
+    """
+    State of the qdiscs, classes and filters of an interface
+    """
+    def __init__(self, interface, qdiscs=(), classes=(), filters=()):
+        self.interface = interface
+        #: qdiscs, by parent ("root" for the root qdisc)
+        self.qdiscs = OrderedDict((q.parent, q) for q in qdiscs)
+        #: classes, by classid
+        self.classes = OrderedDict((c.classid, c) for c in classes)
+        #: filters, in the kernel order
+        self.filters = list(filters)
+
+    @property
+    def root(self):
+        """
+        Root qdisc, or None if the interface uses the default one
+        """
+        root = self.qdiscs.get("root")
+        if root is None or root.handle in ("0:", "root"):
+            return None
+        return root
+
+
+def format_record(record):
+    """
+    Format a record like tc prints it
+
+    :return: list of lines, the second one being the statistics if any
+    """
+    if isinstance(record, FilterRecord):
+        line = ["filter", "parent", record.parent, "protocol",
+                str(record.protocol), "pref", str(record.prio), record.kind]
+        if record.chain:
+            line += ["chain", str(record.chain)]
+        if record.handle is not None:
+            line += ["handle", hex(record.handle)
+                     if isinstance(record.handle, int) else str(record.handle)]
+        if record.flowid:
+            line += ["classid", record.flowid]
+    elif isinstance(record, ClassRecord):
+        line = ["class", record.kind, record.classid, "parent", record.parent]
+        if record.leaf:
+            line += ["leaf", record.leaf]
+        if record.rate is not None:
+            line += ["rate", "{}bit".format(record.rate),
+                     "ceil", "{}bit".format(record.ceil)]
+    else:
+        line = ["qdisc", record.kind, record.handle]
+        line += (["root"] if record.parent == "root"
+                 else ["parent", record.parent])
+    lines = [" ".join(line + ["dev", record.interface])]
+
+    stats = getattr(record, "stats", None)
+    if stats is not None:
+        line = (" Sent {s.bytes} bytes {s.packets} pkt (dropped {s.drops}, "
+                "overlimits {s.overlimits} requeues {s.requeues}) backlog "
+                "{s.backlog}b {s.qlen}p".format(s=stats))
+        if stats.tokens is not None:
+            line += " tokens {s.tokens} ctokens {s.ctokens}".format(s=stats)
+        lines.append(line)
+    return lines
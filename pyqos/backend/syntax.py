@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Parsing of the tc syntax
+
+from pyqos.exceptions import BadAttributeValueException
+
+TC_H_ROOT = 0xFFFFFFFF
+TC_H_UNSPEC = 0
+
+#: ethernet protocols, as understood by tc
+PROTOCOLS = {
+    "all": 0x0003, "ip": 0x0800, "ipv6": 0x86DD, "arp": 0x0806,
+    "802.1q": 0x8100, "802.1ad": 0x88A8,
+}
+
+#: IP protocols understood by the flower classifier
+IP_PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17, "icmpv6": 58, "sctp": 132}
+
+#: keys matched by the flower classifier, in the order tc expects them
+FLOWER_KEYS = ("ip_proto", "src_ip", "dst_ip", "src_port", "dst_port",
+               "ip_tos")
+
+#: DiffServ code points, by class name
+DSCP_CLASSES = dict(
+    {"be": 0, "ef": 46, "va": 44, "le": 1},
+    **{"cs{}".format(i): i << 3 for i in range(8)},
+    **{"af{}{}".format(i, j): i << 3 | j << 1
+       for i in range(1, 5) for j in range(1, 4)}
+)
+
+#: rate units, in bit/s (tc matches them case insensitively)
+RATE_UNITS = {
+    "bit": 1, "kibit": 1024, "kbit": 1000, "mibit": 1024**2, "mbit": 10**6,
+    "gibit": 1024**3, "gbit": 10**9, "tibit": 1024**4, "tbit": 10**12,
+    "bps": 8, "kibps": 8 * 1024, "kbps": 8000, "mibps": 8 * 1024**2,
+    "mbps": 8 * 10**6, "gibps": 8 * 1024**3, "gbps": 8 * 10**9,
+    "tibps": 8 * 1024**4, "tbps": 8 * 10**12,
+}
+
+#: size units, in bytes
+SIZE_UNITS = {
+    "": 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024**2, "mb": 1024**2,
+    "g": 1024**3, "gb": 1024**3, "kbit": 1024 / 8, "mbit": 1024**2 / 8,
+    "gbit": 1024**3 / 8,
+}
+
+#: time units, in µs
+TIME_UNITS = {
+    "": 1, "s": 10**6, "sec": 10**6, "secs": 10**6, "ms": 1000,
+    "msec": 1000, "msecs": 1000, "us": 1, "usec": 1, "usecs": 1,
+    "ns": 0.001,
+}
+
+
+def _split_unit(value):
+    """
+    Split a tc value like "400kbit" in (400.0, "kbit")
+    """
+    value = str(value).strip()
+    index = len(value)
+    while index and value[index - 1] not in "0123456789.":
+        index -= 1
+    try:
+        return float(value[:index]), value[index:].lower()
+    except ValueError:
+        raise BadAttributeValueException("Invalid value: " + value)
+
+
+def _parse_with_units(value, units, kind):
+    number, unit = _split_unit(value)
+    try:
+        return number * units[unit]
+    except KeyError:
+        raise BadAttributeValueException(
+            "Unknown {} unit in \"{}\"".format(kind, value)
+        )
+
+
+def parse_rate(rate):
+    """
+    Parse a tc rate, like "400kbit"
+
+    :return: rate in Bytes/s
+    """
+    units = dict(RATE_UNITS, **{"": 1})
+    return int(_parse_with_units(rate, units, "rate") / 8)
+
+
+def parse_size(size):
+    """
+    Parse a tc size, like "100k"
+
+    :return: size in Bytes
+    """
+    return int(_parse_with_units(size, SIZE_UNITS, "size"))
+
+
+def parse_time(time):
+    """
+    Parse a tc time, like "5ms"
+
+    :return: time in µs
+    """
+    return int(_parse_with_units(time, TIME_UNITS, "time"))
+
+
+def parse_classid(classid):
+    """
+    Parse a classid the same way than tc: "major:minor", both in hexadecimal
+
+    :return: classid as an integer
+    """
+    classid = str(classid)
+    if classid == "root":
+        return TC_H_ROOT
+    if classid == "none":
+        return TC_H_UNSPEC
+    major, sep, minor = classid.partition(":")
+    try:
+        major = int(major, 16) if major else 0
+        if not sep:
+            return major
+        minor = int(minor, 16) if minor else 0
+    except ValueError:
+        raise BadAttributeValueException("Invalid classid: " + classid)
+    if major >= 1 << 16 or minor >= 1 << 16:
+        raise BadAttributeValueException("Classid out of range: " + classid)
+    return major << 16 | minor
+
+
+def parse_qdisc_handle(handle):
+    """
+    Parse a qdisc handle the same way than tc: "major:" or "major", in
+    hexadecimal
+
+    :return: handle as an integer
+    """
+    handle = str(handle)
+    if handle == "none":
+        return TC_H_UNSPEC
+    major = handle[:-1] if handle.endswith(":") else handle
+    try:
+        major = int(major, 16)
+    except ValueError:
+        raise BadAttributeValueException("Invalid qdisc handle: " + handle)
+    if major >= 1 << 16:
+        raise BadAttributeValueException("Handle out of range: " + handle)
+    return major << 16
+
+
+def parse_u32_handle(handle):
+    """
+    Parse a u32 handle the same way than tc: "htid:hash:node", each part in
+    hexadecimal and optional
+
+    :return: handle as an integer
+    """
+    handle = str(handle)
+    parts = handle.split(":")
+    limits = (0x1000, 0x100, 0x1000)
+    if len(parts) > 3:
+        raise BadAttributeValueException("Invalid u32 handle: " + handle)
+    result = 0
+    for part, limit, shift in zip(parts, limits, (20, 12, 0)):
+        try:
+            value = int(part, 16) if part else 0
+        except ValueError:
+            raise BadAttributeValueException("Invalid u32 handle: " + handle)
+        if value >= limit:
+            raise BadAttributeValueException(
+                "u32 handle out of range: " + handle
+            )
+        result |= value << shift
+    return result
+
+
+def parse_dscp(dscp):
+    """
+    Parse a DiffServ code point: a class name like "EF" or "AF41", or a
+    number
+
+    :return: code point, on 6 bits
+    """
+    name = str(dscp).lower()
+    try:
+        value = DSCP_CLASSES[name] if name in DSCP_CLASSES else int(name, 0)
+    except ValueError:
+        raise BadAttributeValueException("Invalid DSCP: " + str(dscp))
+    if not 0 <= value < 64:
+        raise BadAttributeValueException("DSCP out of range: " + str(dscp))
+    return value
+
+
+def format_tos_match(dscp):
+    """
+    Format the match of a DiffServ code point on the TOS byte, as the flower
+    ip_tos option: "value/mask", ignoring the ECN bits
+    """
+    return "0x{:02x}/0xfc".format(parse_dscp(dscp) << 2)
+
+
+def format_u32_handle(handle):
+    """
+    Format a u32 handle as tc prints it: "htid:hash:node", without the null
+    parts ("800:" for a table, "800::800" for a rule in the bucket 0)
+    """
+    htid, bucket, node = handle >> 20, (handle >> 12) & 0xFF, handle & 0xFFF
+    result = "{:x}:".format(htid) if htid else ""
+    if bucket:
+        result += "{:x}".format(bucket)
+    if bucket or node:
+        result += ":"
+    if node:
+        result += "{:x}".format(node)
+    return result
+
+
+def format_handle(handle):
+    """
+    Format a handle or classid as tc prints it
+    """
+    if handle == TC_H_ROOT:
+        return "root"
+    major, minor = handle >> 16, handle & 0xFFFF
+    return "{:x}:{:x}".format(major, minor) if minor else "{:x}:".format(major)
+
+
+def protocol_name(protocol):
+    """
+    Return the name of an ethernet protocol number, as tc prints it
+    """
+    for name, number in PROTOCOLS.items():
+        if number == protocol:
+            return name
+    return "{:04x}".format(protocol)
@@ -1,26 +1,144 @@
 #!/usr/bin/env python3
 # Author: Anthony Ruhier
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import re
+import subprocess
+
+from pyqos import tools
 from pyqos.tools import launch_command
 from pyqos.decorators import multiple_interfaces
+from pyqos.exceptions import BadAttributeValueException
+from . import syntax
+from .records import (
+    ClassRecord, Dump, FilterRecord, QDiscRecord, Stats, without_list_heads
+)
 
+_logger = logging.getLogger(__name__)
 
-@multiple_interfaces
-def qdisc(interface, action, algorithm=None, handle=None, parent=None,
-          stderr=None, dryrun=False, opts_args=None, **kwargs):
+
+class Batch():
     """
-    Add/change/replace/replace qdisc
+    Queue of tc commands, flushed through one "tc -force -batch -" process
+    per interface
 
-    **kwargs will be used for specific arguments, depending on the algorithm
-    used.
+    Each queued command keeps the object that generated it, so a failing line
+    can be reported with the node of the tree it comes from.
+    """
+    #: regex matching the lines printed by tc for each failing command
+    _failed_line_re = re.compile(r"^Command failed -:(\d+)$")
+    #: number of commands queued for an interface before they are launched,
+    #: to bound the memory used by big plans
+    max_queued = 10000
+
+    def __init__(self, dryrun=False):
+        self.dryrun = dryrun
+        #: queued commands, by interface. Each item is a tuple
+        #: ``(command, origin, stderr)``
+        self.queues = OrderedDict()
+        #: failures of the commands already launched, since the last flush
+        self._failed = []
+
+    def accepts(self, command):
+        """
+        Check if a command can be queued: only tc commands modifying the
+        qdiscs, classes or filters of an interface are batched
+        """
+        return (
+            len(command) > 4 and command[0] == "tc" and
+            command[1] in ("qdisc", "class", "filter") and
+            command[2] != "show" and "dev" in command
+        )
+
+    def add(self, command, origin=None, stderr=None):
+        """
+        Queue a command
+
+        :param command: tc command, as a list
+        :param origin: object which generated the command
+        :param stderr: if subprocess.DEVNULL, a failure of this command will
+            be ignored
+        """
+        interface = command[command.index("dev") + 1]
+        queue = self.queues.setdefault(interface, [])
+        queue.append((command, origin, stderr))
+        if len(queue) >= self.max_queued:
+            self._failed.extend(self._flush_queue(interface, queue))
+            self.queues[interface] = []
+
+    def flush(self):
+        """
+        Launch all queued commands, one tc process per interface
+
+        :return: list of failed commands since the last flush, as tuples
+            ``(command, origin, error message)``
+        """
+        failed, self._failed = self._failed, []
+        for interface, queue in self.queues.items():
+            failed.extend(self._flush_queue(interface, queue))
+        self.queues.clear()
+        return failed
+
+    def _flush_queue(self, interface, queue):
+        lines = [" ".join(command[1:]) for command, _, _ in queue]
+        for line in lines:
+            _logger.debug("tc " + line)
+        if self.dryrun or not lines:
+            return []
+        process = subprocess.run(
+            ["tc", "-force", "-batch", "-"], input="\n".join(lines) + "\n",
+            stderr=subprocess.PIPE, universal_newlines=True
+        )
+        failed = []
+        message = []
+        for err_line in process.stderr.splitlines():
+            match = self._failed_line_re.match(err_line)
+            if match is None:
+                message.append(err_line)
+                continue
+            command, origin, stderr = queue[int(match.group(1)) - 1]
+            if stderr != subprocess.DEVNULL:
+                failed.append((command, origin, " ".join(message)))
+                _logger.error(
+                    "%s (generated by %r): %s", " ".join(command), origin,
+                    " ".join(message)
+                )
+            message = []
+        return failed
+
+
+@contextmanager
+def batch(dryrun=False):
+    """
+    Queue all tc commands launched in this context and flush them at its exit
 
-    :param action: "add", "replace", "change" or "delete"
-    :param interface: target interface
-    :param algorithm: algorithm used for this leaf (htb, pfifo, sfq, ...)
-    :param handle: handle parameter for tc (default: None)
-    :param parent: if is None, the rule will be added as root. (default: None)
-    :param stderr: indicates stderr to use during the tc commands execution
-    :param opts_args: list of options without value, to append to the command
+    If a batch is already active, commands are queued in it and will be
+    flushed by the outer context.
+
+    :param dryrun: only prints the queued commands during the flush
+    """
+    current = tools.get_batch()
+    if current is not None:
+        yield current
+        return
+    command_batch = Batch(dryrun=dryrun)
+    tools.set_batch(command_batch)
+    try:
+        yield command_batch
+    finally:
+        tools.set_batch(None)
+    command_batch.flush()
+
+
+def qdisc_command(interface, action, algorithm=None, handle=None, parent=None,
+                  opts_args=None, **kwargs):
+    """
+    Build a qdisc command. See :func:`qdisc` for the parameters.
+
+    :return: the tc command, as a list
     """
     opts_args = opts_args or []
     command = ["tc", "qdisc", action, "dev", interface]
@@ -36,7 +154,28 @@ def qdisc(interface, action, algorithm=None, handle=None, parent=None,
         if j is not None:
             command += [str(i), str(j)]
     command.extend(sorted(opts_args))
+    return command
+
+
+@multiple_interfaces
+def qdisc(interface, action, algorithm=None, handle=None, parent=None,
+          stderr=None, dryrun=False, opts_args=None, **kwargs):
+    """
+    Add/change/replace/replace qdisc
 
+    **kwargs will be used for specific arguments, depending on the algorithm
+    used.
+
+    :param action: "add", "replace", "change" or "delete"
+    :param interface: target interface
+    :param algorithm: algorithm used for this leaf (htb, pfifo, sfq, ...)
+    :param handle: handle parameter for tc (default: None)
+    :param parent: if is None, the rule will be added as root. (default: None)
+    :param stderr: indicates stderr to use during the tc commands execution
+    :param opts_args: list of options without value, to append to the command
+    """
+    command = qdisc_command(interface, action, algorithm, handle, parent,
+                            opts_args, **kwargs)
     launch_command(command, stderr, dryrun)
 
 
@@ -81,51 +220,30 @@ def qdisc_del(interface, algorithm=None, handle=None, parent=None, *args,
     )
 
 
-@multiple_interfaces
-def qdisc_show(interface=None, show_format=None, dryrun=False):
-    """
-    Show qdiscs
-
-    :param show_format: option "FORMAT" for tc. (default: None)
-        "stats" -> -s
-        "details" -> -d
-        "raw" -> -r
-        "pretty" -> -p
-        "iec" -> -i
-    :param interface: target interface (default: None)
-    """
-    formats = {"stats": "-s", "details": "-d", "raw": "-r", "pretty": "-p",
-               "iec": "-i"}
-    correct_format = formats.get(show_format, None)
-    command = ["tc"]
-    if show_format is not None:
-        command.append(correct_format)
-    command += ["qdisc", "show"]
-    if interface is not None:
-        command += ["dev", interface]
-    launch_command(command, dryrun=dryrun)
-
+def qdisc_show(interface=None):
+    """
+    Get the qdiscs with their statistics
 
-@multiple_interfaces
-def qos_class(interface, action, parent, classid=None, algorithm="htb",
-              dryrun=False, *args, **kwargs):
+    :param interface: target interface, list of interfaces, or None for all
+        interfaces (default: None)
+    :return: list of :class:`pyqos.backend.records.QDiscRecord`
     """
-    Add/change/replace/replace class
+    return [q for d in dumps(interface, stats=True) for q in d.qdiscs.values()]
 
-    **kwargs will be used for specific arguments, depending on the algorithm
-    used.
-    Parameters need to be in kbit. If the unit isn't indicated, add it
-    automagically
 
-    :param action: "add", "replace", "change" or "delete"
-    :param interface: target interface
-    :param parent: parent class/qdisc
-    :param classid: id for the current class (default: None)
-    :param algorithm: algorithm used for this class (default: htb)
+def qos_class_command(interface, action, parent, classid=None,
+                      algorithm="htb", **kwargs):
+    """
+    Build a class command. See :func:`qos_class` for the parameters.
+
+    :return: the tc command, as a list
     """
     command = ["tc", "class", action, "dev", interface, "parent", parent]
     if classid is not None:
         command += ["classid", classid]
+    if action == "delete":
+        # tc would require all the mandatory options of the algorithm
+        return command
     command.append(algorithm)
     if algorithm == "htb":
         for key in ("rate", "ceil"):
@@ -143,6 +261,28 @@ def qos_class(interface, action, parent, classid=None, algorithm="htb",
     for i, j in sorted(kwargs.items()):
         if j is not None:
             command += [str(i), str(j)]
+    return command
+
+
+@multiple_interfaces
+def qos_class(interface, action, parent, classid=None, algorithm="htb",
+              dryrun=False, *args, **kwargs):
+    """
+    Add/change/replace/replace class
+
+    **kwargs will be used for specific arguments, depending on the algorithm
+    used.
+    Parameters need to be in kbit. If the unit isn't indicated, add it
+    automagically
+
+    :param action: "add", "replace", "change" or "delete"
+    :param interface: target interface
+    :param parent: parent class/qdisc
+    :param classid: id for the current class (default: None)
+    :param algorithm: algorithm used for this class (default: htb)
+    """
+    command = qos_class_command(interface, action, parent, classid,
+                                algorithm, **kwargs)
     launch_command(command, dryrun=dryrun)
 
 
@@ -182,31 +322,105 @@ def qos_class_del(interface, parent, classid=None, algorithm="htb", **kwargs):
     return qos_class(interface, "delete", parent, classid, algorithm, **kwargs)
 
 
-@multiple_interfaces
-def qos_class_show(interface, show_format=None, dryrun=False):
+def qos_class_show(interface):
     """
-    Show classes
+    Get the classes with their statistics
 
-    :param interface: target interface
-    :param show_format: option "FORMAT" for tc. (default: None)
-        "stats" -> -s
-        "details" -> -d
-        "raw" -> -r
-        "pretty" -> -p
-        "iec" -> -i
-    """
-    formats = {"stats": "-s", "details": "-d", "raw": "-r", "pretty": "-p",
-               "iec": "-i"}
-    correct_format = formats.get(show_format, None)
-    command = ["tc"]
-    if show_format is not None:
-        command.append(correct_format)
-    command += ["class", "show", "dev", interface]
-    launch_command(command, dryrun=dryrun)
+    :param interface: target interface, or list of interfaces
+    :return: list of :class:`pyqos.backend.records.ClassRecord`
+    """
+    return [c for d in dumps(interface, stats=True)
+            for c in d.classes.values()]
+
+
+def _u32_filter_options(divisor=None, ht=None, match=(), hashkey=None,
+                        link=None):
+    """
+    Options of a u32 filter, in the order tc expects them
+
+    :param match: list of keys (value, mask, offset), compared to the 32 bits
+        at offset in the network header
+    :param hashkey: (mask, offset) of the 32 bits used to select the bucket
+        of the linked table
+    """
+    options = []
+    if divisor is not None:
+        options += ["divisor", str(divisor)]
+    if ht is not None:
+        options += ["ht", ht]
+    for value, mask, offset in match:
+        options += ["match", "u32", "0x{:08x}".format(value),
+                    "0x{:08x}".format(mask), "at", str(offset)]
+    if hashkey is not None:
+        mask, offset = hashkey
+        options += ["hashkey", "mask", "0x{:08x}".format(mask), "at",
+                    str(offset)]
+    if link is not None:
+        options += ["link", link]
+    return options
+
+
+def _flower_filter_options(**keys):
+    """
+    Options of a flower filter, in the order tc expects them: the ports need
+    the IP protocol to be set before
+
+    :param keys: values of the keys of :data:`pyqos.backend.syntax.FLOWER_KEYS`
+        to match: ``ip_proto`` ("tcp", "udp", "sctp", "icmp", "icmpv6" or a
+        number), ``src_ip`` and ``dst_ip`` (address or network), ``src_port``
+        and ``dst_port`` (need ``ip_proto``), ``ip_tos`` ("value/mask")
+    """
+    unknown = set(keys).difference(syntax.FLOWER_KEYS)
+    if unknown:
+        raise BadAttributeValueException(
+            "Unknown flower keys: " + ", ".join(sorted(unknown))
+        )
+    options = []
+    for key in syntax.FLOWER_KEYS:
+        if keys.get(key) is not None:
+            options += [key, str(keys[key])]
+    return options
+
+
+#: builders of the options of the filters, by kind. Options of other kinds
+#: are passed as "key value".
+FILTER_OPTIONS = {"u32": _u32_filter_options,
+                  "flower": _flower_filter_options}
+
+
+def filter_command(interface, action, prio, handle=None, flowid=None,
+                   parent=None, protocol="all", kind="fw", chain=None,
+                   goto_chain=None, **kwargs):
+    """
+    Build a filter command. See :func:`filter` for the parameters.
+
+    :return: the tc command, as a list
+    """
+    command = ["tc", "filter", action, "dev", interface]
+    if parent is not None:
+        command += ["parent", parent]
+    command += ["protocol", protocol, "prio", str(prio)]
+    if handle is not None:
+        command += ["handle", str(handle)]
+    if chain:
+        command += ["chain", str(chain)]
+    command.append(kind)
+    if kind in FILTER_OPTIONS:
+        command += FILTER_OPTIONS[kind](**kwargs)
+        kwargs = {}
+    if flowid is not None:
+        command += ["flowid", str(flowid)]
+    for i, j in sorted(kwargs.items()):
+        if j is not None:
+            command += [str(i), str(j)]
+    if goto_chain is not None:
+        # the actions end the options of the filter
+        command += ["action", "goto", "chain", str(goto_chain)]
+    return command
 
 
 @multiple_interfaces
-def filter(interface, action, prio, handle, flowid, parent=None,
+def filter(interface, action, prio, handle=None, flowid=None, parent=None,
            protocol="all", dryrun=False, *args, **kwargs):
     """
     Add/change/replace/delete filter
@@ -217,19 +431,18 @@ def filter(interface, action, prio, handle, flowid, parent=None,
     :param action: "add", "replace", "change" or "delete"
     :param interface: target interface
     :param prio: priority
-    :param handle: filter id
+    :param handle: filter id. Without handle and flowid, the fw filter uses
+        the marks of the packets as classids.
     :param flowid: target class
     :param parent: parent class/qdisc (default: None)
     :param protocol: protocol to filter. (default: "all")
+    :param kind: classifier: "fw" (default), "u32" or "flower"
+    :param chain: filter chain holding the filter (default: 0)
+    :param goto_chain: continue the classification in this chain when the
+        filter matches, instead of sending the packets to flowid
     """
-    command = ["tc", "filter", action, "dev", interface]
-    if parent is not None:
-        command += ["parent", parent]
-    command += ["protocol", protocol, "prio", str(prio), "handle", str(handle),
-                "fw", "flowid", str(flowid)]
-    for i, j in sorted(kwargs.items()):
-        if j is not None:
-            command += [str(i), str(j)]
+    command = filter_command(interface, action, prio, handle, flowid, parent,
+                             protocol, **kwargs)
     launch_command(command, dryrun=dryrun)
 
 
@@ -273,11 +486,243 @@ def filter_del(interface, prio, handle, flowid, parent=None, protocol="all",
            *args, **kwargs)
 
 
-@multiple_interfaces
-def filter_show(interface, dryrun=False):
+def filter_show(interface):
     """
-    Show filters
+    Get the filters
 
-    :param interface: target interface
+    :param interface: target interface, or list of interfaces
+    :return: list of :class:`pyqos.backend.records.FilterRecord`
+    """
+    return [f for d in dumps(interface) for f in d.filters]
+
+
+def _token_after(tokens, key, default=None):
+    """
+    Return the token following key in a line printed by tc
+    """
+    try:
+        return tokens[tokens.index(key) + 1]
+    except (ValueError, IndexError):
+        return default
+
+
+def _parse_stats_tokens(tokens):
+    """
+    Parse the statistics printed by "tc -s" under a qdisc or a class
+    """
+    def integer(key):
+        value = _token_after(tokens, key)
+        return int(value.rstrip(",)")) if value else 0
+
+    if "Sent" not in tokens:
+        return None
+    backlog = _token_after(tokens, "backlog")
+    tokens_value = _token_after(tokens, "tokens:")
+    ctokens_value = _token_after(tokens, "ctokens:")
+    return Stats(
+        bytes=integer("Sent"), packets=integer("bytes"),
+        drops=integer("(dropped"), overlimits=integer("overlimits"),
+        requeues=integer("requeues"),
+        backlog=syntax.parse_size(backlog) if backlog else 0,
+        qlen=int(tokens[tokens.index("backlog") + 2].rstrip("p"))
+        if backlog else 0,
+        tokens=int(tokens_value) if tokens_value is not None else None,
+        ctokens=int(ctokens_value) if ctokens_value is not None else None,
+    )
+
+
+def _parse_json_stats(obj):
+    """
+    Parse the statistics of an object printed by "tc -j -s"
+    """
+    if "bytes" not in obj:
+        return None
+    xstats = obj.get("xstats", {})
+    return Stats(
+        *(obj.get(key, 0) for key in Stats._fields[:7]),
+        tokens=xstats.get("tokens"), ctokens=xstats.get("ctokens")
+    )
+
+
+def _parse_qdisc_line(interface, tokens):
+    options = {}
+    for i in range(4, len(tokens) - 1, 2):
+        options[tokens[i]] = tokens[i + 1]
+    if "root" in tokens:
+        parent = "root"
+    else:
+        parent = syntax.format_handle(
+            syntax.parse_classid(_token_after(tokens, "parent"))
+        )
+    return QDiscRecord(interface, tokens[1], tokens[2], parent, options)
+
+
+def _parse_class_line(interface, tokens):
+    classid = tokens[2]
+    parent = _token_after(tokens, "parent")
+    if parent is None:
+        parent = classid.split(":")[0] + ":"
+    rate = _token_after(tokens, "rate")
+    ceil = _token_after(tokens, "ceil")
+    burst = _token_after(tokens, "burst")
+    cburst = _token_after(tokens, "cburst")
+    prio = _token_after(tokens, "prio")
+    quantum = _token_after(tokens, "quantum")
+    return ClassRecord(
+        interface, tokens[1], classid, parent, _token_after(tokens, "leaf"),
+        syntax.parse_rate(rate) * 8 if rate else None,
+        syntax.parse_rate(ceil) * 8 if ceil else None,
+        syntax.parse_size(burst.split("/")[0]) if burst else None,
+        syntax.parse_size(cburst.split("/")[0]) if cburst else None,
+        int(prio) if prio is not None else None,
+        int(quantum) if quantum is not None else None
+    )
+
+
+def _parse_filter_line(interface, tokens):
+    # the head of a filter list has no handle
+    handle = _token_after(tokens, "handle") or _token_after(tokens, "fh")
+    prio = _token_after(tokens, "pref")
+    kind = tokens[tokens.index("pref") + 2] if prio is not None else None
+    flowid = _token_after(tokens, "classid") or _token_after(tokens, "flowid")
+    if handle is not None and kind == "fw":
+        handle = int(handle, 0)
+    chain = _token_after(tokens, "chain")
+    return FilterRecord(
+        interface, kind, _token_after(tokens, "parent"),
+        _token_after(tokens, "protocol"), int(prio) if prio else None,
+        handle, flowid, int(chain) if chain else 0
+    )
+
+
+def _parse_json_object(interface, obj):
+    """
+    Convert an object printed by "tc -j" to a record
+    """
+    if "class" in obj:
+        tokens = ["class", obj["class"], obj["handle"]]
+        if not obj.get("root"):
+            tokens += ["parent", obj.get("parent")]
+        for key in ("leaf", "prio", "quantum", "rate", "ceil", "burst",
+                    "cburst"):
+            if key in obj:
+                tokens += [key, str(obj[key]) + (
+                    "bps" if key in ("rate", "ceil") and
+                    isinstance(obj[key], int) else ""
+                )]
+        return _parse_class_line(interface, tokens)._replace(
+            stats=_parse_json_stats(obj)
+        )
+    if "pref" in obj:
+        options = obj.get("options", {})
+        # the head of a filter list has no handle
+        handle = options.get("handle", options.get("fh"))
+        if handle is not None and obj.get("kind") == "fw":
+            handle = int(str(handle), 0)
+        return FilterRecord(
+            interface, obj.get("kind"), obj.get("parent"),
+            obj.get("protocol"), obj.get("pref"), handle,
+            options.get("classid", options.get("flowid")), obj.get("chain", 0)
+        )
+    parent = "root" if obj.get("root") else syntax.format_handle(
+        syntax.parse_classid(obj["parent"])
+    )
+    return QDiscRecord(interface, obj["kind"], obj["handle"], parent,
+                       obj.get("options", {}), _parse_json_stats(obj))
+
+
+def parse_show_output(interface, output):
+    """
+    Parse the output of "tc -j [-s] qdisc/class/filter show". Objects tc
+    cannot print in json yet (like htb classes for some versions) are parsed
+    from their text lines, followed by their indented statistics if any.
+
+    :return: list of records
+    """
+    decoder = json.JSONDecoder()
+    parsers = {"qdisc": _parse_qdisc_line, "class": _parse_class_line,
+               "filter": _parse_filter_line}
+    records = []
+    #: last text line, as [tokens, tokens of its statistics]
+    text_line = None
+    index = 0
+    while index < len(output):
+        if output[index] == "\n":
+            index += 1
+            continue
+        if output[index] == "[":
+            objects, index = decoder.raw_decode(output, index)
+            records.extend(
+                _parse_json_object(interface, obj) for obj in objects
+            )
+            text_line = None
+            continue
+        end = output.find("\n", index)
+        end = len(output) if end == -1 else end
+        line = output[index:end]
+        index = end
+        tokens = line.split()
+        if not tokens:
+            continue
+        if line[0].isspace():
+            if text_line is not None:
+                text_line[1].extend(tokens)
+        elif tokens[0] in parsers:
+            text_line = [tokens, []]
+            records.append(text_line)
+
+    result = []
+    for record in records:
+        if isinstance(record, list):
+            tokens, stats_tokens = record
+            record = parsers[tokens[0]](interface, tokens)
+            if stats_tokens and not isinstance(record, FilterRecord):
+                record = record._replace(
+                    stats=_parse_stats_tokens(stats_tokens)
+                )
+        if record is not None:
+            result.append(record)
+    return without_list_heads(result)
+
+
+def dump(interface, stats=False):
+    """
+    Get the qdiscs, classes and filters of an interface, through one tc
+    process
+
+    :param stats: read the statistics of the qdiscs and classes too
+    :return: :class:`pyqos.backend.records.Dump`
+    """
+    process = subprocess.run(
+        ["tc", "-j", "-d"] + (["-s"] if stats else []) + ["-batch", "-"],
+        universal_newlines=True,
+        input="".join(
+            "{} show dev {}\n".format(kind, interface)
+            for kind in ("qdisc", "class", "filter")
+        ),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        _logger.warning("Cannot read the tc rules of %s: %s", interface,
+                        process.stderr.strip())
+        return Dump(interface)
+    records = parse_show_output(interface, process.stdout)
+    return Dump(
+        interface,
+        qdiscs=[r for r in records if isinstance(r, QDiscRecord)],
+        classes=[r for r in records if isinstance(r, ClassRecord)],
+        filters=[r for r in records if isinstance(r, FilterRecord)],
+    )
+
+
+def dumps(interface=None, stats=False):
+    """
+    Get the qdiscs, classes and filters of several interfaces, with one tc
+    process per interface
+
+    :param interface: target interface, list of interfaces, or None for all
+        interfaces
+    :param stats: read the statistics of the qdiscs and classes too
+    :return: list of :class:`pyqos.backend.records.Dump`
     """
-    launch_command(["tc", "filter", "show", "dev", interface], dryrun=dryrun)
+    return [dump(i, stats) for i in tools.interface_names(interface)]
@@ -27,6 +27,8 @@ class Config(dict):
     def __init__(self, root_path, defaults=None):
         dict.__init__(self, defaults or {})
         self.root_path = root_path or "./"
+        #: files and objects loaded, to load them again with :meth:`reload`
+        self.sources = []
         self.refresh_global_logger_lvl()
 
     def refresh_global_logger_lvl(self):
@@ -46,6 +48,11 @@ class Config(dict):
                        files.
         """
         filename = os.path.join(self.root_path, filename)
+        if ("pyfile", filename, silent) not in self.sources:
+            self.sources.append(("pyfile", filename, silent))
+        return self._load_pyfile(filename, silent)
+
+    def _load_pyfile(self, filename, silent):
         d = types.ModuleType('config')
         d.__file__ = filename
         try:
@@ -56,7 +63,7 @@ class Config(dict):
                 return False
             e.strerror = 'Unable to load configuration file (%s)' % e.strerror
             raise
-        self.from_object(d)
+        self._update_from(d)
         return True
 
     def from_object(self, obj):
@@ -84,10 +91,47 @@ class Config(dict):
         """
         if isinstance(obj, str):
             obj = importlib.import_module(obj)
+        if not any(source[0] == "object" and source[1] is obj
+                   for source in self.sources):
+            self.sources.append(("object", obj))
+        self._update_from(obj)
+
+    def _update_from(self, obj):
         for key in dir(obj):
             if key.isupper():
                 self[key] = getattr(obj, key)
 
+    def files(self):
+        """
+        Files of the sources of the config
+
+        :return: list of paths
+        """
+        files = []
+        for source in self.sources:
+            if source[0] == "pyfile":
+                files.append(source[1])
+            elif getattr(source[1], "__file__", None):
+                files.append(source[1].__file__)
+        return files
+
+    def reload(self):
+        """
+        Load again the files and objects of the config, in the same order
+
+        The modules are reimported. The keys removed from the sources keep
+        their current value.
+        """
+        for source in list(self.sources):
+            if source[0] == "pyfile":
+                self._load_pyfile(source[1], source[2])
+            else:
+                obj = source[1]
+                if isinstance(obj, types.ModuleType):
+                    obj = importlib.reload(obj)
+                self._update_from(obj)
+        self.refresh_global_logger_lvl()
+
 
 class ConfigAttribute(object):
     """
@@ -24,3 +24,4 @@ def multiple_interfaces(f):
             else:
                 f(interface, *args, **kwargs)
     return repeat_for_each_interface
+
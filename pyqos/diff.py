@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Compute the operations to converge the kernel state to the wanted trees
+
+from collections import OrderedDict
+import logging
+
+from pyqos.backend import syntax
+from pyqos.backend.records import Dump
+from pyqos.plan import Operation
+
+_logger = logging.getLogger(__name__)
+
+#: relative tolerance when comparing rates and bursts, as the kernel stores
+#: them with some rounding
+TOLERANCE = 0.02
+
+#: options compared for each qdisc kind, with the function to parse them.
+#: Options not listed here are not compared.
+QDISC_OPTIONS = {
+    "htb": {"default": lambda v: int(str(v), 16), "r2q": int},
+    "sfq": {"perturb": lambda v: int(str(v).rstrip("sec"))},
+    "pfifo": {"limit": lambda v: int(str(v).rstrip("p"))},
+    "fq_codel": {
+        "limit": lambda v: int(str(v).rstrip("p")), "flows": int,
+        "target": syntax.parse_time, "interval": syntax.parse_time,
+        "quantum": syntax.parse_size,
+    },
+    "cake": {"bandwidth": syntax.parse_rate},
+}
+
+#: kinds of classes created by the kernel with their qdisc, never deleted
+KERNEL_CLASSES = ("mq", )
+
+#: default values of the options, when not set
+QDISC_DEFAULTS = {"htb": {"default": 0, "r2q": 10}}
+
+
+def _close(a, b):
+    return abs(a - b) <= TOLERANCE * max(abs(a), abs(b), 1)
+
+
+def _classid(classid):
+    return syntax.format_handle(syntax.parse_classid(classid))
+
+
+def _qdisc_handle(handle):
+    return syntax.format_handle(syntax.parse_qdisc_handle(handle))
+
+
+def _class_values(args):
+    """
+    Values of a class, as stored in a record, from the arguments of a class
+    operation
+    """
+    def with_unit(value, unit):
+        try:
+            return str(int(value)) + unit
+        except ValueError:
+            return value
+
+    values = {}
+    if "rate" in args:
+        values["rate"] = syntax.parse_rate(with_unit(args["rate"], "kbit")) * 8
+        values["ceil"] = values["rate"]
+    if "ceil" in args:
+        values["ceil"] = syntax.parse_rate(with_unit(args["ceil"], "kbit")) * 8
+    for key in ("burst", "cburst"):
+        if key in args:
+            values[key] = syntax.parse_size(with_unit(args[key], "k"))
+    for key in ("prio", "quantum"):
+        if key in args:
+            values[key] = int(args[key])
+    return values
+
+
+def class_differs(args, record):
+    """
+    Check if a class operation would modify the class in record
+    """
+    for key, value in _class_values(args).items():
+        live_value = getattr(record, key)
+        if key == "prio" and live_value is None:
+            live_value = 0
+        if live_value is None:
+            continue
+        if key in ("prio", "quantum"):
+            if value != live_value:
+                return True
+        elif not _close(value, live_value):
+            return True
+    return False
+
+
+def qdisc_differs(args, record):
+    """
+    Check if a qdisc operation would modify the qdisc in record
+
+    :return: "replace" if the qdisc has to be replaced, "change" if only its
+        options have to be changed, None otherwise
+    """
+    if (args.get("algorithm") != record.kind or
+            _qdisc_handle(args.get("handle", "0")) != record.handle):
+        return "replace"
+    parsers = QDISC_OPTIONS.get(record.kind, {})
+    defaults = QDISC_DEFAULTS.get(record.kind, {})
+    for key, parser in parsers.items():
+        value = args.get(key, defaults.get(key))
+        if value is None or key not in record.options and key not in defaults:
+            continue
+        live_value = record.options.get(key, defaults.get(key))
+        if key in ("bandwidth", ) and isinstance(live_value, int):
+            live_value = str(live_value) + "bps"
+        if not _close(parser(value), parser(live_value)):
+            return "change"
+    return None
+
+
+def _filter_key(parent, prio, handle):
+    # filters without handle are the whole list of their priority
+    return (_classid(parent), int(prio),
+            int(str(handle), 0) if handle is not None else None)
+
+
+def _class_depth(classid, classes):
+    depth = 0
+    while classid in classes:
+        classid = classes[classid].parent
+        depth += 1
+    return depth
+
+
+def diff_interface(operations, dump):
+    """
+    Compute the operations to converge one interface to the wanted tree
+
+    :param operations: operations building the wanted tree from scratch, on
+        this interface
+    :param dump: current state of the interface, as a
+        :class:`pyqos.backend.records.Dump`
+    :return: list of :class:`pyqos.plan.Operation`
+    """
+    interface = dump.interface
+    root_ops = [op for op in operations
+                if op.kind == "qdisc" and op.args.get("parent") is None]
+    live_root = dump.root
+    if not root_ops:
+        if live_root is None:
+            return []
+        return [Operation("qdisc", "delete", interface, {}, None)]
+
+    root_op = root_ops[0]
+    rebuild = (
+        live_root is None or qdisc_differs(root_op.args, live_root) or
+        any(op.kind == "class" and
+            _classid(op.args["classid"]) in dump.classes and
+            dump.classes[_classid(op.args["classid"])].parent !=
+            _classid(op.args["parent"])
+            for op in operations)
+    )
+    if rebuild:
+        result = []
+        if live_root is not None:
+            result.append(Operation("qdisc", "delete", interface, {}, None))
+        return result + list(operations)
+
+    wanted_classes = set()
+    wanted_qdiscs = set()
+    wanted_filters = {}
+    for op in operations:
+        if op.kind == "class":
+            wanted_classes.add(_classid(op.args["classid"]))
+        elif op.kind == "qdisc" and op is not root_op:
+            wanted_qdiscs.add(_classid(op.args["parent"]))
+        elif op.kind == "filter" and op.args.get("kind", "fw") == "fw":
+            wanted_filters[_filter_key(
+                op.args.get("parent", root_op.args["handle"]),
+                op.args["prio"], op.args.get("handle")
+            )] = op
+    live_filters = OrderedDict(
+        (_filter_key(f.parent, f.prio, f.handle), f) for f in dump.filters
+        if f.kind == "fw"
+    )
+    # the rules of the other classifiers cannot be compared: their lists are
+    # deleted and added back
+    live_lists = OrderedDict(
+        ((f.parent, f.chain, f.prio), f) for f in dump.filters
+        if f.kind != "fw"
+    )
+
+    result = []
+    # remove filters first, to not send packets to classes being deleted
+    for key, record in live_filters.items():
+        if key not in wanted_filters:
+            result.append(Operation("filter", "delete", interface, {
+                "parent": record.parent, "prio": record.prio,
+                "handle": record.handle, "flowid": record.flowid,
+                "protocol": record.protocol,
+            }, None))
+    for record in live_lists.values():
+        args = {"parent": record.parent, "prio": record.prio,
+                "protocol": record.protocol, "kind": record.kind}
+        if record.chain:
+            args["chain"] = record.chain
+        result.append(Operation("filter", "delete", interface, args, None))
+
+    for op in operations:
+        if op is root_op:
+            continue
+        if op.kind == "class":
+            record = dump.classes.get(_classid(op.args["classid"]))
+            if record is None:
+                result.append(op)
+            elif class_differs(op.args, record):
+                result.append(op._replace(action="change"))
+        elif op.kind == "qdisc":
+            record = dump.qdiscs.get(_classid(op.args["parent"]))
+            if record is None or record.handle == "0:":
+                result.append(op)
+                continue
+            action = qdisc_differs(op.args, record)
+            if action is not None:
+                result.append(op._replace(action=action))
+        elif op.kind == "filter" and op.args.get("kind", "fw") != "fw":
+            result.append(op)
+        elif op.kind == "filter":
+            record = live_filters.get(_filter_key(
+                op.args.get("parent", root_op.args["handle"]),
+                op.args["prio"], op.args.get("handle")
+            ))
+            flowid = op.args.get("flowid")
+            if record is None:
+                result.append(op)
+            elif (_classid(flowid) if flowid else None) != record.flowid:
+                result.append(op._replace(action="replace"))
+
+    for parent, record in dump.qdiscs.items():
+        if (parent != "root" and parent not in wanted_qdiscs and
+                parent in wanted_classes and record.handle != "0:"):
+            result.append(Operation("qdisc", "delete", interface, {
+                "parent": parent, "handle": record.handle,
+            }, None))
+    # delete the deepest classes first, as a class with children cannot be
+    # deleted
+    removed_classes = sorted(
+        (c for c in dump.classes.values()
+         if c.classid not in wanted_classes and
+         c.kind not in KERNEL_CLASSES),
+        key=lambda c: _class_depth(c.classid, dump.classes), reverse=True
+    )
+    for record in removed_classes:
+        result.append(Operation("class", "delete", interface, {
+            "parent": record.parent, "classid": record.classid,
+            "algorithm": record.kind,
+        }, None))
+    return result
+
+
+def _by_interface(function, operations, dumps):
+    """
+    Call function(interface_operations, dump) for each interface and chain
+    the results
+    """
+    by_interface = OrderedDict((interface, []) for interface in dumps)
+    for op in operations:
+        by_interface.setdefault(op.interface, []).append(op)
+    result = []
+    for interface, interface_ops in by_interface.items():
+        dump = dumps.get(interface) or Dump(interface)
+        result.extend(function(interface_ops, dump))
+    return result
+
+
+def changed_interfaces(old_operations, new_operations):
+    """
+    Compare the operations building two versions of the trees, without
+    reading the kernel state
+
+    :param old_operations: operations building the previous trees, as
+        recorded by :func:`pyqos.plan.record`
+    :param new_operations: operations building the new trees
+    :return: set of the interfaces whose operations differ
+    """
+    def by_interface(operations):
+        result = {}
+        for op in operations:
+            result.setdefault(op.interface, []).append(
+                (op.kind, op.action, op.args)
+            )
+        return result
+
+    old, new = by_interface(old_operations), by_interface(new_operations)
+    return set(
+        interface for interface in set(old).union(new)
+        if old.get(interface) != new.get(interface)
+    )
+
+
+def class_only_interfaces(old_operations, new_operations):
+    """
+    Find the interfaces whose trees only differ by the arguments of their
+    classes, like a new rate, which can be applied with class changes
+
+    :param old_operations: operations building the previous trees, as
+        recorded by :func:`pyqos.plan.record`
+    :param new_operations: operations building the new trees
+    :return: set of the interfaces with the same qdiscs, filters and
+        classes, but with classes of different arguments
+    """
+    def by_interface(operations):
+        skeletons, classes = {}, {}
+        for op in operations:
+            if op.kind == "class":
+                item = (op.action, op.args.get("parent"),
+                        _classid(op.args["classid"]))
+                classes.setdefault(op.interface, []).append(op.args)
+            else:
+                item = (op.kind, op.action, op.args)
+            skeletons.setdefault(op.interface, []).append(item)
+        return skeletons, classes
+
+    old_skeletons, old_classes = by_interface(old_operations)
+    new_skeletons, new_classes = by_interface(new_operations)
+    return set(
+        interface for interface, skeleton in new_skeletons.items()
+        if old_skeletons.get(interface) == skeleton and
+        old_classes.get(interface) != new_classes.get(interface)
+    )
+
+
+def synced_classes(operations, dumps):
+    """
+    Find the classes of the wanted trees which are already set as wanted on
+    the interfaces
+
+    :param operations: operations building the wanted trees, as recorded by
+        :func:`pyqos.plan.record`
+    :param dumps: dict {interface: :class:`pyqos.backend.records.Dump`}
+    :return: list of the class operations :func:`diff` would not send
+    """
+    operations = list(operations)
+    pending = diff(operations, dumps)
+    # a root qdisc deleted without arguments rebuilds the whole interface
+    rebuilt = set(op.interface for op in pending
+                  if op.kind == "qdisc" and op.action == "delete" and
+                  not op.args)
+    changed = set((op.interface, _classid(op.args["classid"]))
+                  for op in pending
+                  if op.kind == "class" and "classid" in op.args)
+    return [
+        op for op in operations
+        if op.kind == "class" and op.interface not in rebuilt and
+        (op.interface, _classid(op.args["classid"])) not in changed
+    ]
+
+
+def class_changes(applied, operations):
+    """
+    Compute the changes of the classes since they have been applied, without
+    reading the kernel state
+
+    :param applied: dict {(interface, classid as tc prints it): arguments}
+        of the classes applied
+    :param operations: operations adding the classes as they are now, like
+        :func:`pyqos.plan.compile_classes` generates
+    :return: list of "change" :class:`pyqos.plan.Operation`
+    """
+    result = []
+    missing = []
+    for op in operations:
+        if op.kind != "class":
+            continue
+        args = applied.get((op.interface, _classid(op.args["classid"])))
+        if args is None:
+            missing.append(op.origin)
+        elif args != op.args:
+            result.append(op._replace(action="change"))
+    if missing:
+        _logger.warning("%d classes have not been applied, like %r: apply "
+                        "the trees to add them", len(missing), missing[0])
+    return result
+
+
+def diff(operations, dumps):
+    """
+    Compute the operations to converge the interfaces to the wanted trees
+
+    :param operations: operations building the wanted trees from scratch, as
+        recorded by :func:`pyqos.plan.record`
+    :param dumps: dict {interface: :class:`pyqos.backend.records.Dump`} of the
+        current state. Interfaces without any wanted operation will be
+        cleaned.
+    :return: list of :class:`pyqos.plan.Operation`
+    """
+    return _by_interface(diff_interface, operations, dumps)
+
+
+def swap_interface(operations, dump):
+    """
+    Compute the operations to swap the tree of one interface at once
+
+    The root qdisc is replaced instead of being deleted then added back, so
+    the interface never falls back to its default qdisc. The wanted tree has
+    to use another root handle than the current one: with the same handle,
+    the kernel would just change the options of the current root.
+
+    :param operations: operations building the wanted tree from scratch, on
+        this interface
+    :param dump: current state of the interface, as a
+        :class:`pyqos.backend.records.Dump`
+    :return: list of :class:`pyqos.plan.Operation`
+    """
+    interface = dump.interface
+    live_root = dump.root
+    root_ops = [op for op in operations
+                if op.kind == "qdisc" and op.args.get("parent") is None]
+    if not root_ops:
+        if live_root is None:
+            return []
+        return [Operation("qdisc", "delete", interface, {}, None)]
+
+    root_op = root_ops[0]
+    if (live_root is not None and
+            _qdisc_handle(root_op.args.get("handle", "0")) ==
+            live_root.handle):
+        _logger.warning(
+            "{}: the new root uses the same handle ({}) than the current "
+            "one, rebuilding it instead of swapping".format(
+                interface, live_root.handle
+            )
+        )
+        return ([Operation("qdisc", "delete", interface, {}, None)] +
+                list(operations))
+    return [op._replace(action="replace") if op is root_op else op
+            for op in operations]
+
+
+def swap(operations, dumps):
+    """
+    Compute the operations to swap the trees of the interfaces at once
+
+    See :func:`swap_interface`.
+
+    :param operations: operations building the wanted trees from scratch, as
+        recorded by :func:`pyqos.plan.record`
+    :param dumps: dict {interface: :class:`pyqos.backend.records.Dump`} of the
+        current state. Interfaces without any wanted operation will be
+        cleaned.
+    :return: list of :class:`pyqos.plan.Operation`
+    """
+    return _by_interface(swap_interface, operations, dumps)
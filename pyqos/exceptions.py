@@ -8,3 +8,11 @@ class BadAttributeValueException(Exception):
 
 class NoParentException(Exception):
     pass
+
+
+class ConflictException(BadAttributeValueException):
+    pass
+
+
+class CommandException(Exception):
+    pass
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Cache of the characteristics of the network interfaces
+
+from collections import namedtuple
+import logging
+import socket
+import struct
+import threading
+import time
+
+from pyqos.backend import netlink
+
+_logger = logging.getLogger(__name__)
+
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTMGRP_LINK = 1
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_TXQLEN = 13
+IFLA_NUM_TX_QUEUES = 31
+
+#: characteristics of an interface. speed is the link speed in kbit/s, None
+#: if the driver does not report it (virtual interfaces, link down).
+InterfaceInfo = namedtuple(
+    "InterfaceInfo",
+    ("name", "index", "mtu", "txqueuelen", "num_tx_queues", "speed")
+)
+
+
+def _read_speed(name):
+    """
+    Read the link speed of an interface from sysfs, as it is only exposed
+    through ethtool and not rtnetlink
+
+    :return: speed in kbit/s, or None
+    """
+    try:
+        with open("/sys/class/net/{}/speed".format(name)) as speed_file:
+            speed = int(speed_file.read())
+    except (OSError, ValueError):
+        return None
+    return speed * 1000 if speed > 0 else None
+
+
+def _decode_link(payload):
+    index = struct.unpack_from("=BxHiII", payload)[2]
+    attrs = netlink.parse_attrs(payload[16:])
+
+    def u32(attr_type):
+        value = attrs.get(attr_type)
+        return struct.unpack_from("=I", value)[0] if value else None
+
+    name = attrs.get(IFLA_IFNAME, b"").rstrip(b"\0").decode()
+    return InterfaceInfo(
+        name, index, u32(IFLA_MTU), u32(IFLA_TXQLEN),
+        u32(IFLA_NUM_TX_QUEUES), _read_speed(name)
+    )
+
+
+class InterfaceCache():
+    """
+    Characteristics of all the interfaces, loaded with one netlink dump
+
+    The cache listens to the link events of the kernel, and is reloaded at the
+    next access after any interface has been added, removed or changed. If
+    the events cannot be received, the cache is reloaded every :attr:`ttl`
+    seconds instead.
+    """
+    #: lifetime of the cache without link events, in seconds
+    ttl = 5
+
+    def __init__(self, ttl=None, clock=time.monotonic):
+        self.ttl = ttl or self.ttl
+        self.clock = clock
+        #: loaded interfaces, by name. None if not loaded yet.
+        self._links = None
+        #: time of the last load
+        self._loaded_at = None
+        #: socket receiving the link events
+        self._events = None
+        self._lock = threading.Lock()
+
+    def _open_events(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 netlink.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK))
+        except OSError as e:
+            _logger.debug("Cannot listen to the link events: %s", e)
+            return None
+        sock.setblocking(False)
+        return sock
+
+    def _changed(self):
+        """
+        Consume the pending link events
+
+        :return: True if an interface changed since the last call
+        """
+        if self._events is None:
+            # without events, only trust the cache for a while
+            return (self._loaded_at is None or
+                    self.clock() - self._loaded_at >= self.ttl)
+        changed = False
+        while True:
+            try:
+                data = self._events.recv(1 << 16)
+            except BlockingIOError:
+                return changed
+            except OSError:
+                # ENOBUFS: events have been lost
+                changed = True
+                continue
+            if not data:
+                return changed
+            changed = True
+
+    def load(self):
+        """
+        Load all the interfaces, with one RTM_GETLINK dump
+        """
+        if self._events is None:
+            # listen before the dump to not miss any change
+            self._events = self._open_events()
+        self._changed()
+        self._loaded_at = self.clock()
+        pipeline = netlink.Pipeline(sock=netlink.open_socket())
+        try:
+            messages = pipeline.dump(
+                RTM_GETLINK, struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0,
+                                         0, 0)
+            )
+        except OSError as e:
+            _logger.warning("Cannot read the interfaces: %s", e)
+            messages = []
+        finally:
+            pipeline.close()
+        links = (_decode_link(payload)
+                 for msg_type, payload in messages
+                 if msg_type == RTM_NEWLINK)
+        self._links = {link.name: link for link in links}
+
+    def get(self, interface):
+        """
+        Return the characteristics of an interface
+
+        :return: :class:`InterfaceInfo`, or None if the interface does not
+            exist
+        """
+        with self._lock:
+            if self._links is None or self._changed():
+                self.load()
+            return self._links.get(interface)
+
+    def invalidate(self):
+        """
+        Force the reload of the interfaces at the next access
+        """
+        with self._lock:
+            self._links = None
+
+    def close(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+            self._links = None
+
+
+#: cache shared by the whole application
+_cache = InterfaceCache()
+
+
+def get_info(interface):
+    """
+    Return the characteristics of an interface, from the shared cache
+
+    :return: :class:`InterfaceInfo`, or None if the interface does not exist
+    """
+    return _cache.get(interface)
+
+
+def get_mtu(interface, default=1500):
+    """
+    Return the MTU of an interface
+
+    :param default: MTU returned if the interface does not exist
+    """
+    info = get_info(interface)
+    if info is None or info.mtu is None:
+        _logger.warning("Cannot find the MTU of %s. Will use %s", interface,
+                        default)
+        return default
+    return info.mtu
+
+
+def invalidate():
+    """
+    Force the reload of the shared cache at the next access
+    """
+    _cache.invalidate()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Generate the nftables ruleset marking the packets for the fw filters
+
+from collections import OrderedDict
+import ipaddress
+import logging
+import subprocess
+
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException, NoParentException
+from pyqos.stats import walk
+
+_logger = logging.getLogger(__name__)
+
+#: name of the table, in the inet family, holding the marking rules
+TABLE = "pyqos"
+
+#: nftables expression and type of each flower key. The addresses and the
+#: DSCP depend on the IP version of the rule.
+KEYS = OrderedDict((
+    ("ip_proto", ("meta l4proto", "inet_proto")),
+    ("src_ip", ("{ip} saddr", "{addr}")),
+    ("dst_ip", ("{ip} daddr", "{addr}")),
+    ("src_port", ("th sport", "inet_service")),
+    ("dst_port", ("th dport", "inet_service")),
+    ("dscp", ("{ip} dscp", "dscp")),
+))
+
+
+def _mark(node):
+    """
+    Mark to set on the packets of a class: its fw mark, or its classid if its
+    root uses the marks as classids
+
+    :return: mark, or None if the class has no fw filter
+    """
+    mark = getattr(node, "fw_mark", None)
+    if mark is None and node.root.mark_classid:
+        mark = syntax.parse_classid(node.classid)
+    return mark
+
+
+def _rule_values(rule, dscp):
+    """
+    Convert a rule of :attr:`pyqos.algorithms.htb.HTBClass.match` to the
+    values of the nftables keys
+
+    :return: (IP version, OrderedDict {key: value})
+    """
+    rule = dict(rule)
+    unknown = set(rule).difference(syntax.FLOWER_KEYS)
+    if unknown:
+        raise BadAttributeValueException(
+            "Unknown match keys: " + ", ".join(sorted(unknown))
+        )
+    ip_tos = rule.pop("ip_tos", None)
+    if ip_tos is not None:
+        value, _, mask = str(ip_tos).partition("/")
+        if int(mask or "0xff", 0) & 0xFC != 0xFC:
+            raise BadAttributeValueException(
+                "Only the DSCP of ip_tos can be matched: " + str(ip_tos)
+            )
+        rule["dscp"] = int(value, 0) >> 2
+    if dscp is not None:
+        rule["dscp"] = syntax.parse_dscp(dscp)
+    version = 4
+    for key in ("src_ip", "dst_ip"):
+        if rule.get(key) is not None:
+            rule[key] = ipaddress.ip_network(rule[key], strict=False)
+            version = rule[key].version
+    if str(rule.get("ip_proto")) == "icmpv6":
+        version = 6
+    return version, OrderedDict(
+        (key, rule[key]) for key in KEYS if rule.get(key) is not None
+    )
+
+
+def _format_value(value):
+    if (isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)) and
+            value.prefixlen == value.max_prefixlen):
+        return str(value.network_address)
+    return str(value)
+
+
+class MarkMap():
+    """
+    Map of the values of some keys to the marks, for one interface
+
+    All the rules of an interface matching the same keys are gathered in one
+    map, so nftables finds the mark of a packet with one lookup per set of
+    keys, whatever the number of rules.
+    """
+    def __init__(self, name, interface, version, keys):
+        self.name = name
+        self.interface = interface
+        #: IP version of the addresses and DSCP
+        self.version = version
+        #: matched keys, in the order of :data:`KEYS`
+        self.keys = keys
+        #: marks, by tuple of values
+        self.elements = OrderedDict()
+
+    def _format(self, index):
+        ip = "ip" if self.version == 4 else "ip6"
+        addr = "ipv{}_addr".format(self.version)
+        return [KEYS[key][index].format(ip=ip, addr=addr)
+                for key in self.keys]
+
+    @property
+    def expression(self):
+        return " . ".join(self._format(0))
+
+    @property
+    def type(self):
+        return " . ".join(self._format(1)) + " : mark"
+
+    @property
+    def interval(self):
+        """
+        If some values are networks, the map needs the interval flag
+        """
+        return any(
+            isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network))
+            and value.prefixlen != value.max_prefixlen
+            for values in self.elements for value in values
+        )
+
+    def add(self, values, mark, origin=None):
+        if values in self.elements:
+            _logger.warning(
+                "%s on %s is already marked, %r will not be marked",
+                ", ".join(map(_format_value, values)), self.interface, origin
+            )
+            return
+        self.elements[values] = mark
+
+    def format(self):
+        """
+        Declaration of the map in the table
+
+        :return: list of lines
+        """
+        lines = ["\tmap {} {{".format(self.name),
+                 "\t\ttype {}".format(self.type)]
+        if self.interval:
+            lines.append("\t\tflags interval")
+        elements = ",\n".join(
+            "\t\t\t{} : 0x{:08x}".format(
+                " . ".join(map(_format_value, values)), mark
+            ) for values, mark in self.elements.items()
+        )
+        lines += ["\t\telements = {", elements, "\t\t}", "\t}"]
+        return lines
+
+    def format_rule(self):
+        return 'oifname "{}" meta mark set {} map @{} accept'.format(
+            self.interface, self.expression, self.name
+        )
+
+
+def mark_maps(roots):
+    """
+    Gather the rules of the classes of some trees in maps
+
+    Only the trees of the roots classifying with nftables (see
+    :attr:`pyqos.algorithms.htb.RootHTBClass.classifier`) are used.
+
+    :return: list of :class:`MarkMap`, in the order of the first rule of each
+        map in the trees. A packet gets the mark of the first map it matches.
+    """
+    maps = OrderedDict()
+    for root in roots:
+        for node in walk(root):
+            try:
+                match, dscp = node.match, node.dscp
+                if (match is None and dscp is None or
+                        node.root.classifier != "nftables"):
+                    continue
+                interface = node.interface
+            except (AttributeError, NoParentException):
+                continue
+            mark = _mark(node)
+            if mark is None:
+                _logger.warning("%r has no fw filter, it cannot be marked",
+                                node)
+                continue
+            if match is None or isinstance(match, dict):
+                match = [match or {}]
+            for rule in match:
+                version, values = _rule_values(rule, dscp)
+                if not values:
+                    continue
+                key = (interface, version, tuple(values))
+                if key not in maps:
+                    maps[key] = MarkMap("mark_{}".format(len(maps)), *key)
+                maps[key].add(tuple(values.values()), mark, origin=node)
+    return list(maps.values())
+
+
+def ruleset(roots, table=TABLE):
+    """
+    Generate the nftables ruleset marking the packets of the classes of some
+    trees
+
+    The ruleset replaces the table at once: loaded with one ``nft -f``, the
+    old marking rules are never mixed with the new ones.
+
+    :return: ruleset, as a string
+    """
+    maps = mark_maps(roots)
+    lines = ["table inet {}".format(table),
+             "delete table inet {}".format(table),
+             "table inet {} {{".format(table)]
+    for mark_map in maps:
+        lines += mark_map.format()
+    lines += [
+        "\tchain postrouting {",
+        "\t\ttype filter hook postrouting priority mangle; policy accept;",
+    ]
+    lines += ["\t\t" + mark_map.format_rule() for mark_map in maps]
+    lines += ["\t}", "}"]
+    return "\n".join(lines) + "\n"
+
+
+def load(rules, dryrun=False):
+    """
+    Load a ruleset with one ``nft -f`` transaction
+
+    :param rules: ruleset, as returned by :func:`ruleset`
+    :return: True if the ruleset has been loaded
+    """
+    _logger.debug("nft -f -\n%s", rules)
+    if dryrun:
+        return True
+    try:
+        process = subprocess.run(
+            ["nft", "-f", "-"], input=rules, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+    except OSError as e:
+        _logger.error("Cannot launch nft: %s", e)
+        return False
+    if process.returncode != 0:
+        _logger.error("Cannot load the nftables rules: %s",
+                      process.stderr.strip())
+        return False
+    return True
+
+
+def delete(table=TABLE, dryrun=False):
+    """
+    Remove the marking rules
+    """
+    return load("table inet {0}\ndelete table inet {0}\n".format(table),
+                dryrun=dryrun)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Operations to apply on the interfaces
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import logging
+
+from pyqos import backend, tools
+from pyqos.backend import tc
+
+_logger = logging.getLogger(__name__)
+
+#: operation on a qdisc, class or filter
+#:
+#: :kind: "qdisc", "class" or "filter"
+#: :action: "add", "change", "replace" or "delete"
+#: :interface: target interface
+#: :args: dict of the arguments of the backend function
+#: :origin: object which generated the operation
+Operation = namedtuple(
+    "Operation", ("kind", "action", "interface", "args", "origin")
+)
+
+#: result of the operations applied on one interface
+#:
+#: :interface: interface name
+#: :failed: list of the failed commands, as tuples
+#:     ``(command, origin, error message)``
+#: :error: exception which stopped the apply of the interface, or None
+InterfaceResult = namedtuple("InterfaceResult",
+                             ("interface", "failed", "error"))
+
+
+def make_operation(op_kind, action, interface, origin=None, **args):
+    """
+    Build an operation, ignoring the arguments set to None
+
+    :param op_kind: kind of the operation. Named to leave ``kind`` to the
+        arguments, as the kind of a filter.
+    """
+    args = {i: j for i, j in args.items() if j is not None}
+    return Operation(op_kind, action, interface, args, origin)
+
+
+class Recorder():
+    """
+    Backend recording the operations instead of applying them
+
+    Exposes the same functions than the backend modules.
+    """
+    def __init__(self):
+        #: recorded operations
+        self.operations = []
+
+    def _record(self, op_kind, action, interface, **args):
+        self.operations.append(make_operation(
+            op_kind, action, interface, tools.get_command_origin(), **args
+        ))
+
+    def qdisc(self, interface, action, algorithm=None, handle=None,
+              parent=None, stderr=None, dryrun=False, opts_args=None,
+              **kwargs):
+        self._record(
+            "qdisc", action, interface, algorithm=algorithm, handle=handle,
+            parent=parent, opts_args=list(opts_args) if opts_args else None,
+            **kwargs
+        )
+
+    def qdisc_add(self, interface, handle, algorithm, parent=None,
+                  opts_args=None, **kwargs):
+        self.qdisc(interface, "add", algorithm, handle, parent,
+                   opts_args=opts_args, **kwargs)
+
+    def qdisc_del(self, interface, algorithm=None, handle=None, parent=None,
+                  *args, **kwargs):
+        self.qdisc(interface, "delete", algorithm, handle, parent,
+                   opts_args=args, **kwargs)
+
+    def qos_class(self, interface, action, parent, classid=None,
+                  algorithm="htb", dryrun=False, **kwargs):
+        self._record("class", action, interface, parent=parent,
+                     classid=classid, algorithm=algorithm, **kwargs)
+
+    def qos_class_add(self, interface, parent, classid, algorithm="htb",
+                      **kwargs):
+        self.qos_class(interface, "add", parent, classid, algorithm,
+                       **kwargs)
+
+    def qos_class_del(self, interface, parent, classid=None, algorithm="htb",
+                      **kwargs):
+        self.qos_class(interface, "delete", parent, classid, algorithm,
+                       **kwargs)
+
+    def filter(self, interface, action, prio, handle=None, flowid=None,
+               parent=None, protocol="all", dryrun=False, **kwargs):
+        self._record("filter", action, interface, prio=prio, handle=handle,
+                     flowid=flowid, parent=parent, protocol=protocol,
+                     **kwargs)
+
+    def filter_add(self, interface, parent, prio, handle, flowid,
+                   protocol="all", **kwargs):
+        self.filter(interface, "add", prio, handle, flowid, parent, protocol,
+                    **kwargs)
+
+    def filter_del(self, interface, prio, handle, flowid, parent=None,
+                   protocol="all", **kwargs):
+        self.filter(interface, "delete", prio, handle, flowid, parent,
+                    protocol, **kwargs)
+
+    @contextmanager
+    def batch(self, dryrun=False):
+        yield self
+
+    def flush(self):
+        return []
+
+
+def compile_node(node, **kwargs):
+    """
+    Generate the operations needed to build a node from scratch
+
+    Nodes without a ``compile`` method are applied through a
+    :class:`Recorder`.
+
+    :param node: object to compile
+    :param kwargs: arguments passed to the compile (or apply) method
+    :return: generator of :class:`Operation`
+    """
+    compile_function = getattr(node, "compile", None)
+    if compile_function is not None:
+        yield from compile_function(**kwargs)
+        return
+    recorder = Recorder()
+    with backend.use_backend(recorder):
+        node.apply(**kwargs)
+    yield from recorder.operations
+
+
+def compile(roots):
+    """
+    Generate the operations needed to build some trees from scratch
+
+    The operations are computed while being consumed, so a whole tree never
+    has to be held in memory.
+
+    :param roots: list of objects to apply, like the run_list of the
+        application
+    :return: generator of :class:`Operation`
+    """
+    for root in roots:
+        yield from compile_node(root)
+
+
+def compile_classes(roots):
+    """
+    Generate the operations adding the classes of some trees, without their
+    qdiscs and filters
+
+    Only the roots with a ``compile_classes`` method are compiled.
+
+    :return: generator of :class:`Operation`
+    """
+    for root in roots:
+        compile_function = getattr(root, "compile_classes", None)
+        if compile_function is not None:
+            yield from compile_function()
+
+
+def record(roots):
+    """
+    Record the operations needed to build some trees from scratch
+
+    :param roots: list of objects to apply, like the run_list of the
+        application
+    :return: list of :class:`Operation`
+    """
+    return list(compile(roots))
+
+
+def execute(operations, backend_module=None, dryrun=False):
+    """
+    Apply operations through a backend
+
+    :param operations: iterable of :class:`Operation`
+    :param backend_module: backend to use. If None, use the selected one.
+    """
+    backend_module = backend_module or backend.get_backend()
+    functions = {"qdisc": backend_module.qdisc,
+                 "class": backend_module.qos_class,
+                 "filter": backend_module.filter}
+    for operation in operations:
+        with tools.command_origin(operation.origin):
+            functions[operation.kind](
+                operation.interface, operation.action, dryrun=dryrun,
+                **operation.args
+            )
+
+
+def split_by_interface(operations):
+    """
+    Group operations by interface, keeping their order
+
+    :return: OrderedDict {interface: list of :class:`Operation`}
+    """
+    by_interface = OrderedDict()
+    for operation in operations:
+        by_interface.setdefault(operation.interface, []).append(operation)
+    return by_interface
+
+
+def _execute_interface(interface, operations, backend_module, dryrun):
+    try:
+        with backend_module.batch(dryrun=dryrun) as command_batch:
+            execute(operations, backend_module, dryrun=dryrun)
+            failed = command_batch.flush()
+    except Exception as e:
+        _logger.error("%s: cannot apply the rules: %s", interface, e)
+        return InterfaceResult(interface, [], e)
+    return InterfaceResult(interface, failed, None)
+
+
+def execute_parallel(plans, workers=4, backend_module=None, dryrun=False):
+    """
+    Apply the operations of several interfaces concurrently
+
+    The trees of different interfaces do not share any kernel state, so each
+    interface is applied in its own batch by a pool of threads. An error on
+    an interface does not stop the others.
+
+    :param plans: dict {interface: iterable of :class:`Operation`}. The
+        iterables are consumed by the workers, so they can be lazy plans from
+        :func:`compile`.
+    :param workers: maximum number of interfaces applied at the same time
+    :param backend_module: backend to use. If None, use the selected one.
+    :return: list of :class:`InterfaceResult`, in the order of plans
+    """
+    backend_module = backend_module or backend.get_backend()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [
+            pool.submit(_execute_interface, interface, operations,
+                        backend_module, dryrun)
+            for interface, operations in plans.items()
+        ]
+        return [future.result() for future in futures]
+
+
+def format_operation(operation):
+    """
+    Format an operation as the equivalent tc command
+    """
+    builders = {"qdisc": tc.qdisc_command, "class": tc.qos_class_command,
+                "filter": tc.filter_command}
+    return " ".join(builders[operation.kind](
+        operation.interface, operation.action, **operation.args
+    ))
+
+
+def serialize(operations):
+    """
+    Serialize operations, one JSON object per line
+
+    The origins of the operations are not serialized.
+
+    :param operations: iterable of :class:`Operation`
+    :return: generator of lines
+    """
+    for operation in operations:
+        yield json.dumps({
+            "kind": operation.kind, "action": operation.action,
+            "interface": operation.interface, "args": operation.args,
+        }, sort_keys=True)
+
+
+def deserialize(lines):
+    """
+    Load operations serialized by :func:`serialize`
+
+    :param lines: iterable of lines. Empty lines are ignored.
+    :return: generator of :class:`Operation`, without origin
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        yield Operation(data["kind"], data["action"], data["interface"],
+                        data["args"], None)
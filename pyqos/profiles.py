@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Switch the rates of classes between profiles, at scheduled times
+
+from collections import namedtuple
+import datetime
+import logging
+
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException
+
+_logger = logging.getLogger(__name__)
+
+#: attributes of the classes a profile can override
+ATTRIBUTES = ("rate", "ceil", "prio")
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+#: number of days looked back for the last switch
+_LOOKBACK = 366
+
+
+def _parse_days(days):
+    """
+    Read a set of week days, like "mon-fri", "sat,sun" or ["mon", "wed"]
+
+    :return: frozenset of the days, 0 for monday
+    """
+    if isinstance(days, str):
+        days = days.split(",")
+    result = set()
+    for item in days:
+        first, _, last = item.strip().lower().partition("-")
+        try:
+            start = DAYS.index(first)
+            end = DAYS.index(last) if last else start
+        except ValueError:
+            raise BadAttributeValueException(
+                "Bad days: {!r}".format(item)
+            )
+        if end < start:
+            end += len(DAYS)
+        result.update(day % len(DAYS) for day in range(start, end + 1))
+    return frozenset(result)
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.time):
+        return value
+    try:
+        hours, _, minutes = str(value).partition(":")
+        return datetime.time(int(hours), int(minutes or 0))
+    except ValueError:
+        raise BadAttributeValueException("Bad time: {!r}".format(value))
+
+
+def _parse_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise BadAttributeValueException("Bad date: {!r}".format(value))
+
+
+#: switch of the schedule
+#:
+#: :start: :class:`datetime.time` of the switch
+#: :profile: name of the profile, None for the values of the rules
+#: :days: frozenset of the week days of the switch, 0 for monday
+#: :dates: frozenset of the :class:`datetime.date` of the switch. The
+#:     switches with dates take precedence over the others on these dates.
+ScheduleEntry = namedtuple("ScheduleEntry",
+                           ("start", "profile", "days", "dates"))
+
+
+class Schedule():
+    """
+    Times at which the profiles are switched, by week day or by date
+
+    Each entry is a dict with the ``start`` time of the switch (``"08:30"``),
+    the ``profile`` to switch to, and optionally the ``days`` of the week
+    (``"mon-fri"``, every day if missing) or the ``dates``
+    (``["2026-12-25"]``) of the switch. The profile active at a time is the
+    one of the last switch before it: on a date with its own entries, only
+    them are considered.
+    """
+    def __init__(self, entries):
+        self.entries = []
+        for entry in entries:
+            dates = entry.get("dates")
+            self.entries.append(ScheduleEntry(
+                _parse_time(entry["start"]), entry["profile"],
+                _parse_days(entry.get("days") or DAYS),
+                frozenset(map(_parse_date, dates)) if dates else None,
+            ))
+        # latest switches first
+        self.entries.sort(key=lambda entry: entry.start, reverse=True)
+
+    def _day_entries(self, day):
+        """
+        Switches of a date, latest first
+        """
+        dated = [e for e in self.entries if e.dates and day in e.dates]
+        if dated:
+            return dated
+        return [e for e in self.entries
+                if e.dates is None and day.weekday() in e.days]
+
+    def active(self, when):
+        """
+        :param when: :class:`datetime.datetime`
+        :return: name of the profile active at a time, None for the values
+            of the rules
+        """
+        for delta in range(_LOOKBACK):
+            day = when.date() - datetime.timedelta(days=delta)
+            for entry in self._day_entries(day):
+                if delta or entry.start <= when.time():
+                    return entry.profile
+        return None
+
+
+class ProfileScheduler():
+    """
+    Switch the classes of the trees of an application between profiles,
+    following a :class:`Schedule`
+
+    A profile overrides the rate, ceil or prio of some classes, by
+    (interface, classid). The classes not overridden by the active profile
+    keep their current values, which can be set by an autorate controller or
+    :meth:`pyqos.PyQoS.update_rates`. A switch only touches the attributes
+    overridden by the previous or the new profile: the classes are compiled
+    with their current values, compared with the applied ones, and the
+    differences are sent as class changes in one batch, so the traffic is
+    shaped during the whole switch. The trees have to be applied by the same
+    application first.
+    """
+    def __init__(self, app, profiles, schedule=None,
+                 clock=datetime.datetime.now):
+        """
+        :param app: application which applied the trees
+        :param profiles: dict {name: {(interface, classid): {attribute:
+            value}}}
+        :param schedule: :class:`Schedule`, or its list of entries
+        :param clock: function returning the current
+            :class:`datetime.datetime`
+        """
+        self.app = app
+        if not isinstance(schedule, Schedule):
+            schedule = Schedule(schedule or ())
+        self.schedule = schedule
+        self.clock = clock
+        classes = app.classes()
+        #: overrides of each profile, by node
+        self.profiles = {}
+        for name, overrides in profiles.items():
+            self.profiles[name] = {}
+            for (interface, classid), values in overrides.items():
+                node = classes.get((interface, syntax.format_handle(
+                    syntax.parse_classid(classid)
+                )))
+                if node is None:
+                    raise BadAttributeValueException(
+                        "Profile {}: no class {} on {}".format(
+                            name, classid, interface
+                        )
+                    )
+                unknown = set(values) - set(ATTRIBUTES)
+                if unknown:
+                    raise BadAttributeValueException(
+                        "Profile {}: cannot override {}".format(
+                            name, ", ".join(sorted(unknown))
+                        )
+                    )
+                self.profiles[name][node] = dict(values)
+        for name in set(e.profile for e in self.schedule.entries):
+            if name is not None and name not in self.profiles:
+                raise BadAttributeValueException(
+                    "Unknown profile: {}".format(name)
+                )
+        #: values of the attributes overridden by the current profile, as
+        #: they were before its switch, by node
+        self.base = {}
+        #: interfaces of the overridden classes
+        self.interfaces = sorted(set(
+            node.interface
+            for overrides in self.profiles.values() for node in overrides
+        ))
+        #: profile set on the classes, None for the values of the rules
+        self.profile = None
+
+    def select(self, profile):
+        """
+        Set the values of a profile on the classes, without applying them
+
+        The attributes overridden by the previous profile only get back
+        their values from before its switch. The other attributes are not
+        modified.
+        """
+        old = self.profiles[self.profile] if self.profile is not None else {}
+        new = self.profiles[profile] if profile is not None else {}
+        for node, values in old.items():
+            for attr in values:
+                if attr not in new.get(node, ()):
+                    setattr(node, attr, self.base[node].pop(attr))
+        for node, values in new.items():
+            base = self.base.setdefault(node, {})
+            for attr, value in values.items():
+                base.setdefault(attr, node._raw(attr))
+                setattr(node, attr, value)
+        self.profile = profile
+
+    def switch(self, profile):
+        """
+        Apply a profile, with one class change per class to modify
+
+        :return: list of the "change" :class:`pyqos.plan.Operation` applied
+        """
+        _logger.info("Switching to the profile %s", profile)
+        previous = self.profile
+        self.select(profile)
+        try:
+            return self.app.commit(self.interfaces)
+        except Exception:
+            self.select(previous)
+            raise
+
+    def run_pending(self):
+        """
+        Switch to the profile scheduled now, if it is not the current one
+
+        :return: list of the operations applied, or None if nothing changed
+        """
+        profile = self.schedule.active(self.clock())
+        if profile == self.profile:
+            return None
+        return self.switch(profile)
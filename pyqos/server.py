@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Control socket of the daemon keeping the trees in memory
+
+import contextlib
+import inspect
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from pyqos import stats, watch
+from pyqos.exceptions import CommandException
+
+_logger = logging.getLogger(__name__)
+
+#: default path of the control socket
+SOCKET_PATH = "/run/pyqos.sock"
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    Answer the requests of a client, one JSON object per line
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.dispatch(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _ControllerRunner(threading.Thread):
+    """
+    Run autorate controllers in the background, so their probes wait for the
+    network without blocking the requests of the daemon
+
+    The probes run without any lock: only the new rates are applied under the
+    lock of the daemon.
+    """
+    #: time between two checks of the controllers due, in seconds
+    poll_interval = 0.1
+
+    def __init__(self, server, controllers):
+        super().__init__(name="autorate", daemon=True)
+        self.server = server
+        self.controllers = controllers
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for controller in self.controllers:
+                if self.stopped.is_set():
+                    return
+                if not controller.due():
+                    continue
+                try:
+                    measure = controller.measure()
+                    with self.server._lock:
+                        # the trees may have been reloaded during the probe
+                        if self.stopped.is_set():
+                            return
+                        with self.server.backend_batch():
+                            controller.update(*measure)
+                except Exception:
+                    _logger.exception("Cannot adjust the rate of %r",
+                                      controller.node)
+            self.stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Daemon applying the commands received on a Unix socket to the trees of
+    an application, kept in memory between the commands
+
+    Each request is a JSON object with the name of the command and its
+    arguments, like ``{"command": "set_rate", "interface": "eth0",
+    "classid": "1:10", "rate": 2000}``. The response is
+    ``{"result": ...}``, or ``{"error": message}`` if the command failed.
+    Each client is answered by its own thread, so a client keeping its
+    connection open does not block the others. The commands are still run
+    one at a time, by the methods ``command_<name>``.
+
+    With the netlink backend, all the commands go through the same netlink
+    socket. If watch is set, the files of the config and of the rules are
+    watched, and the rules are reloaded as soon as one of them is written.
+    The switches of the profiles run between the requests. The controllers
+    of the AUTORATE config run in their own thread, as their probes can wait
+    for up to their timeout: only their new rates wait for the requests.
+    """
+    #: the clients still connected do not prevent the daemon from stopping
+    daemon_threads = True
+
+    def __init__(self, app, path=SOCKET_PATH, watch=False):
+        self.app = app
+        self.path = path
+        self._poller = None
+        self._netlink_sock = None
+        self._watcher = None
+        #: held while a command or a service action uses the application
+        self._lock = threading.RLock()
+        #: :class:`pyqos.autorate.Autorate` of the application
+        self.controllers = []
+        self._runner = None
+        controllers = app.autorate_controllers()
+        app.load_scheduler()
+        if watch:
+            self.watch()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        # only root can control the daemon: the socket is created with this
+        # mode, so it is never reachable by the other users
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+        self.start_controllers(controllers)
+
+    def start_controllers(self, controllers):
+        """
+        Run some autorate controllers in the background, instead of the
+        current ones
+        """
+        if self._runner is not None:
+            # it may wait for the lock held by a command: it stops by itself
+            self._runner.stop()
+            self._runner = None
+        self.controllers = controllers
+        if controllers:
+            self._runner = _ControllerRunner(self, controllers)
+            self._runner.start()
+
+    def watch(self):
+        """
+        Watch the files of the config and of the rules
+        """
+        if self._watcher is not None:
+            self._watcher.close()
+        self._watcher = watch.Watcher(self.app.watched_files())
+
+    def service_actions(self):
+        """
+        Reload the rules if their files changed, and run the scheduled
+        switches, between two requests
+        """
+        with self._lock:
+            self._service_actions()
+
+    def _service_actions(self):
+        if self.app.scheduler is not None:
+            try:
+                with self.backend_batch():
+                    self.app.scheduler.run_pending()
+            except Exception:
+                _logger.exception("Cannot switch the profile")
+        if self._watcher is None:
+            return
+        changed = self._watcher.read()
+        if not changed:
+            return
+        _logger.info("%s changed, reloading the rules",
+                     ", ".join(sorted(changed)))
+        response = self.dispatch('{"command": "reload"}')
+        if "error" not in response:
+            _logger.info("Rules applied on: %s",
+                         ", ".join(response["result"]) or "nothing")
+        # the modules of the rules may have changed
+        files = set(map(os.path.abspath, self.app.watched_files()))
+        if files != self._watcher.paths:
+            self.watch()
+
+    def server_close(self):
+        runner = self._runner
+        self.start_controllers([])
+        if runner is not None:
+            runner.join()
+        super().server_close()
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        if self._netlink_sock is not None:
+            self._netlink_sock.close()
+            self._netlink_sock = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    def backend_batch(self):
+        """
+        Context in which a command sends its operations
+        """
+        backend_module = self.app.get_backend()
+        if hasattr(backend_module, "open_socket"):
+            if self._netlink_sock is None:
+                self._netlink_sock = backend_module.open_socket()
+            return backend_module.batch(
+                dryrun=self.app.config.get("DRYRUN", False),
+                sock=self._netlink_sock
+            )
+        return self.app.command_batch()
+
+    def dispatch(self, line):
+        """
+        Run the command of a request
+
+        :param line: request, as a JSON object
+        :return: response, as a dict
+        """
+        try:
+            request = json.loads(line.decode() if isinstance(line, bytes)
+                                 else line)
+            name = request.pop("command")
+        except (ValueError, KeyError, AttributeError, TypeError):
+            return {"error": "Invalid request: {!r}".format(line)}
+        command = getattr(self, "command_" + str(name), None)
+        if command is None:
+            return {"error": "Unknown command: {}".format(name)}
+        try:
+            inspect.signature(command).bind(**request)
+        except TypeError as e:
+            return {"error": "Bad arguments for {}: {}".format(name, e)}
+        _logger.debug("Command %s %r", name, request)
+        try:
+            with self._lock, self.backend_batch():
+                return {"result": command(**request)}
+        except Exception as e:
+            _logger.exception("Command %s failed", name)
+            return {"error": str(e)}
+
+    def command_apply(self):
+        """
+        Apply the trees, as the start subcommand
+        """
+        self.app.apply_qos()
+
+    def command_reload(self):
+        """
+        Load the config and the rules again, and apply the trees of the
+        interfaces whose rules changed
+
+        :return: list of the changed interfaces
+        """
+        self._poller = None
+        changed = self.app.reload()
+        # the controllers start again from the rates of the new trees
+        self.start_controllers(self.app.autorate_controllers())
+        return sorted(changed)
+
+    def command_set_rate(self, interface, classid, rate=None, ceil=None):
+        """
+        Change the rate and ceil of a class, and of the classes depending on
+        it, with class change operations
+
+        :return: number of classes changed
+        """
+        return len(self.app.update_rates({(interface, classid): (rate, ceil)}))
+
+    def command_stats(self):
+        """
+        Rates of the classes since the previous stats command
+
+        :return: list of dicts
+        """
+        if self._poller is None:
+            self._poller = stats.Poller(self.app.run_list,
+                                        backend_module=self.app.get_backend())
+        return [
+            {"interface": node.interface, "classid": node.classid,
+             "rate_bps": node_stats.rate_bps,
+             "rate_pps": node_stats.rate_pps,
+             "drop_rate": node_stats.drop_rate}
+            for node, node_stats in self._poller.sample().items()
+        ]
+
+    def command_autorate(self):
+        """
+        State of the controllers
+
+        :return: list of dicts
+        """
+        return [
+            {"interface": c.node.interface, "classid": c.node.classid,
+             "rate": c.rate, "rtt": c.rtt, "baseline": c.baseline}
+            for c in self.controllers
+        ]
+
+    def command_profile(self):
+        """
+        :return: name of the profile applied, None for the values of the
+            rules
+        """
+        if self.app.scheduler is None:
+            return None
+        return self.app.scheduler.profile
+
+    def command_show(self):
+        """
+        :return: lines of the show subcommand
+        """
+        return list(self.app.format_qos())
+
+    def command_plan(self, json=False):
+        """
+        :return: lines of the plan subcommand
+        """
+        return list(self.app.format_plan(json=json))
+
+
+def request(command, path=SOCKET_PATH, **args):
+    """
+    Send a command to a daemon and wait for its result
+
+    :raise CommandException: if the command failed
+    :return: result of the command
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(args, command=command)).encode() +
+                     b"\n")
+        with sock.makefile("rb") as response_file:
+            response = json.loads(response_file.readline().decode())
+    if "error" in response:
+        raise CommandException(response["error"])
+    return response["result"]
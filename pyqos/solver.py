@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Resolve the relative rates and ceils of a whole tree at once
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: speeds resolved by the solver
+SPEEDS = ("rate", "ceil")
+
+NAN = float("nan")
+
+
+def _flatten(top):
+    """
+    List the classes of a tree level by level
+
+    :return: (nodes, index of the parent of each node, bounds of the levels)
+    """
+    nodes, parents, bounds = [top], [-1], [0, 1]
+    start = 0
+    while start < len(nodes):
+        end = len(nodes)
+        for index in range(start, end):
+            for child in getattr(nodes[index], "children", None) or ():
+                nodes.append(child)
+                parents.append(index)
+        if len(nodes) > end:
+            bounds.append(len(nodes))
+        start = end
+    return nodes, parents, bounds
+
+
+def _parse_speed(value):
+    """
+    Split a rate or ceil as set on a class
+
+    :return: (relative, coeff, min, max, fixed value, known). The max and the
+        fixed value are NaN when they are the speed of the parent or None.
+    """
+    if type(value) is tuple:
+        return (True, value[0], value[1] if len(value) > 1 else 0,
+                value[2] if len(value) > 2 else NAN, NAN, True)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (False, 0, 0, NAN, value, True)
+    # something else than None, like a callback, cannot be solved
+    return (False, 0, 0, NAN, NAN, value is None)
+
+
+class _Speeds():
+    """
+    Relative or fixed values of a speed for all the nodes of a tree, as
+    arrays
+    """
+    def __init__(self, nodes, attr):
+        #: speeds as set, to be cached without being converted
+        self.raw = []
+        descriptors = {}
+        for node in nodes:
+            cls = type(node)
+            try:
+                descriptor = descriptors[cls]
+            except KeyError:
+                descriptor = descriptors[cls] = getattr(cls, attr)
+            self.raw.append(descriptor.raw(node))
+        table = numpy.array(
+            [_parse_speed(value) for value in self.raw], dtype=float
+        ).reshape(-1, 6)
+        self.relative, self.known = table[:, 0] != 0, table[:, 5] != 0
+        self.coeff, self.low, self.high, self.fixed = (
+            table[:, column].copy() for column in range(1, 5)
+        )
+        #: resolved values, NaN if None or unknown
+        self.values = self.fixed.copy()
+
+    def set(self, index, value):
+        """
+        Change the speed of a node
+        """
+        self.raw[index] = value
+        (self.relative[index], self.coeff[index], self.low[index],
+         self.high[index], self.fixed[index],
+         self.known[index]) = _parse_speed(value)
+
+    def solve(self, start, end, parent_speeds):
+        """
+        Resolve the values of the nodes from start to end, one level of the
+        tree, from the speeds of their parents
+        """
+        relative = self.relative[start:end]
+        high = self.high[start:end]
+        speeds = numpy.minimum(
+            numpy.maximum(parent_speeds * self.coeff[start:end] / 100,
+                          self.low[start:end]),
+            numpy.where(numpy.isnan(high), parent_speeds, high)
+        )
+        self.values[start:end] = numpy.where(
+            relative, numpy.trunc(speeds), self.fixed[start:end]
+        )
+        # a relative speed is unknown when the speed of its parent is None
+        # or unknown
+        self.known[start:end] = numpy.where(
+            relative, ~numpy.isnan(speeds), self.known[start:end]
+        )
+
+
+class RateSolver():
+    """
+    Solve the rates and ceils of all the classes of a tree, one level at a
+    time with NumPy, instead of resolving them class by class
+
+    The tree is flattened once: the solver can then be run again after a
+    change of the rate or ceil of the top class, like a new rate of the
+    link, without walking the tree again. A change of the other classes, or
+    of the structure of the tree, needs a new solver.
+    """
+    def __init__(self, top):
+        if numpy is None:
+            raise ImportError("The rate solver needs NumPy")
+        #: classes of the tree, level by level, from the top class
+        self.nodes, parents, self.bounds = _flatten(top)
+        self.parents = numpy.array(parents, dtype=numpy.intp)
+        self.speeds = {attr: _Speeds(self.nodes, attr) for attr in SPEEDS}
+
+    def solve(self):
+        """
+        Solve the speeds of all the classes
+
+        :return: {"rate": array, "ceil": array} of the speeds of
+            :attr:`nodes`, NaN when None or unknown
+        """
+        rate, ceil = self.speeds["rate"], self.speeds["ceil"]
+        top = self.nodes[0]
+        for speeds, attr in ((rate, "rate"), (ceil, "ceil")):
+            speeds.set(0, getattr(top, attr))
+            speeds.values[0] = speeds.fixed[0]
+        for start, end in zip(self.bounds[1:], self.bounds[2:]):
+            parents = self.parents[start:end]
+            rate.solve(start, end, rate.values[parents])
+            # a relative ceil uses the rate of the parent if it has no ceil
+            parent_ceils = numpy.where(
+                ceil.known[parents] & numpy.isnan(ceil.values[parents]),
+                rate.values[parents], ceil.values[parents]
+            )
+            ceil.solve(start, end, parent_ceils)
+        return {attr: self.speeds[attr].values for attr in SPEEDS}
+
+    def resolve(self):
+        """
+        Solve the speeds and cache them in the classes, as if they had been
+        resolved by their getters
+
+        The classes whose speeds cannot be solved, like a relative rate under
+        a class without rate, are left to their getters.
+        """
+        self.solve()
+        for attr in SPEEDS:
+            speeds = self.speeds[attr]
+            values, known = speeds.values.tolist(), speeds.known.tolist()
+            for index, node in enumerate(self.nodes):
+                if not known[index]:
+                    continue
+                value = speeds.raw[index]
+                if type(value) is tuple:
+                    value = int(values[index])
+                resolved = getattr(node, "_resolved", None)
+                if resolved is None:
+                    resolved = node._resolved = {}
+                resolved[attr] = value
+
+
+def resolve(top):
+    """
+    Resolve the speeds of all the classes of a tree with a
+    :class:`RateSolver`, if NumPy is installed
+
+    :return: True if the speeds have been solved
+    """
+    if numpy is None:
+        return False
+    RateSolver(top).resolve()
+    return True
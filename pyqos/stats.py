@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Sample the counters of the classes and compute their rates
+
+from collections import namedtuple
+import time
+
+from pyqos import backend
+from pyqos.backend import syntax
+from pyqos.exceptions import BadAttributeValueException, NoParentException
+
+#: statistics of a class between the two last samples
+#:
+#: :counters: last :class:`pyqos.backend.records.Stats` read for the class
+#: :rate_bps: throughput, in bit/s
+#: :rate_pps: throughput, in packets/s
+#: :drop_rate: dropped packets/s
+#: :interval: time between the two samples, in seconds
+ClassStats = namedtuple(
+    "ClassStats",
+    ("counters", "rate_bps", "rate_pps", "drop_rate", "interval")
+)
+
+
+def _delta(new, old):
+    # counters going back mean the class has been recreated
+    return new - old if new >= old else new
+
+
+def walk(node):
+    """
+    Iterate over a node and all its children classes
+    """
+    yield node
+    for child in getattr(node, "children", None) or ():
+        yield from walk(child)
+
+
+class Poller():
+    """
+    Sample the counters of every class of some trees, and attach their rates
+    to the nodes as a :class:`ClassStats`, in their ``stats`` attribute
+
+    Each sample reads one dump per interface through the backend, whatever
+    the number of classes.
+    """
+    #: time between two samples, in seconds
+    interval = 1
+
+    def __init__(self, roots, interval=None, backend_module=None,
+                 clock=time.monotonic):
+        """
+        :param roots: trees to sample, like the run_list of the application
+        :param interval: time between two samples, in seconds
+        :param backend_module: backend to use. If None, use the selected one.
+        :param clock: function returning the current time, in seconds
+        """
+        self.roots = list(roots)
+        self.interval = interval or self.interval
+        self.backend_module = backend_module
+        self.clock = clock
+        #: last counters read, by (interface, classid)
+        self._last = {}
+        #: time of the last sample
+        self._last_time = None
+
+    def nodes(self):
+        """
+        Classes of the trees, by (interface, classid)
+        """
+        nodes = {}
+        for root in self.roots:
+            for node in walk(root):
+                try:
+                    classid = syntax.format_handle(
+                        syntax.parse_classid(node.classid)
+                    )
+                    interface = node.interface
+                except (AttributeError, ValueError, BadAttributeValueException,
+                        NoParentException):
+                    continue
+                nodes[(interface, classid)] = node
+        return nodes
+
+    def sample(self):
+        """
+        Read the counters of all the classes and update their stats
+
+        The rates are only set from the second sample, as they need two
+        readings.
+
+        :return: dict {node: :class:`ClassStats`}
+        """
+        backend_module = self.backend_module or backend.get_backend()
+        nodes = self.nodes()
+        now = self.clock()
+        records = {}
+        for interface in sorted(set(i for i, _ in nodes)):
+            dump = backend_module.dump(interface, stats=True)
+            for classid, record in dump.classes.items():
+                if record.stats is not None:
+                    records[(interface, classid)] = record.stats
+
+        elapsed = (now - self._last_time
+                   if self._last_time is not None else None)
+        result = {}
+        for key, node in nodes.items():
+            counters = records.get(key)
+            if counters is None:
+                continue
+            last = self._last.get(key)
+            if last is None or not elapsed:
+                stats = ClassStats(counters, None, None, None, None)
+            else:
+                stats = ClassStats(
+                    counters,
+                    _delta(counters.bytes, last.bytes) * 8 / elapsed,
+                    _delta(counters.packets, last.packets) / elapsed,
+                    _delta(counters.drops, last.drops) / elapsed,
+                    elapsed,
+                )
+            node.stats = stats
+            result[node] = stats
+        self._last = records
+        self._last_time = now
+        return result
+
+    def run(self, callback=None, count=None):
+        """
+        Sample the classes every interval
+
+        :param callback: function called with the result of each sample
+        :param count: number of samples to do. If None, run until interrupted.
+        """
+        next_time = self.clock()
+        done = 0
+        while count is None or done < count:
+            result = self.sample()
+            done += 1
+            if callback is not None:
+                callback(result)
+            if count is not None and done >= count:
+                break
+            next_time += self.interval
+            time.sleep(max(next_time - self.clock(), 0))
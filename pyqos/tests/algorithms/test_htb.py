@@ -0,0 +1,137 @@
+import pytest
+
+from pyqos import plan
+from pyqos.algorithms.htb import HTBClass, HTBFilterSFQ, RootHTBClass
+from pyqos.exceptions import BadAttributeValueException
+
+
+class Interactive(HTBFilterSFQ):
+    __slots__ = ()
+
+    id = 20
+    mark = 20
+    rate = (10, 200, 1000)
+    ceil = (50, 100)
+    burst = (lambda obj: obj.rate // 8, )
+
+
+@pytest.fixture
+def fixture_tree():
+    root = RootHTBClass("eth0", rate=10000, ceil=10000)
+    main = HTBClass(id=2, rate=(50, 100))
+    root.add_child(main)
+    main.add_child(Interactive(), Interactive(id=30, mark=30, rate=300))
+    return root
+
+
+def test_relative_rates(fixture_tree):
+    main = fixture_tree.children[0]
+    interactive, other = main.children
+
+    assert main.rate == 5000
+    assert (interactive.rate, interactive.ceil) == (500, 2500)
+    assert interactive.burst == 62
+    assert (other.id, other.mark, other.rate) == (30, 30, 300)
+    assert interactive.classid == "1:20"
+    assert interactive.qdisc.id == 20
+
+
+def test_nodes_share_their_class(fixture_tree):
+    interactive, other = fixture_tree.children[0].children
+    assert type(interactive) is type(other) is Interactive
+    assert not hasattr(interactive, "__dict__")
+
+
+def test_rates_follow_parent(fixture_tree):
+    main = fixture_tree.children[0]
+    interactive = main.children[0]
+    main.rate = 8000
+    assert interactive.rate == 800
+
+
+def test_resolved_values_cached(fixture_tree, mocker):
+    interactive = fixture_tree.children[0].children[0]
+    spy = mocker.spy(HTBClass, "_compute_speeds")
+    assert interactive.rate == 500
+    assert interactive.rate == 500
+    assert interactive.burst == 62
+    # rate of interactive and main, computed once
+    assert spy.call_count == 2
+
+
+def test_resolved_values_invalidation(fixture_tree):
+    main = fixture_tree.children[0]
+    interactive = main.children[0]
+    assert (interactive.rate, interactive.burst) == (500, 62)
+
+    fixture_tree.rate = 8000
+    assert (interactive.rate, interactive.burst) == (400, 50)
+
+    interactive.burst = 10
+    assert interactive.burst == 10
+
+    other_main = HTBClass(id=3, rate=2000)
+    fixture_tree.add_child(other_main)
+    main.children.remove(interactive)
+    other_main.add_child(interactive)
+    assert interactive.rate == 200
+
+
+def test_mark_classid(fixture_tree):
+    fixture_tree.mark_classid = True
+    interactive, other = fixture_tree.children[0].children
+
+    filters = [op for op in plan.record([fixture_tree])
+               if op.kind == "filter"]
+    assert [op.args for op in filters] == [
+        {"parent": "1:", "prio": 1, "protocol": "all"}
+    ]
+    assert (interactive.fw_mark, other.fw_mark) == (0x10020, 0x10030)
+
+    fixture_tree.mark_classid = False
+    assert interactive.fw_mark == 20
+
+
+def test_match_flower(fixture_tree):
+    main = fixture_tree.children[0]
+    main.add_child(
+        HTBClass(id=40, rate=100, prio=2,
+                 match={"ip_proto": "tcp", "dst_port": 22}),
+        HTBClass(id=50, rate=100, match_prio=3, dscp="EF",
+                 match=[{"dst_ip": "2001:db8::/32"}]),
+    )
+
+    filters = [(op.args["prio"], op.args["protocol"], op.args.get("flowid"),
+                op.args.get("dst_port"), op.args.get("ip_tos"))
+               for op in plan.record([fixture_tree])
+               if op.kind == "filter" and op.args.get("kind") == "flower"]
+    assert filters == [(2, "ip", "1:40", 22, None),
+                       (3, "ipv6", "1:50", None, "0xb8/0xfc")]
+
+    main.children[-1].match = {"dport": 22}
+    with pytest.raises(BadAttributeValueException):
+        plan.record([fixture_tree])
+
+
+def test_filter_chains():
+    root = RootHTBClass("eth0", rate=10000, filter_chains=True)
+    root.add_child(
+        HTBClass(id=10, rate=100, prio=2,
+                 match=[{"ip_proto": "tcp", "dst_port": 22},
+                        {"ip_proto": "udp", "dst_port": 53}]),
+        HTBClass(id=20, rate=100, prio=3, dscp="EF"),
+        HTBClass(id=30, rate=100, prio=4,
+                 match={"ip_proto": "tcp", "dst_port": 80}),
+    )
+
+    filters = [(op.args.get("chain", 0), op.args["prio"],
+                op.args.get("flowid"), op.args.get("goto_chain"))
+               for op in plan.record([root]) if op.kind == "filter"]
+    assert filters == [
+        (1, 2, "1:10", None), (2, 2, "1:10", None),
+        # the rules without protocol are in every chain
+        (0, 3, "1:20", None), (1, 3, "1:20", None), (2, 3, "1:20", None),
+        (1, 4, "1:30", None),
+        # dispatch
+        (0, 2, None, 1), (0, 2, None, 2),
+    ]
@@ -0,0 +1,83 @@
+import pytest
+
+from pyqos import plan
+from pyqos.algorithms.classless_qdiscs import PFIFO
+from pyqos.algorithms.htb import HTBClass, HTBFilterFQCodel, RootHTBClass
+from pyqos.algorithms.mq import MQRoot
+from pyqos.allocator import Allocator
+from pyqos.exceptions import ConflictException
+
+
+class Uplink(MQRoot):
+    __slots__ = ()
+
+    rate = 3000
+    num_queues = 3
+
+    def tree(self, queue):
+        root = RootHTBClass(queue.interface, branch_id=queue.branch_id,
+                            qdisc_parent=queue.classid, rate=queue.rate,
+                            r2q=10)
+        root.add_child(HTBClass(id=10, rate=(50, 10)))
+        return root
+
+
+def test_mq_tree_per_queue():
+    operations = plan.record([Uplink("eth0")])
+    qdiscs = [(op.args.get("parent"), op.args["handle"], op.args["algorithm"])
+              for op in operations if op.kind == "qdisc"]
+    assert qdiscs == [(None, "1:", "mq"), ("1:1", "fe00:", "htb"),
+                      ("1:2", "fe02:", "htb"), ("1:3", "fe04:", "htb")]
+
+    classes = [(op.args["classid"], op.args["rate"])
+               for op in operations if op.kind == "class"]
+    assert classes[:2] == [("fe00:1", 1000), ("fe00:10", 500)]
+    assert len(classes) == 6
+
+
+def test_mq_classless_queues(mocker):
+    mocker.patch("pyqos.interfaces.get_info",
+                 return_value=mocker.Mock(num_tx_queues=12))
+    root = MQRoot("eth0", branch_id=2, tree=lambda queue: PFIFO(parent=queue))
+
+    operations = plan.record([root])
+    assert len(operations) == 13
+    assert operations[-1].args == {"parent": "2:c", "handle": "fe16",
+                                   "algorithm": "pfifo"}
+
+
+def leaf_tree(leaf_id):
+    def tree(queue):
+        root = RootHTBClass(queue.interface, branch_id=queue.branch_id,
+                            qdisc_parent=queue.classid, rate=queue.rate)
+        root.add_child(HTBFilterFQCodel(id=leaf_id(queue, 0x10), mark=1,
+                                        rate=(50, )),
+                       HTBFilterFQCodel(id=leaf_id(queue, 0x20), mark=2,
+                                        rate=(50, )))
+        return root
+    return tree
+
+
+def test_mq_leaf_qdiscs():
+    root = MQRoot("eth0", rate=3000, num_queues=3,
+                  tree=leaf_tree(lambda queue, n: queue.leaf_id(n)))
+
+    operations = plan.record([root])
+    handles = [op.args["handle"] for op in operations if op.kind == "qdisc"]
+    assert len(set(handles)) == len(handles) == 10
+    assert [tree.spare_branch_id for tree in root.children] == [
+        "fe01", "fe03", "fe05"
+    ]
+
+    # the queues share the marks, but not the qdisc handles
+    allocator = Allocator(root)
+    leaf, = allocator.add(root.children[1], HTBFilterFQCodel(rate=100))
+    assert leaf.id not in ("110", "120", "210", "220", "310", "320")
+
+
+def test_mq_leaf_conflict():
+    root = MQRoot("eth0", rate=3000, num_queues=2,
+                  tree=leaf_tree(lambda queue, n: n))
+
+    with pytest.raises(ConflictException):
+        plan.record([root])
@@ -0,0 +1,80 @@
+import io
+
+import pytest
+
+from pyqos import plan
+from pyqos.algorithms.htb import RootHTBClass
+from pyqos.algorithms.subscribers import add_subscribers, read_csv
+from pyqos.algorithms.u32 import HTBHashFilter
+from pyqos.exceptions import BadAttributeValueException
+
+PLANS = {
+    "basic": {"rate": 1000, "ceil": 10000},
+    "pro": {"rate": 5000, "ceil": 50000, "prio": 1},
+}
+
+
+def fixture_hash_filter():
+    root = RootHTBClass("eth0", rate=100000, r2q=10)
+    hosts = HTBHashFilter(network="10.1.0.0/16", direction="dst", id=2,
+                          rate=100000, prio=2)
+    root.add_child(hosts)
+    return root, hosts
+
+
+def test_read_csv():
+    table = io.StringIO("id,address,plan,name\n"
+                        "a1,10.1.0.2,basic,Alice\n"
+                        "b2,10.1.0.3,pro,Bob\n")
+
+    rows = list(read_csv(table))
+
+    assert [(r["id"], r["address"], r["plan"]) for r in rows] == [
+        ("a1", "10.1.0.2", "basic"), ("b2", "10.1.0.3", "pro")
+    ]
+
+
+def test_read_csv_missing_column():
+    with pytest.raises(BadAttributeValueException):
+        list(read_csv(io.StringIO("id,plan\na1,basic\n")))
+
+
+def test_add_subscribers():
+    root, hosts = fixture_hash_filter()
+    rows = [("a1", "10.1.0.2", "basic"),
+            {"id": "b2", "address": "10.1.0.3", "plan": "pro"}]
+
+    subscribers = add_subscribers(hosts, rows, PLANS, first_mark=0x100)
+
+    assert [s.classid for s in subscribers] == ["1:100", "1:101"]
+    assert [s.subscriber for s in subscribers] == ["a1", "b2"]
+    assert [(s.rate, s.ceil, s.prio) for s in subscribers] == [
+        (1000, 10000, None), (5000, 50000, 1)
+    ]
+    assert [s.mark for s in subscribers] == [0x100, 0x101]
+    assert list(hosts.hosts()) == [("10.1.0.2", "1:100"),
+                                   ("10.1.0.3", "1:101")]
+
+
+def test_add_subscribers_without_mark():
+    root, hosts = fixture_hash_filter()
+    add_subscribers(hosts, [("a1", "10.1.0.2", "basic")], PLANS)
+
+    operations = list(plan.record([root]))
+
+    assert not [op for op in operations
+                if op.kind == "filter" and op.args.get("kind", "fw") == "fw"]
+    assert [op.args["flowid"] for op in operations
+            if "flowid" in op.args] == ["1:100"]
+    assert [op.args.get("parent") for op in operations
+            if op.kind == "qdisc"] == [None, "1:100"]
+
+
+def test_add_subscribers_errors():
+    root, hosts = fixture_hash_filter()
+
+    with pytest.raises(BadAttributeValueException):
+        add_subscribers(hosts, [("a1", "10.1.0.2", "gold")], PLANS)
+    with pytest.raises(BadAttributeValueException):
+        add_subscribers(hosts, [("a1", "10.1.0.2", "basic")] * 2, PLANS,
+                        first_id=0xFFFF)
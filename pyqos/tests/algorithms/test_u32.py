@@ -0,0 +1,61 @@
+import pytest
+
+from pyqos import plan
+from pyqos.algorithms.htb import RootHTBClass
+from pyqos.algorithms.u32 import HTBHashFilter, HTBHost, hash_operations
+from pyqos.exceptions import BadAttributeValueException
+
+
+def fixture_tree(network, addresses):
+    root = RootHTBClass("eth0", rate=10000, r2q=10)
+    hosts = HTBHashFilter(network=network, direction="dst", id=2,
+                          rate=10000, prio=2)
+    root.add_child(hosts)
+    for i, address in enumerate(addresses):
+        hosts.add_child(HTBHost(address=address, id=30 + i, rate=100))
+    return root
+
+
+def filter_args(roots):
+    return [op.args for op in plan.record(roots) if op.kind == "filter"]
+
+
+def test_hash_filter_two_levels():
+    args = filter_args([fixture_tree(
+        "10.1.0.0/16", ["10.1.3.9", "10.1.3.7", "10.1.0.5", "10.2.0.1"]
+    )])
+
+    assert all((a["parent"], a["prio"], a["protocol"], a["kind"]) ==
+               ("1:", 2, "ip", "u32") for a in args)
+    assert [a.get("handle") for a in args[:3]] == ["10:", "11:", "12:"]
+    assert [(a["ht"], a["flowid"], a["match"]) for a in args[3:6]] == [
+        ("11:5:", "1:32", [(0x0A010005, 0xFFFFFFFF, 16)]),
+        ("12:7:", "1:31", [(0x0A010307, 0xFFFFFFFF, 16)]),
+        ("12:9:", "1:30", [(0x0A010309, 0xFFFFFFFF, 16)]),
+    ]
+    assert [(a["ht"], a["link"], a["hashkey"]) for a in args[6:8]] == [
+        ("10:0:", "11:", (0xFF, 16)), ("10:3:", "12:", (0xFF, 16))
+    ]
+    assert args[8]["link"] == "10:"
+    assert args[8]["match"] == [(0x0A010000, 0xFFFF0000, 16)]
+    assert args[8]["hashkey"] == (0xFF00, 16)
+    assert len(args) == 9
+
+
+def test_hash_filter_one_level():
+    args = filter_args([fixture_tree("192.168.1.0/24", ["192.168.1.2"])])
+
+    assert [(a.get("handle"), a.get("ht"), a.get("link")) for a in args] == [
+        ("10:", None, None), (None, "10:2:", None), (None, None, "10:")
+    ]
+
+
+def test_hash_filter_too_large():
+    with pytest.raises(BadAttributeValueException):
+        list(hash_operations("eth0", "1:", 1, "10.0.0.0/8", []))
+
+
+def test_hash_filter_bad_network():
+    # the host bits have to be unset
+    with pytest.raises(BadAttributeValueException, match="10.0.0.1/24"):
+        list(hash_operations("eth0", "1:", 1, "10.0.0.1/24", []))
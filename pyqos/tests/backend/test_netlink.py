@@ -0,0 +1,270 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from pyqos import tools
+from pyqos.backend import netlink
+
+
+NETIF = "eth0"
+IFINDEX = 3
+
+
+class FakeNetlinkPeer():
+    """
+    Fake kernel side of a netlink socket: records the received messages and
+    acknowledges them
+    """
+    def __init__(self, errors=None):
+        self.sock, self.client = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+        #: error code to answer, by sequence number
+        self.errors = errors or {}
+        #: received datagrams, as lists of parsed messages
+        self.datagrams = []
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    @property
+    def messages(self):
+        return [msg for datagram in self.datagrams for msg in datagram]
+
+    def _serve(self):
+        while True:
+            try:
+                data = self.sock.recv(1 << 16)
+            except OSError:
+                # closed by the fixture
+                return
+            if not data:
+                return
+            messages = netlink.parse_nlmsgs(data)
+            self.datagrams.append(messages)
+            acks = b""
+            for msg_type, flags, seq, payload in messages:
+                error = self.errors.get(seq, 0)
+                acks += netlink.nlmsg(
+                    netlink.NLMSG_ERROR, 0, seq,
+                    struct.pack("=i", error) + payload[:16]
+                )
+            self.sock.send(acks)
+
+    def close(self):
+        self.client.close()
+        self.sock.close()
+
+
+@pytest.fixture
+def fixture_peer(monkeypatch):
+    monkeypatch.setattr("pyqos.backend.netlink.get_ifindex",
+                        lambda interface: IFINDEX)
+    peers = []
+
+    def new_peer(errors=None):
+        peer = FakeNetlinkPeer(errors)
+        monkeypatch.setattr("pyqos.backend.netlink.open_socket",
+                            lambda: peer.client)
+        peers.append(peer)
+        return peer
+
+    yield new_peer
+    tools.set_batch(None)
+    for peer in peers:
+        peer.sock.close()
+
+
+def parse_tc_message(payload):
+    family, ifindex, handle, parent, info = struct.unpack_from(
+        "=BxxxiIII", payload
+    )
+    return (ifindex, handle, parent, info), netlink.parse_attrs(payload[20:])
+
+
+def test_parse_classid():
+    assert netlink.parse_classid("1:10") == 0x10010
+    assert netlink.parse_classid("1:") == 0x10000
+    assert netlink.parse_classid("root") == netlink.TC_H_ROOT
+    assert netlink.parse_qdisc_handle("100") == 0x1000000
+    assert netlink.parse_qdisc_handle("1:") == 0x10000
+
+
+def test_parse_units():
+    assert netlink.parse_rate("400kbit") == 50000
+    assert netlink.parse_rate("5000kbps") == 5000000
+    assert netlink.parse_size("100k") == 102400
+    assert netlink.parse_time("5ms") == 5000
+
+
+def test_qdisc_add_htb_root(fixture_peer):
+    peer = fixture_peer()
+    netlink.qdisc_add(NETIF, handle="1:", algorithm="htb", default=1500,
+                      r2q=None)
+
+    (msg_type, flags, seq, payload), = peer.messages
+    assert msg_type == netlink.RTM_NEWQDISC
+    assert flags & netlink.NLM_F_CREATE and flags & netlink.NLM_F_EXCL
+    header, attrs = parse_tc_message(payload)
+    assert header == (IFINDEX, 0x10000, netlink.TC_H_ROOT, 0)
+    assert attrs[netlink.TCA_KIND] == b"htb\0"
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    version, r2q, defcls, _, _ = struct.unpack(
+        "=IIIII", options[netlink.TCA_HTB_INIT]
+    )
+    assert (version, r2q, defcls) == (3, 10, 0x1500)
+
+
+def test_qos_class_add_htb(fixture_peer):
+    peer = fixture_peer()
+    netlink.qos_class_add(NETIF, parent="1:1", classid="1:10", rate=400,
+                          ceil=800, burst=10, prio=1, quantum=1514)
+
+    (msg_type, _, _, payload), = peer.messages
+    assert msg_type == netlink.RTM_NEWTCLASS
+    header, attrs = parse_tc_message(payload)
+    assert header == (IFINDEX, 0x10010, 0x10001, 0)
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    parms = options[netlink.TCA_HTB_PARMS]
+    rate = struct.unpack_from("=BBHhHI", parms)[5]
+    ceil = struct.unpack_from("=BBHhHI", parms, 12)[5]
+    quantum, level, prio = struct.unpack_from("=III", parms, 32)
+    assert (rate, ceil, quantum, prio) == (50000, 100000, 1514, 1)
+
+
+def test_filter_add_fw(fixture_peer):
+    peer = fixture_peer()
+    netlink.filter_add(NETIF, parent="1:", prio=10, handle=100,
+                       flowid="1:100")
+
+    (msg_type, _, _, payload), = peer.messages
+    assert msg_type == netlink.RTM_NEWTFILTER
+    header, attrs = parse_tc_message(payload)
+    assert header == (IFINDEX, 100, 0x10000,
+                      10 << 16 | socket.htons(0x0003))
+    assert attrs[netlink.TCA_KIND] == b"fw\0"
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    assert struct.unpack("=I", options[netlink.TCA_FW_CLASSID]) == (0x10100,)
+
+
+def test_filter_fw_mark_classid(fixture_peer):
+    peer = fixture_peer()
+    netlink.filter(NETIF, "add", prio=1, parent="1:")
+
+    (msg_type, _, _, payload), = peer.messages
+    header, attrs = parse_tc_message(payload)
+    assert header == (IFINDEX, 0, 0x10000, 1 << 16 | socket.htons(0x0003))
+    assert attrs[netlink.TCA_KIND] == b"fw\0"
+    assert netlink.TCA_OPTIONS not in attrs
+
+
+def test_filter_add_u32(fixture_peer):
+    peer = fixture_peer()
+    with netlink.batch():
+        netlink.filter_add(NETIF, parent="1:", prio=2, handle=None,
+                           flowid="1:20", protocol="ip", kind="u32",
+                           ht="10:3:", match=[(0x0A010305, 0xFFFFFFFF, 16)])
+        netlink.filter_add(NETIF, parent="1:", prio=2, handle="11:",
+                           flowid=None, protocol="ip", kind="u32",
+                           divisor=256)
+
+    (_, _, _, rule), (_, _, _, table) = peer.messages
+    header, attrs = parse_tc_message(rule)
+    assert attrs[netlink.TCA_KIND] == b"u32\0"
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    assert struct.unpack("=I", options[netlink.TCA_U32_HASH]) == (
+        0x10 << 20 | 3 << 12,
+    )
+    assert struct.unpack("=I", options[netlink.TCA_U32_CLASSID]) == (
+        0x10020,
+    )
+    sel = options[netlink.TCA_U32_SEL]
+    flags, _, nkeys = struct.unpack_from("=BBB", sel)
+    assert (flags, nkeys) == (netlink.TC_U32_TERMINAL, 1)
+    assert struct.unpack_from(">II", sel, 16) == (0xFFFFFFFF, 0x0A010305)
+    assert struct.unpack_from("=i", sel, 24) == (16,)
+
+    header, attrs = parse_tc_message(table)
+    assert header[1] == 0x11 << 20
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    assert struct.unpack("=I", options[netlink.TCA_U32_DIVISOR]) == (256,)
+    assert netlink.TCA_U32_SEL not in options
+
+
+def test_filter_add_flower(fixture_peer):
+    peer = fixture_peer()
+    netlink.filter_add(NETIF, parent="1:", prio=3, handle=None,
+                       flowid="1:10", protocol="ip", kind="flower",
+                       ip_proto="tcp", src_ip="10.0.0.0/8", dst_port=22,
+                       ip_tos="0xb8/0xfc")
+
+    (_, _, _, payload), = peer.messages
+    header, attrs = parse_tc_message(payload)
+    assert attrs[netlink.TCA_KIND] == b"flower\0"
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    assert options == {
+        netlink.TCA_FLOWER_CLASSID: struct.pack("=I", 0x10010),
+        netlink.TCA_FLOWER_KEY_ETH_TYPE: b"\x08\x00",
+        netlink.TCA_FLOWER_KEY_IP_PROTO: b"\x06",
+        netlink.TCA_FLOWER_KEY_IPV4_SRC: b"\x0a\x00\x00\x00",
+        netlink.TCA_FLOWER_KEY_IPV4_SRC + 1: b"\xff\x00\x00\x00",
+        netlink.FLOWER_PORTS[6][1]: b"\x00\x16",
+        netlink.TCA_FLOWER_KEY_IP_TOS: b"\xb8",
+        netlink.TCA_FLOWER_KEY_IP_TOS_MASK: b"\xfc",
+    }
+
+
+def test_filter_goto_chain(fixture_peer):
+    peer = fixture_peer()
+    netlink.filter_add(NETIF, parent="1:", prio=2, handle=None, flowid=None,
+                       protocol="ip", kind="u32", chain=2, goto_chain=3,
+                       match=[(6 << 16, 0xFF << 16, 8)])
+
+    (_, _, _, payload), = peer.messages
+    header, attrs = parse_tc_message(payload)
+    assert struct.unpack("=I", attrs[netlink.TCA_CHAIN]) == (2, )
+    options = netlink.parse_attrs(attrs[netlink.TCA_OPTIONS])
+    assert options[netlink.TCA_U32_SEL][0] == netlink.TC_U32_TERMINAL
+    action = netlink.parse_attrs(netlink.parse_attrs(
+        options[netlink.FILTER_ACTIONS["u32"]]
+    )[1])
+    assert action[netlink.TCA_ACT_KIND] == b"gact\0"
+    parms = netlink.parse_attrs(action[netlink.TCA_ACT_OPTIONS])
+    assert struct.unpack("=IIiii", parms[netlink.TCA_GACT_PARMS])[2] == (
+        netlink.TC_ACT_GOTO_CHAIN | 3
+    )
+
+
+def test_batch_pipelines_messages(fixture_peer):
+    peer = fixture_peer()
+    with netlink.batch():
+        netlink.qdisc_add(NETIF, handle="1:", algorithm="htb")
+        netlink.qos_class_add(NETIF, parent="1:", classid="1:1", rate=1000)
+        netlink.qdisc_add(NETIF, handle="10", parent="1:1", algorithm="sfq",
+                          perturb=10)
+        assert not peer.datagrams
+
+    assert len(peer.datagrams) == 1
+    assert [msg[0] for msg in peer.datagrams[0]] == [
+        netlink.RTM_NEWQDISC, netlink.RTM_NEWTCLASS, netlink.RTM_NEWQDISC
+    ]
+
+
+def test_pipeline_failed_messages_origin(fixture_peer):
+    peer = fixture_peer(errors={2: -17})
+    origin = object()
+
+    pipeline = netlink.Pipeline(sock=peer.client)
+    tools.set_batch(pipeline)
+    netlink.qdisc_add(NETIF, handle="1:", algorithm="htb")
+    with tools.command_origin(origin):
+        netlink.qos_class_add(NETIF, parent="1:", classid="1:1", rate=1000)
+    tools.set_batch(None)
+    failed = pipeline.flush()
+
+    assert len(failed) == 1
+    description, failed_origin, message = failed[0]
+    assert failed_origin is origin
+    assert description.startswith("tc class add dev eth0 parent 1:")
+    assert message == "File exists"
@@ -1,8 +1,13 @@
 
+import subprocess
+
 import pytest
 
 import pyqos.backend.tc
 from pyqos.backend import tc
+from pyqos.backend.records import (
+    ClassRecord, Dump, FilterRecord, QDiscRecord, Stats
+)
 
 
 NETIF = "eth0"
@@ -71,12 +76,16 @@ def test_qdisc_del(fixture_qdisc_wrapper):
     assert calls[0] == calls[1]
 
 
-def test_qdisc_show(fixture_disable_commands):
-    launch_cmd_spy = fixture_disable_commands
+def test_qdisc_show(monkeypatch, mocker):
+    dump = mocker.Mock(return_value=Dump(NETIF, qdiscs=[
+        QDiscRecord(NETIF, "htb", "1:", "root", {}, Stats(bytes=42))
+    ]))
+    monkeypatch.setattr("pyqos.backend.tc.dump", dump)
 
-    tc.qdisc_show()
-    expected_cmd = ["tc", "qdisc", "show"]
-    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+    qdiscs = tc.qdisc_show(interface=[NETIF, "eth1"])
+    dump.assert_any_call(NETIF, True)
+    dump.assert_any_call("eth1", True)
+    assert [q.stats.bytes for q in qdiscs] == [42, 42]
 
 
 def test_qos_class(fixture_disable_commands):
@@ -152,12 +161,15 @@ def test_qos_class_del(fixture_qos_class_wrapper):
     assert calls[0] == calls[1]
 
 
-def test_qos_class_show(fixture_disable_commands):
-    launch_cmd_spy = fixture_disable_commands
+def test_qos_class_show(monkeypatch, mocker):
+    dump = mocker.Mock(return_value=Dump(NETIF, classes=[
+        ClassRecord(NETIF, "htb", "1:10", "1:1", None, 8, 8, 1, 1, 0, 1)
+    ]))
+    monkeypatch.setattr("pyqos.backend.tc.dump", dump)
 
-    tc.qos_class_show(interface=NETIF)
-    expected_cmd = ["tc", "class", "show", "dev", NETIF]
-    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+    classes = tc.qos_class_show(interface=NETIF)
+    dump.assert_called_once_with(NETIF, True)
+    assert [c.classid for c in classes] == ["1:10"]
 
 
 def test_filter(fixture_disable_commands):
@@ -187,6 +199,61 @@ def test_filter_with_parent(fixture_disable_commands):
     launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
 
 
+def test_filter_mark_classid(fixture_disable_commands):
+    launch_cmd_spy = fixture_disable_commands
+
+    tc.filter(interface=NETIF, action="add", prio=1, parent="1:")
+    expected_cmd = [
+        "tc", "filter", "add", "dev", NETIF, "parent", "1:",
+        "protocol", "all", "prio", "1", "fw"
+    ]
+    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+
+
+def test_filter_u32(fixture_disable_commands):
+    launch_cmd_spy = fixture_disable_commands
+
+    tc.filter(interface=NETIF, action="add", prio=2, parent="1:",
+              protocol="ip", kind="u32", ht="10:3:", flowid="1:20",
+              match=[(0x0A010300, 0xFFFFFF00, 16)], hashkey=(0xFF, 16),
+              link="11:")
+    expected_cmd = [
+        "tc", "filter", "add", "dev", NETIF, "parent", "1:",
+        "protocol", "ip", "prio", "2", "u32", "ht", "10:3:",
+        "match", "u32", "0x0a010300", "0xffffff00", "at", "16",
+        "hashkey", "mask", "0x000000ff", "at", "16", "link", "11:",
+        "flowid", "1:20"
+    ]
+    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+
+
+def test_filter_flower(fixture_disable_commands):
+    launch_cmd_spy = fixture_disable_commands
+
+    tc.filter(interface=NETIF, action="add", prio=3, parent="1:",
+              protocol="ip", kind="flower", flowid="1:10", dst_port=22,
+              ip_tos="0xb8/0xfc", ip_proto="tcp")
+    expected_cmd = [
+        "tc", "filter", "add", "dev", NETIF, "parent", "1:",
+        "protocol", "ip", "prio", "3", "flower", "ip_proto", "tcp",
+        "dst_port", "22", "ip_tos", "0xb8/0xfc", "flowid", "1:10"
+    ]
+    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+
+
+def test_filter_goto_chain(fixture_disable_commands):
+    launch_cmd_spy = fixture_disable_commands
+
+    tc.filter(interface=NETIF, action="add", prio=2, parent="1:",
+              protocol="ip", kind="flower", ip_proto="tcp", goto_chain=1)
+    expected_cmd = [
+        "tc", "filter", "add", "dev", NETIF, "parent", "1:",
+        "protocol", "ip", "prio", "2", "flower", "ip_proto", "tcp",
+        "action", "goto", "chain", "1"
+    ]
+    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+
+
 @pytest.fixture
 def fixture_filter_wrapper(fixture_disable_commands):
     kwargs = {
@@ -220,9 +287,182 @@ def test_filter_del(fixture_filter_wrapper):
     assert calls[0] == calls[1]
 
 
-def test_filter_show(fixture_disable_commands):
-    launch_cmd_spy = fixture_disable_commands
+def test_filter_show(monkeypatch, mocker):
+    dump = mocker.Mock(return_value=Dump(NETIF, filters=[
+        FilterRecord(NETIF, "fw", "1:", "all", 1, 10, "1:10")
+    ]))
+    monkeypatch.setattr("pyqos.backend.tc.dump", dump)
 
-    tc.filter_show(interface=NETIF)
-    expected_cmd = ["tc", "filter", "show", "dev", NETIF]
-    launch_cmd_spy.assert_called_with(expected_cmd, dryrun=False)
+    filters = tc.filter_show(interface=NETIF)
+    dump.assert_called_once_with(NETIF, False)
+    assert [f.flowid for f in filters] == ["1:10"]
+
+
+@pytest.fixture
+def fixture_batch_process(monkeypatch, mocker):
+    process = mocker.Mock(stderr="")
+    run_spy = mocker.Mock(return_value=process)
+    monkeypatch.setattr("pyqos.backend.tc.subprocess.run", run_spy)
+
+    return run_spy, process
+
+
+def test_batch_queue_commands(fixture_batch_process):
+    run_spy, _ = fixture_batch_process
+
+    with tc.batch():
+        tc.qdisc_add(NETIF, handle="1:", algorithm="htb")
+        tc.qos_class_add(NETIF, parent="1:", classid="1:10", rate=400)
+        tc.qdisc_add("eth1", handle="1:", algorithm="htb")
+        assert not run_spy.called
+
+    assert run_spy.call_count == 2
+    args, kwargs = run_spy.call_args_list[0]
+    assert args[0] == ["tc", "-force", "-batch", "-"]
+    assert kwargs["input"] == (
+        "qdisc add dev eth0 root handle 1: htb\n"
+        "class add dev eth0 parent 1: classid 1:10 htb rate 400kbit\n"
+    )
+
+
+def test_batch_nested(fixture_batch_process):
+    run_spy, _ = fixture_batch_process
+
+    with tc.batch() as outer_batch:
+        with tc.batch() as inner_batch:
+            tc.qdisc_add(NETIF, handle="1:", algorithm="htb")
+        assert inner_batch is outer_batch
+        assert not run_spy.called
+    assert run_spy.call_count == 1
+
+
+def test_batch_dryrun_commands(fixture_batch_process):
+    run_spy, _ = fixture_batch_process
+
+    # a dry run command is not queued, so it is not launched by the flush
+    with tc.batch() as command_batch:
+        tc.qdisc_add(NETIF, handle="1:", algorithm="htb", dryrun=True)
+        assert not command_batch.queues.get(NETIF)
+    assert not run_spy.called
+
+
+def test_batch_failed_lines_origin(fixture_batch_process):
+    run_spy, process = fixture_batch_process
+    process.stderr = (
+        "RTNETLINK answers: File exists\nCommand failed -:2\n"
+    )
+    origin = object()
+
+    command_batch = tc.Batch()
+    command_batch.add(["tc", "qdisc", "add", "dev", NETIF, "root"])
+    command_batch.add(
+        ["tc", "class", "add", "dev", NETIF, "parent", "1:"], origin=origin
+    )
+    failed = command_batch.flush()
+
+    assert failed == [(
+        ["tc", "class", "add", "dev", NETIF, "parent", "1:"], origin,
+        "RTNETLINK answers: File exists"
+    )]
+    assert not command_batch.queues
+
+
+def test_batch_ignore_devnull_failures(fixture_batch_process):
+    run_spy, process = fixture_batch_process
+    process.stderr = "Error: Cannot delete qdisc\nCommand failed -:1\n"
+
+    command_batch = tc.Batch()
+    command_batch.add(
+        ["tc", "qdisc", "delete", "dev", NETIF, "root"],
+        stderr=subprocess.DEVNULL
+    )
+    assert command_batch.flush() == []
+    assert run_spy.call_count == 1
+
+
+def test_batch_flush_full_queue(fixture_batch_process, monkeypatch):
+    run_spy, process = fixture_batch_process
+    process.stderr = "Error: Exclusivity flag on\nCommand failed -:1\n"
+    monkeypatch.setattr(tc.Batch, "max_queued", 2)
+
+    command_batch = tc.Batch()
+    command_batch.add(["tc", "qdisc", "add", "dev", NETIF, "root"])
+    command_batch.add(["tc", "class", "add", "dev", NETIF, "parent", "1:"])
+    assert run_spy.call_count == 1
+    assert not command_batch.queues[NETIF]
+
+    process.stderr = ""
+    command_batch.add(["tc", "class", "add", "dev", NETIF, "parent", "1:"])
+    failed = command_batch.flush()
+    assert run_spy.call_count == 2
+    assert [command for command, _, _ in failed] == [
+        ["tc", "qdisc", "add", "dev", NETIF, "root"]
+    ]
+
+
+def test_parse_filter_without_rules():
+    output = (
+        "filter parent 1: protocol all pref 1 fw chain 0 \n"
+        "filter parent 1: protocol all pref 10 fw chain 0 \n"
+        "filter parent 1: protocol all pref 10 fw chain 0 handle 0x64 "
+        "classid 1:10 \n"
+    )
+    heads, rule = tc.parse_show_output(NETIF, output)
+    assert (heads.prio, heads.handle, heads.flowid) == (1, None, None)
+    assert (rule.prio, rule.handle) == (10, 100)
+
+
+def test_parse_filter_chain():
+    output = (
+        "filter parent 1: protocol ip pref 2 u32 chain 1 \n"
+        "filter parent 1: protocol ip pref 2 u32 chain 1 fh 800: ht divisor 1"
+        " \n"
+        "filter parent 1: protocol ip pref 2 u32 chain 0 fh 800: ht divisor 1"
+        " \n"
+    )
+    in_chain, in_root = tc.parse_show_output(NETIF, output)
+    assert (in_chain.chain, in_chain.handle) == (1, "800:")
+    assert in_root.chain == 0
+
+
+def test_parse_show_output():
+    output = (
+        '[{"kind":"htb","handle":"1:","root":true,"options":{"r2q":10,'
+        '"default":"0x10"}}]\n'
+        "class htb 1:10 parent 1:1 leaf 10: prio 1 quantum 1514 rate 1Mbit "
+        "ceil 2Mbit linklayer ethernet burst 10Kb/1 mpu 0b cburst 20Kb/1 "
+        "mpu 0b level 0\n"
+        "filter parent 1: protocol all pref 10 fw chain 0 \n"
+        "filter parent 1: protocol all pref 10 fw chain 0 handle 0x64 "
+        "classid 1:100\n"
+    )
+    qdisc, htb_class, fw_filter = tc.parse_show_output(NETIF, output)
+
+    assert (qdisc.kind, qdisc.handle, qdisc.parent) == ("htb", "1:", "root")
+    assert htb_class.classid == "1:10" and htb_class.parent == "1:1"
+    assert (htb_class.rate, htb_class.ceil) == (1000000, 2000000)
+    assert (htb_class.burst, htb_class.cburst) == (10240, 20480)
+    assert (fw_filter.prio, fw_filter.handle, fw_filter.flowid) == (
+        10, 100, "1:100"
+    )
+
+
+def test_parse_show_output_stats():
+    output = (
+        '[{"kind":"htb","handle":"1:","root":true,"options":{},"bytes":300,'
+        '"packets":3,"drops":1,"overlimits":2,"requeues":0,"backlog":60,'
+        '"qlen":1}]\n'
+        "class htb 1:10 parent 1:1 prio 0 rate 1Mbit ceil 1Mbit burst 1600b "
+        "cburst 1600b \n"
+        " Sent 200 bytes 2 pkt (dropped 1, overlimits 5 requeues 0) \n"
+        " backlog 1514b 1p requeues 0\n"
+        " lended: 0 borrowed: 0 giants: 0\n"
+        " tokens: 200000 ctokens: -3000\n"
+        "\n"
+        "class htb 1:1 root rate 1Mbit ceil 1Mbit burst 1600b cburst 1600b \n"
+    )
+    qdisc, leaf_class, root_class = tc.parse_show_output(NETIF, output)
+
+    assert qdisc.stats == Stats(300, 3, 1, 2, 0, 60, 1)
+    assert leaf_class.stats == Stats(200, 2, 1, 5, 0, 1514, 1, 200000, -3000)
+    assert root_class.stats is None
@@ -0,0 +1,34 @@
+import contextlib
+import types
+
+import pytest
+
+from pyqos import plan
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+from pyqos.app import PyQoS
+
+
+@pytest.fixture
+def fixture_rules():
+    """
+    Trees of the application, overridden by the tests needing other ones
+    """
+    root = RootHTBClass("eth0", rate=1000)
+    root.add_child(HTBClass(id=20, rate=100))
+    return [root]
+
+
+@pytest.fixture
+def fixture_app(mocker, fixture_rules):
+    """
+    Application with a fake backend, whose trees have been applied
+    """
+    app = PyQoS()
+    app.run_list = list(fixture_rules)
+    backend_module = types.SimpleNamespace(
+        batch=lambda dryrun=False: contextlib.ExitStack(),
+        qdisc=mocker.Mock(), qos_class=mocker.Mock(), filter=mocker.Mock()
+    )
+    mocker.patch.object(app, "get_backend", return_value=backend_module)
+    list(app._track_classes(plan.record(app.run_list)))
+    return app
@@ -0,0 +1,117 @@
+import pytest
+
+from pyqos.algorithms.htb import HTBClass, HTBFilterFQCodel, RootHTBClass
+from pyqos.algorithms.subscribers import add_subscribers
+from pyqos.allocator import Allocator, NumberPool
+from pyqos.exceptions import BadAttributeValueException, ConflictException
+
+
+def fixture_tree():
+    root = RootHTBClass("eth0", rate=10000)
+    root.add_child(HTBFilterFQCodel(id=10, mark=10, rate=1000),
+                   HTBClass(id=20, rate=1000))
+    return root
+
+
+def test_pool_reuse():
+    pool = NumberPool(2, 5)
+    pool.take(3)
+
+    assert [pool.allocate() for _ in range(3)] == [2, 4, 5]
+    with pytest.raises(BadAttributeValueException):
+        pool.allocate()
+    pool.release(4)
+    assert pool.allocate() == 4
+
+
+def test_pool_shared_number():
+    pool = NumberPool(1, 2)
+    pool.take(1)
+    pool.take(1)
+    pool.release(1)
+
+    assert 1 in pool
+    assert pool.allocate() == 2
+
+
+def test_allocate_ids():
+    root = fixture_tree()
+    allocator = Allocator(root)
+
+    leaves = allocator.add(root, *(HTBFilterFQCodel(rate=100)
+                                   for _ in range(3)), marks=True)
+
+    # 1: and 2: are the handles of the branch, 0x10 and 0x20 are taken
+    assert [leaf.classid for leaf in leaves] == ["1:3", "1:4", "1:5"]
+    assert [leaf.mark for leaf in leaves] == [1, 2, 3]
+    assert leaves[0] in root.children
+
+
+def test_allocate_recycle():
+    root = fixture_tree()
+    allocator = Allocator(root)
+    leaf, = allocator.add(root, HTBFilterFQCodel(rate=100), marks=True)
+
+    allocator.remove(leaf)
+    new, = allocator.add(root, HTBFilterFQCodel(rate=100), marks=True)
+
+    assert leaf not in root.children
+    assert (new.id, new.mark) == ("3", 1)
+
+
+def test_conflicts():
+    root = fixture_tree()
+    allocator = Allocator(root)
+
+    # ids are read in hexadecimal: "10" is the class 0x10
+    with pytest.raises(ConflictException):
+        allocator.add(root, HTBClass(id="10", rate=100))
+    with pytest.raises(ConflictException):
+        allocator.add(root, HTBFilterFQCodel(id=30, mark=10, rate=100))
+    # leaf qdisc with the handle of the root qdisc
+    with pytest.raises(ConflictException):
+        allocator.add(root, HTBFilterFQCodel(id=1, rate=100))
+    with pytest.raises(BadAttributeValueException):
+        allocator.add(root, HTBClass(id=70000, rate=100))
+    assert len(root.children) == 2
+    assert allocator.add(root, HTBClass(id="a", rate=100))
+
+
+def test_conflict_resets_allocated():
+    root = fixture_tree()
+    allocator = Allocator(root)
+    # the mark 10 is taken: the allocated id is not kept
+    leaf = HTBFilterFQCodel(mark=10, rate=100)
+    with pytest.raises(ConflictException):
+        allocator.add(root, leaf, marks=True)
+    assert leaf.id is None
+    # the id 1:10 is taken: the allocated mark is not kept
+    other = HTBFilterFQCodel(id="10", rate=100)
+    with pytest.raises(ConflictException):
+        allocator.add(root, other, marks=True)
+    assert other.mark is None
+
+    leaf.mark = None
+    allocator.add(root, leaf, marks=True)
+    assert (leaf.id, leaf.mark) == ("3", 1)
+
+
+def test_conflict_in_tree():
+    root = fixture_tree()
+    root.children[1].add_child(HTBFilterFQCodel(id=10, rate=100))
+
+    with pytest.raises(ConflictException):
+        Allocator(root)
+
+
+def test_allocate_subscribers():
+    root = fixture_tree()
+    allocator = Allocator(root, first_id=0x100)
+
+    subscribers = add_subscribers(
+        root, [("a1", None, "basic"), ("b2", None, "basic")],
+        {"basic": {"rate": 100}}, first_mark=1, allocator=allocator
+    )
+
+    assert [s.classid for s in subscribers] == ["1:100", "1:101"]
+    assert [s.mark for s in subscribers] == [1, 2]
@@ -0,0 +1,109 @@
+import pytest
+
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+from pyqos.autorate import Autorate, SimulatedLink
+from pyqos.exceptions import BadAttributeValueException
+
+
+@pytest.fixture
+def fixture_root():
+    root = RootHTBClass("eth0", rate=10000, ceil=10000)
+    root.add_child(HTBClass(id=20, rate=(50, ), ceil=(100, )))
+    return root
+
+
+@pytest.fixture
+def fixture_link():
+    return SimulatedLink(capacity=8000, rate=10000)
+
+
+@pytest.fixture
+def fixture_rules(fixture_root):
+    return [fixture_root]
+
+
+@pytest.fixture
+def fixture_app(fixture_app, fixture_root, fixture_link):
+    """
+    Application whose top class shapes the simulated link
+    """
+    def qos_class(interface, action, classid, rate, **kwargs):
+        assert action == "change"
+        if classid == fixture_root.classid:
+            fixture_link.rate = rate
+
+    fixture_app.get_backend().qos_class.side_effect = qos_class
+    return fixture_app
+
+
+def run(controller, link, steps):
+    for _ in range(steps):
+        link.advance(controller.interval)
+        controller.step()
+
+
+def test_autorate_follows_capacity(fixture_app, fixture_root, fixture_link):
+    controller = Autorate(fixture_app, fixture_root, 2000, 15000,
+                          fixture_link.probe, fixture_link.load)
+
+    # the link is slower than the shaper: the queue fills, the rate drops
+    run(controller, fixture_link, 20)
+    assert controller.rate < 8000
+    assert fixture_link.rate == controller.rate
+    assert fixture_link.probe() - fixture_link.base_rtt < 15
+
+    # the link gets faster: the rate rises up to its maximum
+    fixture_link.capacity = 30000
+    run(controller, fixture_link, 40)
+    assert controller.rate == fixture_link.rate == 15000
+
+    child = fixture_root.children[0]
+    assert (child.rate, child.ceil) == (7500, 15000)
+    assert fixture_app._applied_classes[("eth0", child.classid)]["rate"] == (
+        7500
+    )
+
+
+def test_autorate_idle(fixture_app, fixture_root, fixture_link):
+    fixture_link.demand = 1000
+    controller = Autorate(fixture_app, fixture_root, 2000, 15000,
+                          fixture_link.probe, fixture_link.load)
+
+    run(controller, fixture_link, 10)
+    assert controller.rate == 10000
+    fixture_app.get_backend().qos_class.assert_not_called()
+
+
+def test_autorate_lost_probe(fixture_app, fixture_root):
+    controller = Autorate(fixture_app, fixture_root, 9500, 15000,
+                          lambda: None, lambda: None)
+
+    assert controller.step() == 9500
+    assert controller.step() is None
+
+
+def test_autorate_bad_rate(fixture_app, fixture_root):
+    with pytest.raises(BadAttributeValueException):
+        Autorate(fixture_app, fixture_root.children[0], 2000, 15000,
+                 lambda: None)
+
+
+def test_autorate_controllers(fixture_app, fixture_root):
+    fixture_app.config["AUTORATE"] = [
+        {"interface": "eth0", "min_rate": 2000, "max_rate": 15000,
+         "target": "192.0.2.1"},
+        {"interface": "eth0", "classid": "1:20", "min_rate": 2000,
+         "max_rate": 15000, "probe": lambda: None},
+    ]
+    fixture_root.children[0].rate = 5000
+
+    controllers = fixture_app.autorate_controllers()
+    assert [c.node for c in controllers] == [fixture_root,
+                                             fixture_root.children[0]]
+    assert controllers[0].probe.target == "192.0.2.1"
+
+    fixture_app.config["AUTORATE"] = [
+        {"interface": "eth0", "min_rate": 2000, "max_rate": 15000}
+    ]
+    with pytest.raises(BadAttributeValueException, match="target"):
+        fixture_app.autorate_controllers()
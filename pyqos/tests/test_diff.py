@@ -0,0 +1,177 @@
+from pyqos import diff
+from pyqos.backend.records import ClassRecord, Dump, FilterRecord, QDiscRecord
+from pyqos.plan import Operation
+
+
+NETIF = "eth0"
+
+
+def wanted_operations():
+    return [
+        Operation("qdisc", "add", NETIF,
+                  {"algorithm": "htb", "handle": "1:", "default": 10}, None),
+        Operation("class", "add", NETIF,
+                  {"parent": "1:", "classid": "1:1", "algorithm": "htb",
+                   "rate": 1000}, None),
+        Operation("class", "add", NETIF,
+                  {"parent": "1:1", "classid": "1:10", "algorithm": "htb",
+                   "rate": 500, "ceil": 1000, "prio": 1}, None),
+        Operation("qdisc", "add", NETIF,
+                  {"algorithm": "sfq", "handle": "10", "parent": "1:10",
+                   "perturb": 10}, None),
+        Operation("filter", "add", NETIF,
+                  {"parent": "1:", "prio": 1, "handle": 10,
+                   "flowid": "1:10"}, None),
+    ]
+
+
+def live_dump(rate_10=500000, extra_class=False):
+    classes = [
+        ClassRecord(NETIF, "htb", "1:1", "1:", None, 1000000, 1000000, 1600,
+                    1600, None, None),
+        ClassRecord(NETIF, "htb", "1:10", "1:1", "10:", rate_10, 1000000,
+                    1600, 1600, 1, 1514),
+    ]
+    if extra_class:
+        classes.append(ClassRecord(NETIF, "htb", "1:20", "1:1", None, 100000,
+                                   1000000, 1600, 1600, 0, 1514))
+    return Dump(
+        NETIF,
+        qdiscs=[
+            QDiscRecord(NETIF, "htb", "1:", "root",
+                        {"r2q": 10, "default": "0x10"}),
+            QDiscRecord(NETIF, "sfq", "10:", "1:10", {"perturb": 10}),
+        ],
+        classes=classes,
+        filters=[FilterRecord(NETIF, "fw", "1:", "all", 1, 10, "1:10")],
+    )
+
+
+def test_diff_nothing_to_do():
+    assert diff.diff(wanted_operations(), {NETIF: live_dump()}) == []
+
+
+def test_diff_empty_interface_builds_everything():
+    operations = wanted_operations()
+    assert diff.diff(operations, {NETIF: Dump(NETIF)}) == operations
+
+
+def test_diff_change_class():
+    result = diff.diff(wanted_operations(), {NETIF: live_dump(200000)})
+    assert [(op.kind, op.action, op.args["classid"]) for op in result] == [
+        ("class", "change", "1:10")
+    ]
+
+
+def test_diff_delete_extra_class():
+    result = diff.diff(wanted_operations(),
+                       {NETIF: live_dump(extra_class=True)})
+    assert [(op.kind, op.action, op.args["classid"]) for op in result] == [
+        ("class", "delete", "1:20")
+    ]
+
+
+def test_diff_keep_kernel_classes():
+    dump = live_dump()
+    dump.classes["1:2"] = ClassRecord(NETIF, "mq", "1:2", "1:", None, None,
+                                      None, None, None, None, None)
+    assert diff.diff(wanted_operations(), {NETIF: dump}) == []
+
+
+def test_diff_mark_classid_filter():
+    operations = wanted_operations()
+    operations[-1] = Operation("filter", "add", NETIF,
+                               {"parent": "1:", "prio": 1}, None)
+    dump = live_dump()
+    assert [(op.action, op.args.get("handle")) for op in
+            diff.diff(operations, {NETIF: dump})] == [("delete", 10),
+                                                      ("add", None)]
+
+    dump.filters = [FilterRecord(NETIF, "fw", "1:", "all", 1, None, None)]
+    assert diff.diff(operations, {NETIF: dump}) == []
+
+
+def test_diff_rebuild_u32_lists():
+    operations = wanted_operations()
+    operations.append(Operation("filter", "add", NETIF, {
+        "parent": "1:", "prio": 2, "protocol": "ip", "kind": "u32",
+        "handle": "10:", "divisor": 256}, None))
+    dump = live_dump()
+    dump.filters.append(
+        FilterRecord(NETIF, "u32", "1:", "ip", 2, "800::800", None)
+    )
+
+    result = diff.diff(operations, {NETIF: dump})
+    assert result == [
+        Operation("filter", "delete", NETIF, {
+            "parent": "1:", "prio": 2, "protocol": "ip", "kind": "u32"
+        }, None),
+        operations[-1],
+    ]
+
+
+def test_diff_rebuild_when_root_differs():
+    operations = wanted_operations()
+    operations[0] = operations[0]._replace(
+        args={"algorithm": "htb", "handle": "2:"}
+    )
+    result = diff.diff(operations, {NETIF: live_dump()})
+    assert (result[0].kind, result[0].action) == ("qdisc", "delete")
+    assert result[1:] == operations
+
+
+def test_diff_clean_unused_interface():
+    result = diff.diff([], {NETIF: live_dump()})
+    assert [(op.kind, op.action) for op in result] == [("qdisc", "delete")]
+
+
+def test_swap_replaces_root():
+    operations = wanted_operations()
+    operations[0] = operations[0]._replace(
+        args={"algorithm": "htb", "handle": "2:"}
+    )
+    result = diff.swap(operations, {NETIF: live_dump()})
+    assert (result[0].kind, result[0].action) == ("qdisc", "replace")
+    assert result[1:] == operations[1:]
+
+
+def test_swap_same_handle_rebuilds():
+    operations = wanted_operations()
+    result = diff.swap(operations, {NETIF: live_dump()})
+    assert (result[0].kind, result[0].action) == ("qdisc", "delete")
+    assert result[1:] == operations
+
+
+def test_changed_interfaces():
+    old = [Operation("class", "add", "eth0", {"rate": 10}, None),
+           Operation("class", "add", "eth1", {"rate": 10}, None),
+           Operation("class", "add", "eth2", {"rate": 10}, None)]
+    new = [Operation("class", "add", "eth0", {"rate": 10}, object()),
+           Operation("class", "add", "eth1", {"rate": 20}, None),
+           Operation("class", "add", "eth3", {"rate": 10}, None)]
+
+    assert diff.changed_interfaces(old, new) == {"eth1", "eth2", "eth3"}
+
+
+def test_class_changes():
+    applied = {(NETIF, "1:10"): {"classid": "1:10", "rate": 10},
+               (NETIF, "1:20"): {"classid": "1:20", "rate": 10}}
+    operations = [
+        Operation("class", "add", NETIF, {"classid": "1:10", "rate": 10},
+                  None),
+        Operation("class", "add", NETIF, {"classid": "1:0x20", "rate": 20},
+                  None),
+        Operation("class", "add", NETIF, {"classid": "1:30", "rate": 10},
+                  None),
+    ]
+
+    result = diff.class_changes(applied, operations)
+    assert [(op.action, op.args["rate"]) for op in result] == [("change", 20)]
+
+
+def test_synced_classes():
+    operations = wanted_operations()
+
+    result = diff.synced_classes(operations, {NETIF: live_dump(200000)})
+    assert [op.args["classid"] for op in result] == ["1:1"]
+    assert diff.synced_classes(operations, {NETIF: Dump(NETIF)}) == []
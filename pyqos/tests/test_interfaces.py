@@ -0,0 +1,80 @@
+import socket
+
+import pytest
+
+from pyqos import interfaces, tools
+
+
+@pytest.fixture
+def fixture_cache(monkeypatch):
+    """
+    Cache with fake links, receiving its events from a socket pair
+    """
+    cache = interfaces.InterfaceCache()
+    events, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    events.setblocking(False)
+    loads = []
+
+    def load():
+        loads.append(True)
+        cache._loaded_at = cache.clock()
+        cache._links = {"eth0": interfaces.InterfaceInfo(
+            "eth0", 2, 1500 + len(loads), 1000, 4, 1000000
+        )}
+
+    cache._events = events
+    monkeypatch.setattr(cache, "load", load)
+    yield cache, kernel, loads
+    cache.close()
+    kernel.close()
+
+
+def test_cache_loaded_once(fixture_cache):
+    cache, _, loads = fixture_cache
+    for i in range(10):
+        assert cache.get("eth0").mtu == 1501
+    assert cache.get("eth1") is None
+    assert len(loads) == 1
+
+
+def test_cache_reload_on_link_event(fixture_cache):
+    cache, kernel, loads = fixture_cache
+    cache.get("eth0")
+    kernel.send(b"RTM_NEWLINK")
+    assert cache.get("eth0").mtu == 1502
+    assert cache.get("eth0").mtu == 1502
+    assert len(loads) == 2
+
+
+def test_cache_invalidate(fixture_cache):
+    cache, _, loads = fixture_cache
+    cache.get("eth0")
+    cache.invalidate()
+    cache.get("eth0")
+    assert len(loads) == 2
+
+
+def test_cache_ttl_without_events(fixture_cache):
+    cache, _, loads = fixture_cache
+    now = [0]
+    cache._events.close()
+    cache._events = None
+    cache.clock = lambda: now[0]
+
+    cache.get("eth0")
+    now[0] = cache.ttl - 1
+    cache.get("eth0")
+    assert len(loads) == 1
+    now[0] = cache.ttl
+    cache.get("eth0")
+    assert len(loads) == 2
+
+
+def test_get_mtu_large():
+    """
+    The MTU of lo (65536) does not fit in 16 bits
+    """
+    info = interfaces.get_info("lo")
+    assert info.index == socket.if_nametoindex("lo")
+    assert interfaces.get_mtu("lo") == info.mtu > 0
+    assert tools.get_mtu("lo") == info.mtu
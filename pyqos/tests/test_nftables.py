@@ -0,0 +1,72 @@
+import subprocess
+
+from pyqos import nftables
+from pyqos.algorithms.htb import HTBClass, HTBFilterPFIFO, RootHTBClass
+
+
+NETIF = "eth0"
+
+
+def fixture_tree(**kwargs):
+    root = RootHTBClass(NETIF, rate=10000, classifier="nftables", **kwargs)
+    root.add_child(
+        HTBFilterPFIFO(id=10, mark=10, rate=1000, prio=1, match=[
+            {"ip_proto": "tcp", "dst_port": 22},
+            {"ip_proto": "udp", "dst_port": 53},
+        ]),
+        HTBFilterPFIFO(id=20, mark=20, rate=1000, prio=1, dscp="EF"),
+        HTBFilterPFIFO(id=30, mark=30, rate=1000, prio=1,
+                       match={"ip_proto": "tcp", "dst_port": 22}),
+        HTBClass(id=40, rate=1000, match={"dst_ip": "10.0.0.0/8"}),
+    )
+    return root
+
+
+def test_mark_maps():
+    maps = nftables.mark_maps([fixture_tree()])
+
+    assert [(m.expression, m.type) for m in maps] == [
+        ("meta l4proto . th dport", "inet_proto . inet_service : mark"),
+        ("ip dscp", "dscp : mark"),
+    ]
+    # the first class matching a packet gets it
+    assert list(maps[0].elements.values()) == [10, 10]
+    assert maps[1].elements == {(46, ): 20}
+
+
+def test_mark_maps_classid():
+    maps = nftables.mark_maps([fixture_tree(mark_classid=True)])
+
+    assert maps[2].format_rule() == (
+        'oifname "eth0" meta mark set ip daddr map @mark_2 accept'
+    )
+    assert maps[2].interval
+    assert maps[2].format()[-3] == "\t\t\t10.0.0.0/8 : 0x00010040"
+
+
+def test_ruleset_replaces_table():
+    lines = nftables.ruleset([fixture_tree()]).splitlines()
+
+    assert lines[:3] == ["table inet pyqos", "delete table inet pyqos",
+                         "table inet pyqos {"]
+    assert "\t\t\ttcp . 22 : 0x0000000a," in lines
+    assert lines[-3:] == [
+        '\t\toifname "eth0" meta mark set ip dscp map @mark_1 accept',
+        "\t}", "}"
+    ]
+
+
+def test_flower_disabled():
+    root = fixture_tree()
+    assert not list(root.children[0]._compile_match())
+
+
+def test_load(mocker):
+    run = mocker.patch("subprocess.run", return_value=mocker.Mock(
+        returncode=1, stderr="Error: syntax error"
+    ))
+    assert not nftables.load("table inet pyqos\n")
+    run.assert_called_once_with(
+        ["nft", "-f", "-"], input="table inet pyqos\n",
+        stderr=subprocess.PIPE, universal_newlines=True
+    )
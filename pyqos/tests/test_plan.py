@@ -0,0 +1,86 @@
+import pytest
+
+from pyqos import backend, plan
+from pyqos.algorithms.htb import HTBClass, HTBFilterPFIFO, RootHTBClass
+
+
+NETIF = "eth0"
+
+
+@pytest.fixture
+def fixture_tree():
+    root = RootHTBClass(NETIF, rate=10000, r2q=10)
+    main = HTBClass(id=2, rate=5000)
+    root.add_child(main)
+    main.add_child(HTBFilterPFIFO(id=20, mark=20, rate=1000, prio=1))
+    return root
+
+
+class Custom():
+    """
+    Object of the run_list without compile method
+    """
+    def apply(self, dryrun=False):
+        backend.get_backend().qdisc_add(NETIF, handle="9:", algorithm="sfq")
+
+
+def test_compile_is_lazy(fixture_tree, mocker):
+    spy = mocker.spy(HTBFilterPFIFO, "_compile_filter")
+    operations = plan.compile([fixture_tree])
+
+    assert next(operations).args == {"algorithm": "htb", "handle": "1:",
+                                     "r2q": 10}
+    assert not spy.called
+    assert [(op.kind, op.origin) for op in operations] == [
+        ("class", fixture_tree), ("class", fixture_tree.children[0]),
+        ("class", fixture_tree.children[0].children[0]),
+        ("qdisc", fixture_tree.children[0].children[0].qdisc),
+        ("filter", fixture_tree.children[0].children[0]),
+    ]
+    assert spy.call_count == 1
+
+
+def test_compile_same_as_apply(fixture_tree):
+    recorder = plan.Recorder()
+    with backend.use_backend(recorder):
+        fixture_tree.apply()
+
+    compiled = plan.record([fixture_tree])
+    assert compiled == recorder.operations
+
+
+def test_compile_objects_without_compile():
+    assert plan.record([Custom()]) == [plan.Operation(
+        "qdisc", "add", NETIF, {"algorithm": "sfq", "handle": "9:"}, None
+    )]
+
+
+def test_serialize(fixture_tree):
+    operations = plan.record([fixture_tree])
+    lines = list(plan.serialize(operations))
+
+    assert len(lines) == len(operations)
+    assert list(plan.deserialize(lines + [""])) == [
+        op._replace(origin=None) for op in operations
+    ]
+
+
+def test_execute_parallel(fixture_tree):
+    class FailingRecorder(plan.Recorder):
+        def qdisc(self, interface, *args, **kwargs):
+            if interface == "eth1":
+                raise OSError("No such device")
+            super().qdisc(interface, *args, **kwargs)
+
+    recorder = FailingRecorder()
+    results = plan.execute_parallel({
+        NETIF: plan.compile([fixture_tree]),
+        "eth1": [plan.make_operation("qdisc", "delete", "eth1")],
+    }, workers=2, backend_module=recorder)
+
+    assert [(r.interface, r.failed) for r in results] == [
+        (NETIF, []), ("eth1", [])
+    ]
+    assert results[0].error is None
+    assert isinstance(results[1].error, OSError)
+    assert len(recorder.operations) == 6
@@ -0,0 +1,182 @@
+import datetime
+
+import pytest
+
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+from pyqos.exceptions import BadAttributeValueException
+from pyqos.profiles import ProfileScheduler, Schedule
+
+PROFILES = {
+    "day": {("eth0", "1:10"): {"rate": 8000, "prio": 0}},
+    "backup": {("eth0", "1:20"): {"rate": 8000, "ceil": 10000}},
+}
+
+SCHEDULE = [
+    {"start": "08:00", "profile": "day", "days": "mon-fri"},
+    {"start": "19:00", "profile": None},
+    {"start": "01:00", "profile": "backup", "dates": ["2026-10-17"]},
+]
+
+
+def at(day, time):
+    """
+    Datetime of a day of the week of 2026-10-12, a monday
+    """
+    hours, minutes = map(int, time.split(":"))
+    return datetime.datetime(2026, 10, 12 + day, hours, minutes)
+
+
+@pytest.fixture
+def fixture_rules():
+    root = RootHTBClass("eth0", rate=10000, ceil=10000)
+    root.add_child(HTBClass(id=10, rate=2000, ceil=(100, ), prio=1))
+    root.add_child(HTBClass(id=20, rate=1000, ceil=(50, ), prio=2))
+    root.children[1].add_child(HTBClass(id=21, rate=(50, ), prio=2))
+    return [root]
+
+
+def test_schedule():
+    schedule = Schedule(SCHEDULE)
+
+    assert schedule.active(at(0, "07:59")) is None
+    assert schedule.active(at(0, "08:00")) == "day"
+    assert schedule.active(at(0, "19:00")) is None
+    assert schedule.active(at(1, "18:00")) == "day"
+    assert schedule.active(at(4, "23:00")) is None
+    # the dated switches replace the other ones of their date, a saturday
+    assert schedule.active(at(5, "00:30")) is None
+    assert schedule.active(at(5, "20:00")) == "backup"
+    # the last switch of the saturday lasts until the next one
+    assert schedule.active(at(6, "12:00")) == "backup"
+    assert schedule.active(at(6, "19:30")) is None
+
+
+def test_schedule_bad_entries():
+    with pytest.raises(BadAttributeValueException):
+        Schedule([{"start": "08:00", "profile": "day", "days": "mon-xyz"}])
+    with pytest.raises(BadAttributeValueException):
+        Schedule([{"start": "8h", "profile": "day"}])
+
+
+def test_switch(fixture_app):
+    clock = [at(0, "07:00")]
+    scheduler = ProfileScheduler(fixture_app, PROFILES, SCHEDULE,
+                                 clock=lambda: clock[0])
+    qos_class = fixture_app.get_backend().qos_class
+
+    assert scheduler.run_pending() is None
+    qos_class.assert_not_called()
+
+    clock[0] = at(0, "08:00")
+    operations = scheduler.run_pending()
+    assert [(op.args["classid"], op.args["rate"], op.args["prio"])
+            for op in operations] == [("1:10", 8000, 0)]
+    assert qos_class.call_count == 1
+    assert fixture_app.find_class("eth0", "1:10").rate == 8000
+    assert scheduler.run_pending() is None
+
+    # the classes of the previous profile go back to the rules
+    operations = scheduler.switch("backup")
+    assert sorted((op.args["classid"], op.args["rate"],
+                   op.args.get("ceil")) for op in operations) == [
+        ("1:10", 2000, 10000), ("1:20", 8000, 10000), ("1:21", 4000, None)
+    ]
+    node = fixture_app.find_class("eth0", "1:10")
+    assert (node.rate, node.prio) == (2000, 1)
+
+
+def test_bad_profiles(fixture_app):
+    with pytest.raises(BadAttributeValueException, match="no class"):
+        ProfileScheduler(fixture_app, {"day": {("eth0", "1:30"): {}}})
+    with pytest.raises(BadAttributeValueException, match="burst"):
+        ProfileScheduler(fixture_app,
+                         {"day": {("eth0", "1:10"): {"burst": 10}}})
+    with pytest.raises(BadAttributeValueException, match="Unknown profile"):
+        ProfileScheduler(fixture_app, PROFILES,
+                         [{"start": "08:00", "profile": "night"}])
+
+
+def test_reload_keeps_profile(fixture_app, mocker):
+    rules = fixture_app.run_list[0]
+
+    @fixture_app.rules_loader
+    def load(app):
+        app.run_list = [rules]
+
+    fixture_app.config["PROFILES"] = PROFILES
+    fixture_app.load_scheduler().switch("day")
+    apply_qos = mocker.patch.object(fixture_app, "apply_qos")
+    rules = RootHTBClass("eth0", rate=10000, ceil=10000)
+    rules.add_child(HTBClass(id=10, rate=2000, ceil=(100, ), prio=1))
+    rules.add_child(HTBClass(id=20, rate=1000, ceil=(50, ), prio=2))
+    rules.children[1].add_child(HTBClass(id=21, rate=(50, ), prio=2))
+
+    assert fixture_app.reload() == set()
+    apply_qos.assert_not_called()
+    assert fixture_app.scheduler.profile == "day"
+    assert fixture_app.find_class("eth0", "1:10").rate == 8000
+
+
+def test_switch_keeps_live_rates(fixture_app):
+    clock = [at(0, "07:00")]
+    scheduler = ProfileScheduler(fixture_app, PROFILES, SCHEDULE,
+                                 clock=lambda: clock[0])
+    fixture_app.update_rates({("eth0", "1:20"): (1500, None),
+                              ("eth0", "1:1"): (6000, 6000)})
+
+    clock[0] = at(0, "08:00")
+    operations = scheduler.run_pending()
+    assert sorted((op.args["classid"], op.args["rate"], op.args["prio"])
+                  for op in operations) == [("1:10", 8000, 0)]
+    for classid, rate in (("1:1", 6000), ("1:20", 1500), ("1:10", 8000)):
+        assert fixture_app.find_class("eth0", classid).rate == rate
+        assert fixture_app._applied_classes[("eth0", classid)]["rate"] == (
+            rate
+        )
+
+    # back to the rules: only the overridden attributes are restored
+    clock[0] = at(0, "19:00")
+    operations = scheduler.run_pending()
+    assert [(op.args["classid"], op.args["rate"], op.args["prio"])
+            for op in operations] == [("1:10", 2000, 1)]
+    assert fixture_app.find_class("eth0", "1:20").rate == 1500
+
+
+def test_reload_loads_profiles(fixture_app, fixture_rules, mocker):
+    @fixture_app.rules_loader
+    def load(app):
+        app.run_list = list(fixture_rules)
+
+    mocker.patch.object(fixture_app, "apply_qos")
+    assert fixture_app.scheduler is None
+
+    fixture_app.config["PROFILES"] = PROFILES
+    fixture_app.reload()
+    assert sorted(fixture_app.scheduler.profiles) == ["backup", "day"]
+
+    del fixture_app.config["PROFILES"]
+    fixture_app.reload()
+    assert fixture_app.scheduler is None
+
+
+def test_profiles_with_autorate(fixture_app):
+    fixture_app.config["AUTORATE"] = [
+        {"interface": "eth0", "classid": "1:10", "min_rate": 500,
+         "max_rate": 5000, "probe": lambda: None, "load": lambda: None}
+    ]
+    fixture_app.config["PROFILES"] = PROFILES
+    with pytest.raises(BadAttributeValueException, match="autorate"):
+        fixture_app.load_scheduler()
+
+    # the profiles can still override the other attributes of the class
+    fixture_app.config["PROFILES"] = {"day": {("eth0", "1:10"): {"prio": 0}}}
+    scheduler = fixture_app.load_scheduler()
+    controller, = fixture_app.autorate_controllers()
+    scheduler.switch("day")
+    # the probe is lost: the rate is lowered
+    assert controller.step() == 1800
+    scheduler.switch(None)
+
+    node = fixture_app.find_class("eth0", "1:10")
+    assert (node.rate, node.ceil, node.prio) == (1800, 1800, 1)
+    assert fixture_app._applied_classes[("eth0", "1:10")]["rate"] == 1800
@@ -0,0 +1,215 @@
+import contextlib
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from pyqos import server
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+from pyqos.app import PyQoS
+from pyqos.exceptions import BadAttributeValueException, CommandException
+
+
+@pytest.fixture
+def fixture_app(fixture_app, mocker):
+    mocker.patch.object(fixture_app, "apply_qos")
+    mocker.patch.object(fixture_app, "command_batch",
+                        return_value=contextlib.ExitStack())
+    return fixture_app
+
+
+@pytest.fixture
+def fixture_server(fixture_app, tmp_path):
+    daemon = server.Server(fixture_app, str(tmp_path / "pyqos.sock"))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    thread.join()
+    daemon.server_close()
+
+
+def test_set_rate(fixture_server, fixture_app):
+    changed = server.request("set_rate", fixture_server.path,
+                             interface="eth0", classid="1:20", rate=200,
+                             ceil=400)
+
+    node = fixture_app.find_class("eth0", "1:20")
+    assert (node.rate, node.ceil) == (200, 400)
+    assert changed == 1
+    qos_class = fixture_app.get_backend().qos_class
+    qos_class.assert_called_once()
+    assert qos_class.call_args[0] == ("eth0", "change")
+    assert qos_class.call_args[1]["rate"] == 200
+    fixture_app.apply_qos.assert_not_called()
+
+    # nothing changed since
+    assert server.request("set_rate", fixture_server.path,
+                          interface="eth0", classid="1:20", rate=200) == 0
+
+
+def test_set_rate_not_applied(fixture_server, fixture_app):
+    fixture_app._applied_classes.clear()
+
+    with pytest.raises(CommandException, match="has not been applied"):
+        server.request("set_rate", fixture_server.path, interface="eth0",
+                       classid="1:20", rate=200)
+    assert fixture_app.find_class("eth0", "1:20").rate == 100
+
+
+def test_clients(fixture_server, fixture_app):
+    # a client keeping its connection open does not block the others
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(fixture_server.path)
+        assert server.request("profile", fixture_server.path) is None
+    assert not stat.S_IMODE(os.stat(fixture_server.path).st_mode) & 0o077
+
+
+def test_apply_failure_keeps_applied(fixture_app, mocker):
+    mocker.patch.object(fixture_app, "run_as_root")
+    mocker.patch.object(fixture_app, "dump_interfaces", return_value={})
+    mocker.patch("pyqos.plan.record",
+                 side_effect=BadAttributeValueException("Bad rate"))
+    applied = dict(fixture_app._applied_classes)
+
+    with pytest.raises(BadAttributeValueException):
+        PyQoS.apply_qos(fixture_app)
+    assert fixture_app._applied_classes == applied
+
+
+def test_autorate_probe(fixture_app, tmp_path):
+    probing = threading.Event()
+    answered = threading.Event()
+
+    def probe():
+        probing.set()
+        answered.wait(5)
+        return None
+
+    fixture_app.config["AUTORATE"] = [
+        {"interface": "eth0", "min_rate": 500, "max_rate": 2000,
+         "probe": probe, "load": lambda: None}
+    ]
+    daemon = server.Server(fixture_app, str(tmp_path / "pyqos.sock"))
+    try:
+        assert probing.wait(5)
+        # the probe waiting for the network does not block the commands
+        state, = daemon.dispatch('{"command": "autorate"}')["result"]
+        assert state["rate"] == 1000
+        answered.set()
+        for _ in range(50):
+            if daemon.controllers[0].rate != 1000:
+                break
+            time.sleep(0.1)
+    finally:
+        daemon.server_close()
+
+    # the probe has been lost: the rate is lowered
+    assert fixture_app.find_class("eth0", "1:1").rate == 900
+
+
+def test_errors(fixture_server):
+    with pytest.raises(CommandException, match="Unknown command"):
+        server.request("restart", fixture_server.path)
+    with pytest.raises(CommandException, match="Bad arguments"):
+        server.request("apply", fixture_server.path, rate=2)
+    with pytest.raises(CommandException, match="No class"):
+        server.request("set_rate", fixture_server.path, interface="eth0",
+                       classid="1:30", rate=200)
+
+
+def test_reload(fixture_server, fixture_app):
+    interfaces = ["eth0"]
+
+    @fixture_app.rules_loader
+    def load(app):
+        for interface in interfaces:
+            app.run_list.append(RootHTBClass(interface, rate=2000))
+
+    interfaces[:] = ["eth1"]
+    changed = server.request("reload", fixture_server.path)
+
+    assert [r.interface for r in fixture_app.run_list] == ["eth1"]
+    assert changed == ["eth0", "eth1"]
+    fixture_app.apply_qos.assert_called_once_with({"eth0", "eth1"})
+
+
+def test_reload_only_changed(fixture_app, tmp_path):
+    rules = tmp_path / "rules.py"
+    rules.write_text("RATES = {'eth0': 1000, 'eth1': 2000}\n")
+    fixture_app.config.from_pyfile(str(rules))
+
+    @fixture_app.rules_loader
+    def load(app):
+        for interface, rate in sorted(app.config["RATES"].items()):
+            app.run_list.append(RootHTBClass(interface, rate=rate))
+
+    daemon = server.Server(fixture_app, str(tmp_path / "pyqos.sock"),
+                           watch=True)
+    try:
+        rules.write_text("RATES = {'eth0': 1000, 'eth1': 3000}\n")
+        daemon.service_actions()
+        daemon.service_actions()
+    finally:
+        daemon.server_close()
+
+    assert fixture_app.run_list[1].rate == 3000
+    fixture_app.apply_qos.assert_called_once_with({"eth1"})
+
+
+def test_reload_class_changes(fixture_app):
+    rates = [100]
+
+    @fixture_app.rules_loader
+    def load(app):
+        root = RootHTBClass("eth0", rate=1000)
+        root.add_child(HTBClass(id=20, rate=rates[0]))
+        app.run_list.append(root)
+
+    rates[0] = 200
+    assert fixture_app.reload() == {"eth0"}
+
+    # only the class is changed, without rebuilding the filters
+    fixture_app.apply_qos.assert_not_called()
+    backend_module = fixture_app.get_backend()
+    backend_module.filter.assert_not_called()
+    backend_module.qos_class.assert_called_once()
+    assert backend_module.qos_class.call_args[0] == ("eth0", "change")
+    assert backend_module.qos_class.call_args[1]["rate"] == 200
+
+
+def test_reload_failure_keeps_rules(fixture_app, tmp_path):
+    rules = tmp_path / "rules.py"
+    rules.write_text("RATE = 1000\n")
+    fixture_app.config.from_pyfile(str(rules))
+
+    @fixture_app.rules_loader
+    def load(app):
+        root = RootHTBClass("eth0", rate=app.config["RATE"])
+        app.run_list.append(root)
+        root.add_child(HTBClass(
+            id=20, rate=app.config["RATE"] // app.config.get("RATIO", 1)
+        ))
+
+    run_list = fixture_app.run_list
+    rules.write_text("RATE = 2000\nRATIO = 0\n")
+    with pytest.raises(ZeroDivisionError):
+        fixture_app.reload()
+
+    assert fixture_app.run_list is run_list
+    assert fixture_app.config["RATE"] == 1000
+    assert "RATIO" not in fixture_app.config
+    fixture_app.apply_qos.assert_not_called()
+
+
+def test_dispatch_invalid(fixture_app, tmp_path):
+    daemon = server.Server(fixture_app, str(tmp_path / "pyqos.sock"))
+    try:
+        assert "error" in daemon.dispatch(b"[1, 2]")
+        assert daemon.dispatch('{"command": "apply"}') == {"result": None}
+    finally:
+        daemon.server_close()
+    assert not (tmp_path / "pyqos.sock").exists()
@@ -0,0 +1,68 @@
+import pytest
+
+from pyqos import solver
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+
+numpy = pytest.importorskip("numpy")
+
+
+def fixture_tree():
+    root = RootHTBClass("eth0", rate=10000, ceil=20000)
+    web = HTBClass(id=10, rate=(50, 1000), ceil=(80, 0, 12000))
+    video = HTBClass(id=20, rate=(10, 3000), ceil=None)
+    web.add_child(HTBClass(id=11, rate=(30, ), ceil=(200, )))
+    video.add_child(HTBClass(id=21, rate=500, ceil=(50, 100)))
+    root.add_child(web, video)
+    return root
+
+
+def speeds(root):
+    return [(node.classid, node.rate, node.ceil)
+            for node in solver.RateSolver(root).nodes]
+
+
+def test_solve_like_getters():
+    expected = speeds(fixture_tree())
+    root = fixture_tree()
+
+    assert solver.resolve(root)
+    assert speeds(root) == expected
+    assert expected == [
+        ("1:1", 10000, 20000), ("1:10", 5000, 12000), ("1:20", 3000, None),
+        ("1:11", 1500, 12000), ("1:21", 500, 1500),
+    ]
+
+
+def test_solve_levels():
+    root = fixture_tree()
+    rate_solver = solver.RateSolver(root)
+
+    assert rate_solver.bounds == [0, 1, 3, 5]
+    assert rate_solver.parents.tolist() == [-1, 0, 0, 1, 2]
+    rates = rate_solver.solve()["rate"]
+    assert rates.tolist() == [10000, 5000, 3000, 1500, 500]
+
+
+def test_resolve_top_change():
+    root = fixture_tree()
+    rate_solver = solver.RateSolver(root)
+    rate_solver.resolve()
+
+    root.rate = 4000
+    rate_solver.resolve()
+
+    assert [node.rate for node in rate_solver.nodes] == [
+        4000, 2000, 3000, 600, 500
+    ]
+
+
+def test_unknown_parent_speed():
+    root = fixture_tree()
+    orphan = HTBClass(id=30, rate=None)
+    orphan.add_child(HTBClass(id=31, rate=(10, )))
+    root.add_child(orphan)
+
+    solver.resolve(root)
+
+    with pytest.raises(TypeError):
+        orphan.children[0].rate
@@ -0,0 +1,66 @@
+from pyqos import stats
+from pyqos.algorithms.htb import HTBClass, RootHTBClass
+from pyqos.backend.records import ClassRecord, Dump, Stats
+
+
+NETIF = "eth0"
+
+
+class FakeBackend():
+    def __init__(self):
+        self.counters = {}
+        self.dumps = []
+
+    def dump(self, interface, stats=False):
+        self.dumps.append(interface)
+        return Dump(interface, classes=[
+            ClassRecord(interface, "htb", classid, "1:", None, 0, 0, 0, 0, 0,
+                        0, counters)
+            for classid, counters in self.counters.items()
+        ])
+
+
+def test_poller_rates():
+    root = RootHTBClass(NETIF, rate=1000)
+    child = HTBClass(id=20, rate=100)
+    root.add_child(child)
+    fake_backend = FakeBackend()
+    clock = iter([10, 12]).__next__
+    poller = stats.Poller([root], backend_module=fake_backend, clock=clock)
+
+    fake_backend.counters = {"1:1": Stats(1000, 10, 0),
+                             "1:20": Stats(500, 5, 1)}
+    poller.sample()
+    assert child.stats.rate_bps is None
+
+    fake_backend.counters = {"1:1": Stats(3000, 30, 0),
+                             "1:20": Stats(2500, 25, 5)}
+    result = poller.sample()
+
+    assert fake_backend.dumps == [NETIF, NETIF]
+    assert (child.stats.rate_bps, child.stats.rate_pps,
+            child.stats.drop_rate) == (8000, 10, 2)
+    assert result[root].rate_bps == 8000
+
+
+def test_poller_counters_reset():
+    root = RootHTBClass(NETIF, rate=1000)
+    fake_backend = FakeBackend()
+    clock = iter([0, 1]).__next__
+    poller = stats.Poller([root], backend_module=fake_backend, clock=clock)
+
+    fake_backend.counters = {"1:1": Stats(5000, 50, 0)}
+    poller.sample()
+    fake_backend.counters = {"1:1": Stats(100, 1, 0)}
+    poller.sample()
+
+    assert root.stats.rate_bps == 800
+
+
+def test_poller_skips_bad_classids():
+    root = RootHTBClass(NETIF, rate=1000)
+    root.add_child(HTBClass(id="1g0", rate=100))
+    fake_backend = FakeBackend()
+    poller = stats.Poller([root], backend_module=fake_backend)
+
+    assert list(poller.nodes()) == [(NETIF, "1:1")]
@@ -1,39 +1,85 @@
 #!/usr/bin/env python3
 # Author: Anthony Ruhier
 
-from fcntl import ioctl
+from contextlib import contextmanager
 import logging
 import socket
 import subprocess
-import struct
+import threading
 
 _logger = logging.getLogger(__name__)
 
+#: per-thread state: command batch currently active and stack of the objects
+#: generating the commands
+_context = threading.local()
 
-def get_mtu(ifname):
+
+def get_batch():
+    """
+    Return the command batch active in the current thread, or None
+    """
+    return getattr(_context, "batch", None)
+
+
+def set_batch(batch):
     """
-    Use socket ioctl call to get MTU size of an interface
+    Set the command batch in which the commands will be queued, instead of
+    being launched directly. Set it to None to disable batching.
+    """
+    _context.batch = batch
+
+
+def get_command_origin():
+    """
+    Return the object generating the current commands, or None
+    """
+    origins = getattr(_context, "origins", None)
+    return origins[-1] if origins else None
+
+
+@contextmanager
+def command_origin(obj):
+    """
+    Declare obj as the generator of the commands launched in this context
+
+    Used to map the errors of a batch to the objects that generated them.
     """
-    SIOCGIFMTU = 0x8921
-    s = socket.socket(type=socket.SOCK_DGRAM)
-    ifr = ifname + '\x00'*(32-len(ifname))
+    if getattr(_context, "origins", None) is None:
+        _context.origins = []
+    _context.origins.append(obj)
     try:
-        ifs = ioctl(s, SIOCGIFMTU, ifr)
-        mtu = struct.unpack('<H', ifs[16:18])[0]
-    except Exception:
-        _logger.warning("Cannot find the MTU of %s. Will use 1500", ifname)
-        mtu = 1500
-    return mtu
+        yield obj
+    finally:
+        _context.origins.pop()
+
+
+def get_mtu(ifname):
+    """
+    Return the MTU of an interface, from the cache of
+    :mod:`pyqos.interfaces`
+
+    Kept for the existing callers, use :func:`pyqos.interfaces.get_mtu`.
+    """
+    from pyqos import interfaces
+    return interfaces.get_mtu(ifname)
 
 
 def launch_command(command, stderr=None, dryrun=False):
     """
     If the script is launched in debug mode, just prints the command.
     Otherwise, starts it with subprocess.call()
+
+    If a batch is active and accepts the command, the command is queued in it
+    instead, unless it is a dry run.
     """
-    _logger.debug(" ".join(command))
     if dryrun:
+        _logger.debug(" ".join(command))
         return
+    batch = get_batch()
+    if batch is not None and batch.accepts(command):
+        batch.add(command, origin=get_command_origin(), stderr=stderr)
+        return
+    _logger.debug(" ".join(command))
     r = subprocess.call(command, stderr=stderr)
     if r != 0:
         if stderr == subprocess.DEVNULL:
@@ -41,6 +87,20 @@ def launch_command(command, stderr=None, dryrun=False):
         _logger.error(" ".join(command))
 
 
+def interface_names(interface=None):
+    """
+    Return a list of interface names from an interface parameter
+
+    :param interface: name of an interface, list of names, or None for all
+        the interfaces of the system
+    """
+    if interface is None:
+        return [name for _, name in socket.if_nameindex()]
+    if isinstance(interface, str):
+        return [interface]
+    return list(interface)
+
+
 def get_child_qdiscid(classid):
     """
     Return the id to handle for a child qdisc. By convention, it will take its
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Author: Anthony Ruhier
+# Watch the files of the configuration and of the rules with inotify
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+_logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: header of an inotify event: wd, mask, cookie, len
+_EVENT = struct.Struct("=iIII")
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    return _libc
+
+
+class Watcher():
+    """
+    Report the files modified among a set of files
+
+    The directories of the files are watched rather than the files, so a
+    file replaced by an editor (written aside, then renamed) is still
+    reported.
+    """
+    def __init__(self, paths):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "inotify_init1: " + os.strerror(error))
+        #: watched files
+        self.paths = set(os.path.abspath(p) for p in paths)
+        #: watched directories, by watch descriptor
+        self._directories = {}
+        for directory in sorted(set(os.path.dirname(p) for p in self.paths)):
+            wd = libc.inotify_add_watch(
+                self.fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            if wd < 0:
+                error = ctypes.get_errno()
+                _logger.warning("Cannot watch %s: %s", directory,
+                                os.strerror(error))
+                continue
+            self._directories[wd] = directory
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        Read the pending events, without waiting
+
+        :return: set of the watched files modified since the last read
+        """
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0").decode()
+                offset += length
+                path = os.path.join(self._directories.get(wd, ""), name)
+                if path in self.paths:
+                    changed.add(path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
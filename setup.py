@@ -38,6 +38,7 @@ setup(
     keywords="networking qos linux development",
     packages=["pyqos", "pyqos.algorithms", "pyqos.backend"],
     install_requires=["argparse", ],
+    extras_require={"solver": ["numpy"], },
     setup_requires=['pytest-runner', ],
     tests_require=['pytest', 'pytest-cov', "pytest-mock", "pytest-xdist"],
 )